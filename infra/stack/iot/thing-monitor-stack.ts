@@ -15,7 +15,9 @@ export class ThingMonitorStack extends base.BaseStack {
         super(appContext, stackConfig);
 
         const ruleList: any[] = [
-            { name: 'thing_updated', topic: 'update/accepted', sns_topic: 'node_updated_topic_test', sql_fields: 'topic(3) as thing_name, topic(6) as shadow_name, state.reported as reported' },
+            // update/documents carries the full reported state after each update, the
+            // daemon only sends the keys that changed so update/accepted has a partial state
+            { name: 'thing_updated', topic: 'update/documents', sns_topic: 'node_updated_topic_test', sql_fields: 'topic(3) as thing_name, topic(6) as shadow_name, current.state.reported as reported' },
             { name: 'thing_deleted', topic: 'delete/accepted', sns_topic: 'node_deleted_topic_test', sql_fields: 'topic(3) as thing_name, topic(6) as shadow_name' },
         ];
 
@@ -57,7 +59,7 @@ HTTPS: https://matterdashboard.netlify.app/.netlify/functions/shadowUpdateWebhoo
             })
         );
 
-        SnsTopic.addSubscription(new subscriptions.LambdaSubscription(new lambda.Function(this, `iot-update-db-${ruleName}`, {
+        const updateDbFunction = new lambda.Function(this, `iot-update-db-${ruleName}`, {
             functionName: `${this.projectPrefix}-iot-update-db-${ruleName}Function`,
             code: lambda.Code.fromAsset('./src/lambda/custom_iot_update_db/src/gg-iot-update-db.zip'),
             handler: `handler.lambda_handler_${ruleName}`,
@@ -69,7 +71,20 @@ HTTPS: https://matterdashboard.netlify.app/.netlify/functions/shadowUpdateWebhoo
                 PASSWORD: this.stackConfig.Password,
                 USERNAME: this.stackConfig.Username,
             },
-        })));
+        });
+
+        // the shards of a sharded endpoint shadow are read back to rebuild the endpoint
+        updateDbFunction.addToRolePolicy(
+            new iam.PolicyStatement({
+                resources: ['*'],
+                actions: [
+                    "iot:DescribeEndpoint",
+                    "iot:GetThingShadow"
+                ]
+            })
+        );
+
+        SnsTopic.addSubscription(new subscriptions.LambdaSubscription(updateDbFunction));
 
         new iot.CfnTopicRule(this, ruleName, {
             ruleName: `${this.projectPrefix.toLowerCase().replace('-', '_')}_${ruleName}`,
@@ -0,0 +1,93 @@
+#
+# Copyright (c) 2023 Matter Cloud Controller Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Measure decode-and-validate throughput of the command decoder used by the
+MQTT, REST and test file ingress (MatterCommand.from_json, which checks each
+command against its compiled schema) against the previous ingress, which
+decoded with the standard library json and only checked for the message_id
+and command keys. Malformed commands are measured too since they are
+rejected before they reach the queue.
+
+To Run:
+python3 src/component/mcc-daemon/benchmarks/benchCommandDecoder.py
+"""
+
+import json
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__)))+'/src')
+import jsonCodec
+from matterCommand import MatterCommand, CommandError
+
+ITERATIONS = 100000
+
+COMMANDS = {
+    "write_attribute": json.dumps({
+        "message_id": "12345",
+        "command": "write_attribute",
+        "args": {"endpoint_id": 1, "node_id": 1, "attribute_path": "1/6/0", "value": True}
+    }),
+    "open_commissioning_window": json.dumps({
+        "message_id": "12346",
+        "command": "open_commissioning_window",
+        "args": {"node_id": 1, "timeout": 300, "iteration": 1000, "option": 1, "discriminator": 3840}
+    }),
+    "call_webhook": json.dumps({
+        "message_id": "12347",
+        "command": "call_webhook",
+        "webhook_method": "POST",
+        "webhook_url": "http://localhost:8080",
+        "webhook_endpoint": "/matter/events",
+        "args": {"node_id": 1, "event": "attribute_updated"}
+    }),
+    "malformed write_attribute": json.dumps({
+        "message_id": "12348",
+        "command": "write_attribute",
+        "args": {"node_id": "1", "attribute_path": "1/6/0", "value": True}
+    }),
+}
+
+def key_check(raw):
+    try:
+        message = json.loads(raw)
+    except json.JSONDecodeError:
+        return None
+    if not all(k in message for k in ("message_id", "command")):
+        return None
+    return message
+
+def decode(raw):
+    try:
+        return MatterCommand.from_json(raw)
+    except CommandError:
+        return None
+
+def run(name, function, raw):
+    seconds = min(timeit.repeat(lambda: function(raw), number=ITERATIONS, repeat=3))
+    per_command = seconds / ITERATIONS * 1e6
+    print(f"{name:<44} {per_command:8.3f} us/command {1 / per_command:8.2f} M/s")
+    return per_command
+
+if __name__ == "__main__":
+    print(f"json backend: {jsonCodec.BACKEND}")
+    for command, raw in COMMANDS.items():
+        before = run(f"{command} json + key check", key_check, raw)
+        after = run(f"{command} decode + schema", decode, raw)
+        print(f"{'':<44} {before / after:8.2f}x")
@@ -0,0 +1,95 @@
+#
+# Copyright (c) 2023 Matter Cloud Controller Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Compare the CPU cost per command of passing JSON strings through the command
+queue (decode at ingress, encode into the queue, decode again to route) with
+passing MatterCommand objects (decode at ingress, encode once at send).
+
+To Run:
+python3 src/component/mcc-daemon/benchmarks/benchCommandEnvelope.py
+"""
+
+import json
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__)))+'/src')
+from matterCommand import MatterCommand
+
+ITERATIONS = 100000
+
+RAW_COMMAND = json.dumps({
+    "message_id": "12345",
+    "command": "write_attribute",
+    "args": {
+        "endpoint_id": 1,
+        "node_id": 1,
+        "attribute_path": "1/6/0",
+        "value": True
+    }
+})
+
+def message_router(message):
+    return message.get("command") != "call_webhook"
+
+def mqtt_strings():
+    message = json.loads(RAW_COMMAND)   # respond()
+    item = json.dumps(message)          # re-encoded into the queue
+    if message_router(json.loads(item)):  # queueListenTask
+        return item
+
+def rest_strings():
+    message = json.loads(RAW_COMMAND)   # RestHandler
+    message_router(message)             # routed in the handler
+    item = RAW_COMMAND
+    if message_router(json.loads(item)):  # and again in queueListenTask
+        return item
+
+def internal_strings():
+    message = {"message_id": "1", "command": "get_node", "args": {"node_id": 1}}
+    item = json.dumps(message)
+    if message_router(json.loads(item)):
+        return item
+
+def mqtt_envelope():
+    command = MatterCommand.from_json(RAW_COMMAND)
+    command.payload_size                # sized by the queue
+    if message_router(command.message):
+        return command.to_json()
+
+def internal_envelope():
+    command = MatterCommand({"message_id": "1", "command": "get_node", "args": {"node_id": 1}})
+    command.payload_size
+    if message_router(command.message):
+        return command.to_json()
+
+def run(name, function):
+    seconds = min(timeit.repeat(function, number=ITERATIONS, repeat=3))
+    per_command = seconds / ITERATIONS * 1e6
+    print(f"{name:<28} {per_command:8.3f} us/command")
+    return per_command
+
+if __name__ == "__main__":
+    mqtt_before = run("mqtt json strings", mqtt_strings)
+    rest_before = run("rest json strings", rest_strings)
+    internal_before = run("internal json strings", internal_strings)
+    mqtt_after = run("mqtt MatterCommand", mqtt_envelope)
+    internal_after = run("internal MatterCommand", internal_envelope)
+    print(f"mqtt saved     {mqtt_before - mqtt_after:8.3f} us/command")
+    print(f"rest saved     {rest_before - mqtt_after:8.3f} us/command")
+    print(f"internal saved {internal_before - internal_after:8.3f} us/command")
@@ -0,0 +1,105 @@
+#
+# Copyright (c) 2023 Matter Cloud Controller Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Compare the standard library json with orjson on the JSON work the daemon
+does for a node dump: decoding a get_nodes reply from the websocket and
+encoding the shadow documents of its endpoints as bytes for the IPC.
+
+The node dump is read from a JSON file of get_node results when one is given
+(e.g. a capture of the python matter server's reply saved the way
+sample_data.json is written), otherwise a node of a similar size is made up.
+
+To Run:
+python3 src/component/mcc-daemon/benchmarks/benchJsonCodec.py [node_dump.json]
+"""
+
+import json
+import sys
+import timeit
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ITERATIONS = 200
+
+def make_node(node_id):
+    #A node of about 28 KB, most of it on endpoint 0 like a real root node,
+    #with a few device endpoints and the global attribute lists
+    attributes = {}
+    for endpoint in range(4):
+        clusters = [29, 31, 40, 48, 49, 51, 60, 62, 63] if endpoint == 0 else [3, 4, 6, 8, 29, 768]
+        for cluster in clusters:
+            for attribute in range(40 if endpoint == 0 else 12):
+                attributes[f"{endpoint}/{cluster}/{attribute}"] = {
+                    0: "Vendor Name %d" % attribute,
+                    1: attribute * 1000,
+                    2: [attribute, attribute + 1, attribute + 2],
+                    3: {"fabricIndex": 1, "label": "fabric", "nodeID": node_id},
+                }[attribute % 4]
+            if cluster == 62:
+                attributes[f"{endpoint}/{cluster}/0"] = [{"noc": "A" * 800, "icac": "B" * 800, "fabricIndex": fabric} for fabric in range(3)]
+            for attribute in (65528, 65529, 65531, 65532, 65533):
+                attributes[f"{endpoint}/{cluster}/{attribute}"] = list(range(attribute % 7 + 3))
+    return {
+        "node_id": node_id,
+        "date_commissioned": "2023-06-01T10:00:00",
+        "last_interview": "2023-06-01T10:00:00",
+        "interview_version": 2,
+        "available": True,
+        "attributes": attributes
+    }
+
+def load_nodes():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as f:
+            nodes = json.load(f)
+        return nodes if isinstance(nodes, list) else [nodes]
+    return [make_node(1)]
+
+def endpoint_documents(node):
+    documents = {}
+    for attribute_path, value in node["attributes"].items():
+        documents.setdefault(attribute_path.split('/')[0], {})[attribute_path] = value
+    return [{"state": {"reported": reported}} for reported in documents.values()]
+
+def run(name, function):
+    seconds = min(timeit.repeat(function, number=ITERATIONS, repeat=3))
+    per_call = seconds / ITERATIONS * 1e6
+    print(f"{name:<36} {per_call:10.1f} us")
+    return per_call
+
+if __name__ == "__main__":
+    nodes = load_nodes()
+    reply = json.dumps({"message_id": "1", "result": nodes})
+    documents = [document for node in nodes for document in endpoint_documents(node)]
+    print(f"node dump {len(reply)} bytes, {len(documents)} endpoint documents")
+
+    stdlib_decode = run("json.loads reply", lambda: json.loads(reply))
+    stdlib_encode = run("json.dumps documents to bytes",
+                        lambda: [bytes(json.dumps(document), "utf-8") for document in documents])
+
+    if orjson is None:
+        print("orjson is not installed, only the standard library was measured")
+        sys.exit(0)
+
+    orjson_decode = run("orjson.loads reply", lambda: orjson.loads(reply))
+    orjson_encode = run("orjson.dumps documents",
+                        lambda: [orjson.dumps(document, option=orjson.OPT_NON_STR_KEYS) for document in documents])
+    print(f"decode speedup {stdlib_decode / orjson_decode:6.1f}x")
+    print(f"encode speedup {stdlib_encode / orjson_encode:6.1f}x")
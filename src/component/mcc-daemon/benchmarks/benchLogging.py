@@ -0,0 +1,82 @@
+#
+# Copyright (c) 2023 Matter Cloud Controller Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Compare the cost to the calling thread of the daemon's logging before and
+after logger.py, for a call that is written and for a hot call site that is
+over its rate limit or below the log level:
+ - before, lPrint formatted the message (and often a JSON dump of the whole
+   command) up front and logging.info wrote it to the stream in the caller
+ - after, the call is checked against the level and the call site's rate
+   limit and the record is formatted and written by the listener thread
+
+The stream is /dev/null so only the CPU of logging is measured.
+
+To Run:
+python3 src/component/mcc-daemon/benchmarks/benchLogging.py
+"""
+
+import json
+import logging
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__)))+'/src')
+import logger
+
+ITERATIONS = 20000
+
+MESSAGE = {
+    "message_id": "12345",
+    "command": "write_attributes",
+    "args": {"endpoint_id": 1, "node_id": 1, "attributes": {f"1/6/{attribute}": attribute for attribute in range(20)}}
+}
+
+def before():
+    logging.info("adding message_object to queue")
+    logging.info(json.dumps(MESSAGE))
+
+def after():
+    logger.info("queueing write_attributes", message_id=MESSAGE["message_id"], node_id=1, endpoint_id=1, attributes=20)
+    logger.payload("write_attributes", MESSAGE)
+
+def after_debug():
+    logger.debug("queueing write_attributes", message_id=MESSAGE["message_id"], node_id=1, endpoint_id=1, attributes=20)
+
+def run(name, function):
+    seconds = min(timeit.repeat(function, number=ITERATIONS, repeat=3))
+    per_call = seconds / ITERATIONS * 1e6
+    print(f"{name:<36} {per_call:8.3f} us/call", file=sys.__stdout__)
+    return per_call
+
+if __name__ == "__main__":
+    devnull = open(os.devnull, "w")
+    sys.stdout = devnull
+    logging.basicConfig(stream=devnull, level=logging.INFO)
+    eager = run("eager lPrint with payload", before)
+
+    logger.setup("info", rate=0)
+    unlimited = run("queued, not rate limited", after)
+    logger.shutdown()
+    logger.setup("info", rate=10, burst=20)
+    limited = run("queued, rate limited hot call site", after)
+    below_level = run("below the log level", after_debug)
+    logger.shutdown()
+
+    sys.stdout = sys.__stdout__
+    print(f"hot call site speedup {eager / limited:6.1f}x")
@@ -1,28 +1,353 @@
 import asyncio
 import sys 
-import json
+import jsonCodec
+import time
+import collections
 import aiohttp
+import logger
+from matterCommand import MatterCommand, CommandError
 
+#Lanes used to schedule the commands sent to the python matter server
+LANE_INTERACTIVE = "interactive"  # user commands from MQTT, REST and the test file
+LANE_CONTROL = "control"          # attribute writes generated from shadow deltas
+LANE_BACKGROUND = "background"    # node refreshes and subscriptions
+LANE_WEBHOOK = "webhook"          # local webhook notifications
+DEFAULT_LANE_WEIGHTS = "interactive:8,control:4,background:2,webhook:1"
+
+
+def payload_size(item):
+    # Approximate the memory held by a queued payload. Containers are walked
+    # so that dict based commands are accounted for as well as JSON strings
+    if hasattr(item, "payload_size"):
+        return item.payload_size
+    if isinstance(item, (str, bytes, bytearray)):
+        return sys.getsizeof(item)
+    size = sys.getsizeof(item)
+    if isinstance(item, dict):
+        for key, value in item.items():
+            size += payload_size(key) + payload_size(value)
+    elif isinstance(item, (list, tuple, set)):
+        for value in item:
+            size += payload_size(value)
+    return size
 
 class MemQueue(asyncio.Queue):
+    #A queue that is bounded by both the number of items and the bytes held.
+    #put() waits while either budget is exhausted and get() returns (item_size, item)
     def __init__(self, maxsize=0, maxmemsize=0,refresh_interval=1.0, refresh_timeout=60):
         super().__init__(maxsize)
         self.maxmemsize = maxmemsize
         self.refresh_interval = refresh_interval
         self.refresh_timeout = refresh_timeout
+        self.memsize = 0
+        self.max_memsize_seen = 0
+        self.max_depth_seen = 0
+        self.blocked_puts = 0
+
+    def full(self):
+        if super().full():
+            return True
+        # the budget is checked before an item is added so a single item
+        # larger than the budget can still get through an empty queue
+        return self.maxmemsize > 0 and self.memsize >= self.maxmemsize
 
     async def put(self, item):
-        item_size = sys.getsizeof(item)
+        if self.full():
+            self.blocked_puts += 1
+        await super().put(item)
+
+    # These are the hooks called by asyncio.Queue so the accounting is kept
+    # in step with the items actually held in the queue
+    def _put(self, item):
+        item_size = payload_size(item)
+        self._queue.append((item_size, item))
+        self.memsize += item_size
+        self.max_memsize_seen = max(self.max_memsize_seen, self.memsize)
+        self.max_depth_seen = max(self.max_depth_seen, len(self._queue))
+
+    def _get(self):
+        item_size, item = self._queue.popleft()
+        self.memsize -= item_size
+        return item_size, item
+
+    def stats(self):
+        return {
+            "depth": self.qsize(),
+            "maxsize": self.maxsize,
+            "bytes": self.memsize,
+            "maxmemsize": self.maxmemsize,
+            "max_depth_seen": self.max_depth_seen,
+            "max_bytes_seen": self.max_memsize_seen,
+            "blocked_puts": self.blocked_puts
+        }
+
+def parse_lane_weights(lane_weights):
+    #Parse a "lane:weight,lane:weight" string into an ordered dict of weights
+    weights = {}
+    for lane_weight in lane_weights.split(","):
+        if lane_weight.strip() == "":
+            continue
+        lane, weight = lane_weight.split(":")
+        weights[lane.strip()] = max(1, int(weight))
+    if not weights:
+        raise ValueError("At least one lane must be configured")
+    return weights
+
+class LaneStats:
+    #Keeps the recent queue wait times of one lane so percentiles can be reported
+    def __init__(self, samples=1024):
+        self.waits = collections.deque(maxlen=samples)
+        self.count = 0
+
+    def record(self, wait):
+        self.waits.append(wait)
+        self.count += 1
+
+    def percentile(self, pct):
+        if not self.waits:
+            return 0.0
+        ordered = sorted(self.waits)
+        index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def stats(self):
+        return {
+            "dequeued": self.count,
+            "wait_p50_ms": round(self.percentile(50) * 1000, 3),
+            "wait_p99_ms": round(self.percentile(99) * 1000, 3),
+            "wait_max_ms": round(max(self.waits, default=0.0) * 1000, 3)
+        }
+
+class _LaneEntry:
+    __slots__ = ("lane", "item", "enqueued_at")
+
+    def __init__(self, lane, item):
+        self.lane = lane
+        self.item = item
+        self.enqueued_at = time.monotonic()
+
+    @property
+    def payload_size(self):
+        return payload_size(self.item)
+
+class _Lanes:
+    #Stands in for the deque of asyncio.Queue. Items are appended to their lane
+    #and popleft() picks the next lane using smooth weighted round robin so
+    #every non empty lane gets a share of the sends in proportion to its weight
+    def __init__(self, lane_weights):
+        self.weights = lane_weights
+        self.lanes = {lane: collections.deque() for lane in lane_weights}
+        self.current = {lane: 0 for lane in lane_weights}
+        self.bytes = {lane: 0 for lane in lane_weights}
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        return self.length > 0
+
+    def append(self, sized_entry):
+        item_size, entry = sized_entry
+        self.lanes[entry.lane].append(sized_entry)
+        self.bytes[entry.lane] += item_size
+        self.length += 1
+
+    def popleft(self):
+        if self.length == 0:
+            raise IndexError("pop from an empty queue")
+        total = 0
+        chosen = None
+        for lane, entries in self.lanes.items():
+            if not entries:
+                continue
+            self.current[lane] += self.weights[lane]
+            total += self.weights[lane]
+            if chosen is None or self.current[lane] > self.current[chosen]:
+                chosen = lane
+        self.current[chosen] -= total
+        item_size, entry = self.lanes[chosen].popleft()
+        self.bytes[chosen] -= item_size
+        self.length -= 1
+        return item_size, entry
+
+class LaneQueue(MemQueue):
+    #A MemQueue split into weighted lanes. Each item is put on a lane and the
+    #time it spends waiting in the queue is recorded per lane
+    def __init__(self, maxsize=0, maxmemsize=0, lane_weights=None, default_lane=LANE_INTERACTIVE):
+        if lane_weights is None:
+            lane_weights = parse_lane_weights(DEFAULT_LANE_WEIGHTS)
+        self.lane_weights = dict(lane_weights)
+        self.default_lane = default_lane if default_lane in self.lane_weights else next(iter(self.lane_weights))
+        self.lane_stats = {lane: LaneStats() for lane in self.lane_weights}
+        super().__init__(maxsize, maxmemsize)
+
+    def _init(self, maxsize):
+        self._queue = _Lanes(self.lane_weights)
+
+    def _entry(self, item, lane):
+        if isinstance(item, _LaneEntry):
+            return item
+        if lane not in self.lane_weights:
+            lane = self.default_lane
+        return _LaneEntry(lane, item)
 
-    	# specific locking code (see original class in GitHub)
-        super().put_nowait((item_size, item))
+    async def put(self, item, lane=None):
+        await super().put(self._entry(item, lane))
 
-    def put_nowait(self, item):
-        item_size = sys.getsizeof(item)
-        
-        if self.full(item_size):
-            raise asyncio.QueueFull
-        super().put_nowait((item_size, item))
+    def put_nowait(self, item, lane=None):
+        super().put_nowait(self._entry(item, lane))
+
+    def _get(self):
+        item_size, entry = super()._get()
+        self.lane_stats[entry.lane].record(time.monotonic() - entry.enqueued_at)
+        return item_size, entry.item
+
+    def stats(self):
+        result = super().stats()
+        result["lanes"] = {}
+        for lane, weight in self.lane_weights.items():
+            lane_result = {
+                "weight": weight,
+                "depth": len(self._queue.lanes[lane]),
+                "bytes": self._queue.bytes[lane]
+            }
+            lane_result.update(self.lane_stats[lane].stats())
+            result["lanes"][lane] = lane_result
+        return result
+
+class QueueFeeder:
+    #Puts items on a queue without ever waiting, for producers that have to
+    #keep running while the queue is full such as the websocket reader, which
+    #frees the in-flight window by reading the replies. Items that do not fit
+    #wait in an overflow that a task feeds into the queue as it drains. Items
+    #with the same key are coalesced so the overflow holds one per key (e.g.
+    #one resync per node), past max_pending items are dropped
+    def __init__(self, queue, max_pending=256):
+        self.queue = queue
+        self.max_pending = max_pending
+        self.pending = collections.OrderedDict()  # key -> (item, lane)
+        self._task = None
+        self._next_key = 0
+        self.queued = 0
+        self.overflowed = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def put(self, item, lane=None, key=None):
+        #Returns False if the item had to be dropped
+        if not self.pending:
+            try:
+                self.queue.put_nowait(item, lane)
+                self.queued += 1
+                return True
+            except asyncio.QueueFull:
+                pass
+
+        if key is None:
+            key = self._next_key # not coalesced
+            self._next_key += 1
+        elif key in self.pending:
+            self.pending[key] = (item, lane)
+            self.coalesced += 1
+            return True
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            logger.warning("Queue overflow is full, dropping command", key=key, lane=lane)
+            return False
+
+        self.pending[key] = (item, lane)
+        self.overflowed += 1
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._feed())
+        return True
+
+    async def _feed(self):
+        while self.pending:
+            key, (item, lane) = self.pending.popitem(last=False)
+            await self.queue.put(item, lane)
+            self.queued += 1
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "queued": self.queued,
+            "overflowed": self.overflowed,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped
+        }
+
+class AimdPacer:
+    #Paces the commands sent to the python matter server. The send rate grows
+    #additively while replies come back within the target latency and is cut
+    #multiplicatively on slow replies or error_code responses
+    def __init__(self, rate=20.0, min_rate=1.0, max_rate=200.0, increase=1.0, decrease=0.5, target_latency=1.0, max_pending=1024):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate = min(max(rate, min_rate), max_rate)
+        self.increase = increase
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.max_pending = max_pending
+        self._next_send = 0.0
+        self._last_decrease = 0.0
+        self._sent = collections.OrderedDict() # message_id -> time the message was sent
+        self.replies = 0
+        self.errors = 0
+        self.slow_replies = 0
+        self.last_latency = 0.0
+
+    async def wait(self):
+        #Wait for the next send slot at the current rate
+        now = time.monotonic()
+        if self._next_send > now:
+            await asyncio.sleep(self._next_send - now)
+            now = time.monotonic()
+        self._next_send = max(now, self._next_send) + 1.0 / self.rate
+
+    def on_send(self, message_id):
+        if message_id is None:
+            return
+        self._sent[message_id] = time.monotonic()
+        while len(self._sent) > self.max_pending:
+            self._sent.popitem(last=False)
+
+    def on_reply(self, message_id, error=False):
+        sent_at = self._sent.pop(message_id, None)
+        if error:
+            self.errors += 1
+            self._back_off()
+            return
+        if sent_at is None:
+            return # not a message we paced
+        self.replies += 1
+        self.last_latency = time.monotonic() - sent_at
+        if self.last_latency > self.target_latency:
+            self.slow_replies += 1
+            self._back_off()
+        else:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def _back_off(self):
+        #Only cut the rate once per target latency period so a burst of
+        #late replies to the same window does not collapse the rate
+        now = time.monotonic()
+        if now - self._last_decrease < self.target_latency:
+            return
+        self._last_decrease = now
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+
+    def stats(self):
+        return {
+            "rate": round(self.rate, 3),
+            "min_rate": self.min_rate,
+            "max_rate": self.max_rate,
+            "pending": len(self._sent),
+            "replies": self.replies,
+            "errors": self.errors,
+            "slow_replies": self.slow_replies,
+            "last_latency_ms": round(self.last_latency * 1000, 3)
+        }
 
 class CancellableSleeps:
     def __init__(self):
@@ -55,11 +380,11 @@ class TestFileHandler:
     def loadTestData(self, file_name: str):
         with open(file_name) as f:
             try:
-                sample = json.load(f)
+                sample = jsonCodec.loads(f.read())
                 f.close()
                 return sample
             except:
-                return json.loads('''{}''')
+                return {}
 
     def clearTestData(self, file_name: str):
         file = open(file_name,"r+")
@@ -73,30 +398,90 @@ class TestFileHandler:
 
     async def pollForCommand(self, file_name: str, queue: MemQueue):
         sample = self.loadAndCleanTestData(file_name)
-        nodeId = None
+        if not sample:
+            return
         try:
-            command = sample["command"]
-            # add to the queue
-            message_object = json.dumps(sample)
-
-            # add to the queue
-            await queue.put(message_object)
+            command = MatterCommand.from_message(sample)
+        except CommandError as e:
+            logger.warning("Ignoring the command file", file=file_name, response=e.response)
+            return
 
-        except:
-            pass
+        # add to the queue
+        await queue.put(command)
 
 class WebhookHandler:
+    #Sends the webhooks to the local host. One session is kept per webhook
+    #base URL so the connections are reused (keep-alive) instead of a new
+    #session and connection for every webhook, with at most `limit`
+    #connections per base URL and every request bounded by `timeout` seconds.
+    #Webhooks are fire and forget so failures are counted and logged, not raised
+    def __init__(self, limit=4, timeout=10.0, keepalive=30.0):
+        self.limit = limit
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.keepalive = keepalive
+        self.sessions = {}  # base url -> aiohttp.ClientSession
+        self.targets = {}  # base url -> counters
+
+    def _session(self, webhook_url):
+        session = self.sessions.get(webhook_url)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=self.keepalive)
+            session = aiohttp.ClientSession(webhook_url, connector=connector, timeout=self.timeout)
+            self.sessions[webhook_url] = session
+        return session
+
     async def sendWebhook(self, webhook_method, webhook_url, webhook_endpoint, data, headers):
-        print(webhook_method)
-        print(webhook_url)
-        print(webhook_endpoint)
-        
-        async with aiohttp.ClientSession(webhook_url) as session:
-            if webhook_method == "POST":
-                async with session.post('/'+webhook_endpoint, data=data, headers=headers) as r:
-                    text = await r.text()
-            elif webhook_method == "GET":
-                async with session.get('/'+webhook_endpoint, headers=headers) as r:
-                    text = await r.text()
+        #Returns the status of the response or None if the webhook failed
+        target = self.targets.setdefault(webhook_url, {
+            "requests": 0, "responses": 0, "errors": 0, "timeouts": 0, "last_status": None,
+            "latency_total": 0.0, "latency_max": 0.0
+        })
+        target["requests"] += 1
+        start = time.monotonic()
+        try:
+            session = self._session(webhook_url)
+            async with session.request(webhook_method, '/'+webhook_endpoint, data=data if webhook_method == "POST" else None,
+                                       headers=headers) as r:
+                await r.read()
+                status = r.status
+        except asyncio.TimeoutError:
+            target["timeouts"] += 1
+            logger.warning("webhook timed out", method=webhook_method, url=webhook_url, endpoint=webhook_endpoint)
+            return None
+        except aiohttp.ClientError as e:
+            target["errors"] += 1
+            logger.warning("webhook failed", method=webhook_method, url=webhook_url, endpoint=webhook_endpoint, error=e)
+            return None
 
+        latency = time.monotonic() - start
+        target["responses"] += 1
+        target["latency_total"] += latency
+        target["latency_max"] = max(target["latency_max"], latency)
+        target["last_status"] = status
+        if status >= 400:
+            target["errors"] += 1
+        return status
+
+    async def close(self):
+        #Close the sessions and their connections, used on shutdown
+        sessions = list(self.sessions.values())
+        self.sessions = {}
+        for session in sessions:
             await session.close()
+
+    def stats(self):
+        return {
+            "sessions": len(self.sessions),
+            "targets": {
+                webhook_url: {
+                    "requests": target["requests"],
+                    "responses": target["responses"],
+                    "errors": target["errors"],
+                    "timeouts": target["timeouts"],
+                    "last_status": target["last_status"],
+                    "latency_avg": target["latency_total"] / max(target["responses"], 1),
+                    "latency_max": target["latency_max"]
+                }
+                for webhook_url, target in self.targets.items()
+            }
+        }
@@ -0,0 +1,109 @@
+#
+# Copyright (c) 2023 Matter Cloud Controller Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+
+import jsonCodec
+
+NOT_INCLUDED = "(not included)"
+
+
+class PathRule:
+    #One "endpoint/cluster/attribute" rule, each part is a number, a range
+    #of numbers such as 65528-65533 or * for any
+    def __init__(self, rule):
+        self.rule = rule
+        parts = rule.split('/')
+        if len(parts) != 3:
+            raise ValueError(f"Projection rule {rule!r} is not endpoint/cluster/attribute")
+        self.parts = [self._parse_part(part) for part in parts]
+
+    @staticmethod
+    def _parse_part(part):
+        if part == '*':
+            return None
+        if '-' in part:
+            low, high = part.split('-', 1)
+            return int(low), int(high)
+        return int(part), int(part)
+
+    def matches(self, ids):
+        for bounds, value in zip(self.parts, ids):
+            if bounds is not None and not bounds[0] <= value <= bounds[1]:
+                return False
+        return True
+
+
+class AttributeProjection:
+    #Decides which attributes are mirrored into the shadows. An attribute is
+    #kept when it matches an include rule and none of the exclude rules, the
+    #default is to include everything. The config is a JSON file such as
+    #  {"include": ["*/*/*"], "exclude": ["*/*/65528-65533", "0/62/*"]}
+    #The bytes of the attributes left out are counted per rule.
+    def __init__(self, include=None, exclude=None):
+        self.include = [PathRule(rule) for rule in (include if include is not None else ["*/*/*"])]
+        self.exclude = [PathRule(rule) for rule in (exclude or [])]
+        self._decisions = {}  # attribute_path -> None if kept or the rule that drops it
+        self.kept = 0
+        self.dropped = {}  # rule -> attributes dropped
+        self.bytes_saved = {}  # rule -> bytes of the attributes dropped
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as config_file:
+            config = json.load(config_file)
+        return cls(config.get("include"), config.get("exclude"))
+
+    def _decide(self, attribute_path):
+        ids = [int(part) for part in attribute_path.split('/')]
+        if not any(rule.matches(ids) for rule in self.include):
+            return NOT_INCLUDED
+        for rule in self.exclude:
+            if rule.matches(ids):
+                return rule.rule
+        return None
+
+    def dropped_by(self, attribute_path):
+        #The rule that leaves an attribute out, or None if it is kept
+        if attribute_path not in self._decisions:
+            self._decisions[attribute_path] = self._decide(attribute_path)
+        return self._decisions[attribute_path]
+
+    def allows(self, attribute_path, value=None):
+        #Check one attribute, e.g. from an attribute_updated event
+        rule = self.dropped_by(attribute_path)
+        if rule is None:
+            self.kept += 1
+            return True
+        self._count(rule, attribute_path, value)
+        return False
+
+    def project(self, attributes):
+        #Returns the attributes that are kept
+        return {attribute_path: value for attribute_path, value in attributes.items() if self.allows(attribute_path, value)}
+
+    def _count(self, rule, attribute_path, value):
+        self.dropped[rule] = self.dropped.get(rule, 0) + 1
+        self.bytes_saved[rule] = self.bytes_saved.get(rule, 0) + len(jsonCodec.dumpb(attribute_path)) + len(jsonCodec.dumpb(value)) + 2
+
+    def stats(self):
+        return {
+            "kept": self.kept,
+            "rules": {
+                rule: {"dropped": self.dropped[rule], "bytes_saved": self.bytes_saved[rule]}
+                for rule in self.dropped
+            },
+            "bytes_saved": sum(self.bytes_saved.values())
+        }
@@ -0,0 +1,256 @@
+#
+# Copyright (c) 2023 Matter Cloud Controller Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import asyncio
+import bisect
+import logging
+import mmap
+import os
+import time
+
+import jsonCodec
+
+SEGMENT_PREFIX = "events-"
+SEGMENT_SUFFIX = ".jnl"
+
+
+def eventNodeId(message):
+    #The node an event from the python matter server is about, or None
+    data = message.get("data")
+    if isinstance(data, dict):
+        return data.get("node_id")
+    if isinstance(data, list) and data and isinstance(data[0], int):
+        return data[0] # attribute_updated is [node_id, attribute_path, value]
+    if isinstance(data, int):
+        return data # node_removed
+    return None
+
+
+class JournalIndex:
+    #Time ordered locations of the records of one node (or of all nodes)
+    def __init__(self):
+        self.times = []
+        self.locations = []  # (segment_id, offset, length)
+
+    def add(self, timestamp, location):
+        self.times.append(timestamp)
+        self.locations.append(location)
+
+    def drop_segment(self, segment_id):
+        #Segments are dropped oldest first so their records are at the front
+        count = 0
+        while count < len(self.locations) and self.locations[count][0] == segment_id:
+            count += 1
+        del self.times[:count]
+        del self.locations[:count]
+
+    def range(self, start, end):
+        first = 0 if start is None else bisect.bisect_left(self.times, start)
+        last = len(self.times) if end is None else bisect.bisect_right(self.times, end)
+        return first, last
+
+
+class EventJournal:
+    #Append only journal of every event of the python matter server, kept in
+    #numbered segment files of JSON lines in `directory`. A new segment is
+    #started once the current one is over segment_size bytes and only the
+    #newest max_segments segments are kept. Records are found through an in
+    #memory index per node and time that is rebuilt from the segments at
+    #startup, and are read back through memory maps of the segments.
+    #Appends are buffered and flushed once flush_size bytes are waiting or
+    #flush_interval seconds after the first waiting append, so a burst of
+    #events costs one write. Without a running event loop every append is
+    #flushed straight away.
+    def __init__(self, directory, segment_size=4 * 1024 * 1024, max_segments=8, flush_interval=1.0, flush_size=64 * 1024):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.segments = []  # segment ids, oldest first
+        self.all_events = JournalIndex()
+        self.node_indexes = {}  # node_id -> JournalIndex
+        self._maps = {}  # segment_id -> (size, mmap)
+        self._file = None
+        self._last_time = 0.0
+        self._pending = 0  # bytes appended since the last flush
+        self._flush_timer = None
+        self.appended = 0
+        self.bytes_written = 0
+        self.queries = 0
+        self.segments_dropped = 0
+        self.truncated = 0
+        self.flushes = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _segment_path(self, segment_id):
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{segment_id:08d}{SEGMENT_SUFFIX}")
+
+    def _load(self):
+        #Rebuild the index from the segments left by a previous run
+        for name in sorted(os.listdir(self.directory)):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                segment_id = int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+                self.segments.append(segment_id)
+                with open(self._segment_path(segment_id), "r+b") as segment:
+                    offset = 0
+                    for line in segment:
+                        try:
+                            if not line.endswith(b"\n"):
+                                raise ValueError("no end of line")
+                            record = jsonCodec.loads(line)
+                        except ValueError:
+                            break # a partly written last record
+                        self._index(record["t"], record["n"], (segment_id, offset, len(line)))
+                        offset += len(line)
+                    #Cut off a partly written record so the next records are
+                    #not appended to it
+                    if offset < os.path.getsize(self._segment_path(segment_id)):
+                        logging.warning("Truncating journal segment %s at %d bytes", segment_id, offset)
+                        segment.truncate(offset)
+                        self.truncated += 1
+
+        if not self.segments:
+            self.segments.append(1)
+        self._file = open(self._segment_path(self.segments[-1]), "ab")
+
+    def _index(self, timestamp, node_id, location):
+        self._last_time = max(self._last_time, timestamp)
+        self.all_events.add(timestamp, location)
+        if node_id is not None:
+            self.node_indexes.setdefault(node_id, JournalIndex()).add(timestamp, location)
+
+    def append(self, message):
+        #Append an event message and return its record
+        timestamp = max(time.time(), self._last_time + 1e-6) # unique and in order for the index
+        node_id = eventNodeId(message)
+        record = {"t": timestamp, "n": node_id, "e": message.get("event"), "m": message}
+        line = jsonCodec.dumpb(record) + b"\n"
+
+        if self._file.tell() >= self.segment_size:
+            self._rotate()
+        offset = self._file.tell()
+        self._file.write(line)
+        self._pending += len(line)
+
+        self._index(timestamp, node_id, (self.segments[-1], offset, len(line)))
+        self.appended += 1
+        self.bytes_written += len(line)
+        self._schedule_flush()
+        return record
+
+    def _schedule_flush(self):
+        if self._pending >= self.flush_size:
+            self.flush()
+            return
+        if self._flush_timer is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        self._flush_timer = loop.call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        #Write out the buffered appends
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        if self._pending:
+            self._file.flush()
+            self._pending = 0
+            self.flushes += 1
+
+    def _rotate(self):
+        self.flush()
+        self._file.close()
+        self.segments.append(self.segments[-1] + 1)
+        self._file = open(self._segment_path(self.segments[-1]), "ab")
+
+        while len(self.segments) > self.max_segments:
+            segment_id = self.segments.pop(0)
+            self.all_events.drop_segment(segment_id)
+            for node_id in list(self.node_indexes):
+                self.node_indexes[node_id].drop_segment(segment_id)
+                if not self.node_indexes[node_id].times:
+                    del self.node_indexes[node_id]
+            size_map = self._maps.pop(segment_id, None)
+            if size_map is not None:
+                size_map[1].close()
+            try:
+                os.remove(self._segment_path(segment_id))
+            except OSError:
+                logging.exception("Error removing journal segment %s", segment_id)
+            self.segments_dropped += 1
+
+    def _segment_map(self, segment_id):
+        #Memory map of a segment, remapped when the segment has grown since
+        if segment_id == self.segments[-1]:
+            self.flush()
+        size = os.path.getsize(self._segment_path(segment_id))
+        cached = self._maps.get(segment_id)
+        if cached is not None and cached[0] == size:
+            return cached[1]
+        if cached is not None:
+            cached[1].close()
+        with open(self._segment_path(segment_id), "rb") as segment:
+            segment_map = mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps[segment_id] = (size, segment_map)
+        return segment_map
+
+    def query(self, node_id=None, start=None, end=None, limit=100):
+        #Returns the records between the start and end times (inclusive) for
+        #a node or for all nodes, oldest first, and the time to start the next
+        #query at when there were more than limit records
+        self.queries += 1
+        index = self.all_events if node_id is None else self.node_indexes.get(node_id)
+        if index is None:
+            return [], None
+
+        first, last = index.range(start, end)
+        next_start = None
+        if limit is not None and last - first > limit:
+            next_start = index.times[first + limit]
+            last = first + limit
+
+        records = []
+        for segment_id, offset, length in index.locations[first:last]:
+            segment_map = self._segment_map(segment_id)
+            records.append(jsonCodec.loads(segment_map[offset:offset + length]))
+        return records, next_start
+
+    def close(self):
+        self.flush()
+        for size, segment_map in self._maps.values():
+            segment_map.close()
+        self._maps = {}
+        self._file.close()
+
+    def stats(self):
+        return {
+            "segments": len(self.segments),
+            "records": len(self.all_events.times),
+            "nodes": len(self.node_indexes),
+            "appended": self.appended,
+            "bytes_written": self.bytes_written,
+            "queries": self.queries,
+            "segments_dropped": self.segments_dropped,
+            "truncated": self.truncated,
+            "flushes": self.flushes,
+            "pending_bytes": self._pending
+        }
@@ -55,7 +55,6 @@ import time
 import datetime
 import subprocess
 import json
-import traceback
 from rich.console import Console
 import asyncio
 import aiohttp
@@ -63,23 +62,60 @@ import concurrent.futures
 from aiohttp import web, ClientWebSocketResponse
 import json
 from concurrent.futures import ThreadPoolExecutor
-from asyncioUtils import MemQueue, TestFileHandler, CancellableSleeps, WebhookHandler
-import random
+import jsonCodec
+import logger
+from asyncioUtils import LaneQueue, TestFileHandler, CancellableSleeps, WebhookHandler, AimdPacer, QueueFeeder, parse_lane_weights
+from asyncioUtils import LANE_INTERACTIVE, LANE_CONTROL, LANE_BACKGROUND, LANE_WEBHOOK, DEFAULT_LANE_WEIGHTS
 import requests 
 
 from iotRestApiService import RestHandler
+from matterCommand import MatterCommand, CommandError, commandResponse
+from nodeStore import NodeStore, NodeEventLog, endpointOfPath
+from eventJournal import EventJournal
+from attributeProjection import AttributeProjection
+from ipcClient import ManagedIpcClient
+from messageCorrelation import CommandCorrelator, CallbackRegistry, MessageIdGenerator
+from shadowUtils import ShadowFlushScheduler, ShadowFingerprints, ReportedStateTracker, ShadowDocumentCache, ShadowSharder
+from shadowUtils import ShadowSplitter, DEFAULT_STATIC_ATTRIBUTES
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-n", "--name", help="Name of the IOT thing (default: mcc-thing-ver01-1)", action="store", default="mcc-thing-ver01-1")
 parser.add_argument("-t", "--test", help="true if testing local", action="store", default="False")
 parser.add_argument("-m", "--monitor", help="monitor and trace the loops", action="store", default="False")
-parser.add_argument("-e", "--maxevents", help="number of matter events logged per device", action="store", default=100)
+parser.add_argument("-e", "--maxevents", help="number of matter events logged per device", action="store", type=int, default=100)
 parser.add_argument("-c", "--clean", help="true to clean working directory", action="store", default="False")
 parser.add_argument("-s", "--stop", help="true to stop at first resolve fail", action="store", default="False")
 parser.add_argument("-p", "--pythonserverpath", help="provide path to auto start the python matter server if not already started", action="store", default="/home/ggc_user/python-matter-server/")
 parser.add_argument("-l", "--local", help="true to notify local host of shadow changes", action="store", default="False")
 parser.add_argument("-w", "--webhook", help="the webhook for the local host", action="store", default="http://localhost:8911/")
 parser.add_argument("-g", "--graphql", help="the GraphQL endpoint for the local host (e.g. .netlify/functions/)", action="store", default="")
+parser.add_argument("--lanes", help=f"weights of the command queue lanes (default: {DEFAULT_LANE_WEIGHTS})", action="store", default=DEFAULT_LANE_WEIGHTS)
+parser.add_argument("--pace-rate", type=float, default=20.0, help="initial rate (messages/s) of commands sent to the matter server, default=20")
+parser.add_argument("--pace-min-rate", type=float, default=1.0, help="lowest rate the pacing backs off to, default=1")
+parser.add_argument("--pace-max-rate", type=float, default=200.0, help="highest rate the pacing increases to, default=200")
+parser.add_argument("--pace-increase", type=float, default=1.0, help="rate added for every timely reply, default=1")
+parser.add_argument("--pace-decrease", type=float, default=0.5, help="factor the rate is multiplied by on a slow or error reply, default=0.5")
+parser.add_argument("--pace-target-latency", type=float, default=1.0, help="reply latency (s) above which the pacing backs off, default=1")
+parser.add_argument("--inflight", type=int, default=8, help="number of commands that can be waiting for a reply from the matter server, default=8")
+parser.add_argument("--command-timeout", type=float, default=30.0, help="seconds to wait for the reply to a matter server command, default=30")
+parser.add_argument("--shadow-debounce", type=float, default=0.5, help="seconds without changes before dirty node shadows are written, default=0.5")
+parser.add_argument("--shadow-max-staleness", type=float, default=2.0, help="maximum seconds a node shadow change waits before it is written, default=2")
+parser.add_argument("--projection", type=str, default=None, help="JSON file of the include and exclude rules for the attributes mirrored into the shadows, relative paths are from the daemon directory (see attributeProjection.json), default=all attributes")
+parser.add_argument("--shadow-split", type=str, default="off", choices=["off", "config", "learn"], help="put the attributes that rarely change in a <node>_<ep>_static shadow, config uses --static-attributes and learn treats the attributes not seen to change as static, default=off")
+parser.add_argument("--static-attributes", type=str, default=DEFAULT_STATIC_ATTRIBUTES, help="comma separated endpoint/cluster/attribute rules of the static attributes for --shadow-split config, default="+DEFAULT_STATIC_ATTRIBUTES)
+parser.add_argument("--shadow-split-state", type=str, default="shadowSplit.json", help="file the attributes learned to change are kept in for --shadow-split learn, default=shadowSplit.json")
+parser.add_argument("--shadow-shard-size", type=int, default=28672, help="bytes above which the shadow of an endpoint is split into shards, must be below the shadowDocumentSizeLimitBytes of the shadow manager, default=28672")
+parser.add_argument("--events-flush-interval", type=float, default=2.0, help="seconds after a new event that the events shadow of the node is written, default=2")
+parser.add_argument("--events-flush-count", type=int, default=20, help="number of new events that makes the events shadows be written straight away, default=20")
+parser.add_argument("--journal-dir", type=str, default="journal", help="directory of the local journal of matter server events, default=journal")
+parser.add_argument("--journal-segment-size", type=int, default=4*1024*1024, help="bytes after which a new journal segment is started, default=4194304")
+parser.add_argument("--journal-segments", type=int, default=8, help="number of journal segments kept, default=8")
+parser.add_argument("--journal-flush-interval", type=float, default=1.0, help="seconds that journal appends are buffered before they are written out, default=1.0")
+parser.add_argument("--webhook-connections", type=int, default=4, help="connections kept open to each webhook base URL, default=4")
+parser.add_argument("--webhook-timeout", type=float, default=10.0, help="seconds a webhook request can take, default=10")
+parser.add_argument("--log-rate", type=float, default=10.0, help="records a second each logging call site can write before it is rate limited, 0 to not limit, default=10")
+parser.add_argument("--log-burst", type=int, default=20, help="records a logging call site can write in a burst above --log-rate, default=20")
+parser.add_argument("--log-payloads", help="true to log whole JSON payloads at --log-level debug", action="store", default="False")
 parser.add_argument("--log-level", type=str, default="info", help="Provide logging level. Example --log-level debug, default=info, possible=(critical, error, warning, info, debug)")
 
 #Set up the variables from the arguments (and defaults)
@@ -99,6 +135,7 @@ LOCAL_ARG = args.local
 LOCAL_ARG = LOCAL_ARG.lower() == 'true' # this notifies localhost of changes on port such as "http://localhost:8911/shadowUpdateWebhookLocal/"+thing_name+"/"+str(node_id)
 WEBHOOK_PATH = args.webhook
 WEBHOOK_GRAPHQL_ENDPOINT = args.graphql
+LANE_WEIGHTS = parse_lane_weights(args.lanes)
 
 #Set up the Websocket client details
 HOST='127.0.0.1' 
@@ -106,16 +143,53 @@ PORT=5580
 URL = f'http://{HOST}:{PORT}/ws'
 
 # create the shared queue for sharing inbound messages between webserver and websocket queues
-# queue of 5 MiB max, and 1000 items max
-queue = MemQueue(maxsize=1000, maxmemsize=5*1024*1024)
+# queue of 5 MiB max, and 1000 items max, split into weighted lanes so user
+# commands are not stuck behind background refreshes
+queue = LaneQueue(maxsize=1000, maxmemsize=5*1024*1024, lane_weights=LANE_WEIGHTS, default_lane=LANE_INTERACTIVE)
+# puts the commands made by the websocket reader on the queue without waiting,
+# a reader blocked on a full queue would stop reading the replies that free it
+reader_feeder = QueueFeeder(queue)
+# paces the commands sent to the python matter server based on its reply latency
+pacer = AimdPacer(rate=args.pace_rate, min_rate=args.pace_min_rate, max_rate=args.pace_max_rate,
+                  increase=args.pace_increase, decrease=args.pace_decrease, target_latency=args.pace_target_latency)
+# matches the replies of the matter server to the commands in flight
+correlator = CommandCorrelator(window=args.inflight, timeout=args.command_timeout,
+                               on_timeout=lambda message_id: pacer.on_reply(message_id, error=True))
 sleeps = CancellableSleeps()
-shadow_subscriptions = []
+# in memory mirror of the node attributes kept up to date from attribute_updated events
+node_store = NodeStore()
+# the attributes that are mirrored into the shadows
+if args.projection is not None:
+    attribute_projection = AttributeProjection.from_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), args.projection))
+else:
+    attribute_projection = AttributeProjection()
+# the latest events of each node that are written to the events_<node> shadows
+node_events = NodeEventLog(maxevents=MAX_EVENTS)
+# every event of the matter server with its full payload, queried through the REST API
+event_journal = None # opened in main()
+# fingerprints of the last document written per shadow so no-op writes are skipped
+shadow_fingerprints = ShadowFingerprints()
+# the shadow documents as last read or written by us
+shadow_cache = ShadowDocumentCache()
+# splits the endpoint shadows that would be over the shadow document size limit
+shadow_sharder = ShadowSharder(max_size=args.shadow_shard_size)
+# splits the endpoint shadows into live and static shadows
+shadow_splitter = ShadowSplitter(mode=args.shadow_split, static_rules=args.static_attributes.split(','),
+                                 state_file=args.shadow_split_state)
+# last reported state written per node shadow so only the changed keys are sent
+reported_states = ReportedStateTracker()
+shadow_subscriptions = [] # the shadow topic filters we have subscribed to
 
 # create a semaphore to prevent multiple calls to webhook
 semaphore = asyncio.Semaphore(2)
+# sends the webhooks over one pooled session per webhook base URL
+webhooks = WebhookHandler(limit=args.webhook_connections, timeout=args.webhook_timeout)
 
-# holds a list of dicts holding a callback function per message id
-callbacks_per_message_id = {}
+# holds the callback function per message id waiting for a reply
+callbacks_per_message_id = CallbackRegistry(maxsize=1024, ttl=120)
+
+# generates the message ids of the commands created by the daemon
+next_message_id = MessageIdGenerator()
 
 curr_dir = os.path.abspath(os.path.dirname(__file__))
 sys.path.append(curr_dir)
@@ -130,29 +204,26 @@ MATTER_SERVER_STARTUP_BACKOFF_TIMER = 20
 RESPONSE_FORMAT = "json"
 TIMEOUT = 5
 MSG_TIMEOUT = f"Command timed out, limit of {TIMEOUT} seconds"
-MSG_MISSING_ATTRIBUTE = "The attributes 'message_id' and/or 'command' missing from request"
-MSG_INVALID_JSON = "Request message was not a valid JSON object"
+MSG_QUEUE_FULL = "The command queue is full, the command was dropped"
 
 # Set up request topic and response topic from passed in arguments
 REQUEST_TOPIC = "chip/request"
 RESPONSE_TOPIC = "chip/response"
 console = Console()
 
-#Set up the logging
-logging.basicConfig(handlers=None, level=args.log_level.upper())
+#Set up the logging, records are written by a listener thread and each call
+#site is rate limited (see logger.py)
+logger.setup(args.log_level, console if LOCAL_TEST else None, rate=args.log_rate, burst=args.log_burst,
+             debug_payloads=args.log_payloads.lower() == 'true')
 
-def lPrint(msg):
-    if LOCAL_TEST:
-        console.print(msg)
-    logging.info(msg)
-#    print(msg, file=sys.stdout)
-#    sys.stderr.flush()
-    pass
+def lPrint(msg, *args, **fields):
+    logger.info(msg, *args, depth=1, **fields)
 
 if not LOCAL_TEST:
     #Set up the IoT communication to AWS IoT Core
-    import awsiot.greengrasscoreipc
     import awsiot.greengrasscoreipc.client as client
+    from awscrt.exceptions import AwsCrtError
+    from awsiot.eventstreamrpc import ConnectionClosedError
     from awsiot.greengrasscoreipc.clientv2 import GreengrassCoreIPCClientV2
 
     from awsiot.greengrasscoreipc.model import (
@@ -170,7 +241,8 @@ if not LOCAL_TEST:
         ResourceNotFoundError,
         ServiceError,
         ConflictError,
-        UnauthorizedError
+        UnauthorizedError,
+        GreengrassCoreIPCError
     )
 
     lPrint("not LOCAL_TEST")
@@ -178,7 +250,11 @@ if not LOCAL_TEST:
     # After we create an IPC client, keep it open and reuse it for all IPC operations. 
     # Creating multiple clients uses extra resources and can result in resource leaks.
     # (from AWS implementation)
-    ipc_client = awsiot.greengrasscoreipc.connect()
+    # The one long lived IPC connection is shared by the MQTT publish and
+    # subscriptions and all of the shadow operations, it is reconnected (and
+    # the subscriptions made again) when a call fails on the connection itself
+    ipc_client = ManagedIpcClient(GreengrassCoreIPCClientV2, timeout=TIMEOUT,
+                                  connection_errors=(ConnectionClosedError, AwsCrtError, ConnectionError))
 
 _sample_file_name = 'sample_data.json'
 
@@ -195,36 +271,66 @@ def message_router(message): # Return true if the message should be forwarded to
     if "command" in message and message['command'] == 'open_commissioning_window':
         lPrint("in message router with open_commissioning_window")
         node_id = message['args']['node_id']
-        callbacks_per_message_id[message['message_id']] = (node_id, open_commissioning_window_callback)
+        callbacks_per_message_id.register(message['message_id'], node_id, open_commissioning_window_callback,
+                                          on_timeout=open_commissioning_window_timeout)
 
 #    elif "command" in message and message['command'] == 'discover':
 #        lPrint("in message router with discover command")
 #        node_id = message['args']['node_id']
 
     if "command" in message and message['command'] == 'call_webhook':
-        lPrint("Webhook called..........................")
         webhook_method = message['webhook_method']
         webhook_url = message['webhook_url']
         webhook_endpoint = message['webhook_endpoint']
-        data = json.dumps(message['args'])
+        lPrint("webhook called", method=webhook_method, url=webhook_url, endpoint=webhook_endpoint)
+        data = jsonCodec.dumps(message['args'])
         headers = {"Content-Type": "application/json"}
 
-        wh = WebhookHandler()
-        asyncio.create_task(wh.sendWebhook(webhook_method, webhook_url, webhook_endpoint, data, headers))
+        asyncio.create_task(webhooks.sendWebhook(webhook_method, webhook_url, webhook_endpoint, data, headers))
 
         forwardToWebsocket = False # dont forward this onto the websocket for the python matter server
 
     return forwardToWebsocket
 
-def open_commissioning_window_callback(loop, node_id, message):
+async def open_commissioning_window_callback(loop, node_id, message):
     lPrint("In open_commissioning_window callback")
     code = int(message['result'][1])
-    rand_message_id = str(random.randint(1, 9999999) )
+    new_message_id = next_message_id()
     # The spec allows this attribute to be used for the storage of a client-provided small payload which Administrators and
     # Commissioners MAY write and then subsequently read, to keep track of their own progress.
-    message_object = {"message_id": rand_message_id, "command": "write_attribute", "args": {"endpoint_id": 0, "node_id": node_id, "attribute_path": "0/48/0", "value": code}}
-    loop.create_task(queue.put(json.dumps(message_object)))
-
+    message_object = {"message_id": new_message_id, "command": "write_attribute", "args": {"endpoint_id": 0, "node_id": node_id, "attribute_path": "0/48/0", "value": code}}
+    # called from the websocket reader which must not wait on the queue
+    reader_feeder.put(MatterCommand(message_object), LANE_CONTROL)
+
+#Send a command over the shared websocket connection and wait for its reply
+async def matter_request(message_object, lane=LANE_INTERACTIVE):
+    if "message_id" not in message_object:
+        message_object["message_id"] = next_message_id()
+    command = MatterCommand(message_object, reply=asyncio.get_running_loop().create_future())
+    await queue.put(command, lane)
+    return await command.reply
+
+def open_commissioning_window_timeout(message_id, node_id):
+    lPrint(f"No reply to open_commissioning_window {message_id} for node {node_id}")
+
+# commands dropped by enqueue_threadsafe per lane
+enqueue_drops = {}
+
+#Put a message on the queue from one of the IPC stream handler threads.
+#This blocks the IPC thread while the queue is over its budget so the
+#backpressure reaches the producer instead of piling up pending tasks.
+#Returns False when the command was dropped because the queue stayed full
+def enqueue_threadsafe(message_object, loop, lane=None):
+    future = asyncio.run_coroutine_threadsafe(queue.put(message_object, lane), loop)
+    try:
+        future.result(TIMEOUT)
+        return True
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        enqueue_drops[lane] = enqueue_drops.get(lane, 0) + 1
+        logger.warning("Queue is full, dropping command", message_id=message_object.message_id,
+                       command=message_object.command, lane=lane)
+        return False
 
 #######################################################################################
 ##
@@ -232,90 +338,31 @@ def open_commissioning_window_callback(loop, node_id, message):
 ##
 #######################################################################################
 
+#Publish the reply to a command on the response topic
+def publishResponse(response_message):
+    ipc_client.send("publish_to_iot_core", topic_name=RESPONSE_TOPIC, qos=QOS.AT_MOST_ONCE,
+                    payload=jsonCodec.dumpb(response_message))
+
 #Respond to a MQTT message
 def respond(event, loop):
-    resp = {}
-    resp["return_code"] = 200
-    resp["response"] = ""
-    response_format = RESPONSE_FORMAT
-    operation_timeout = TIMEOUT
-    
-    # validate message and attributes
+    # decode and validate the message in one pass, the payload is kept as
+    # bytes so it is sent on to the matter server without encoding it again
     try:
-        message_from_core = json.loads(event.message.payload.decode())
-
-        lPrint('message from core {}: '.format(message_from_core))
-
-        # Verify required keys are provided
-        if not all(k in message_from_core for k in ("message_id", "command")):
-            resp["response"] = MSG_MISSING_ATTRIBUTE
-            resp["return_code"] = 255
-            response_message = {
-                "message": str(event.message.payload),
-                "response": resp["response"],
-                "return_code": resp["return_code"]
-                }
-            # Publish to our topic
-            response = PublishToIoTCoreRequest()
-            response.topic_name = RESPONSE_TOPIC
-            response.payload = bytes(json.dumps(response_message), "utf-8")
-            response.qos = QOS.AT_MOST_ONCE
-            response_op = ipc_client.new_publish_to_iot_core()
-            response_op.activate(response)
-            lPrint('{} for message: '.format(MSG_MISSING_ATTRIBUTE))
-            return
-        
-
-    except json.JSONDecodeError as e:
-        resp["response"] = MSG_INVALID_JSON
-        resp["return_code"] = 255
-        response_message = {
-            "timestamp": int(round(time.time() * 1000)),
-            "message": str(event.message.payload),
-            "response": resp["response"],
-            "return_code": resp["return_code"]
-            }
-        # Publish to our topic
-        response = PublishToIoTCoreRequest()
-        response.topic_name = RESPONSE_TOPIC
-        response.payload = bytes(json.dumps(response_message), "utf-8")
-        response.qos = QOS.AT_MOST_ONCE
-        response_op = ipc_client.new_publish_to_iot_core()
-        response_op.activate(response)        
-        lPrint(f"{MSG_INVALID_JSON} for message")
+        command = MatterCommand.from_json(event.message.payload)
+    except CommandError as e:
+        publishResponse(commandResponse(event.message.payload, e.response, 255))
+        lPrint(f"{e.response} for message")
         return
-    except Exception as e:
-        raise
-    
-    command = message_from_core["command"]
-    command = command.lstrip()
 
-    node_id = None
-    resp["response"] = "accepted"
-    resp["return_code"] = 200
-    resp["message_id"] = message_from_core["message_id"]
+    lPrint("message from core", message_id=command.message_id, command=command.command)
+    logger.payload("message from core", command.message)
 
     # add to the queue
-    message_object = json.dumps(message_from_core)
-    loop.create_task(queue.put(message_object))
-
-    # Dummy response message
-    response_message = {
-        "timestamp": int(round(time.time() * 1000)),
-        "message": str(event.message.payload),
-        "message_id": str(resp["message_id"]),
-        "response": resp["response"],
-        "return_code": resp["return_code"]
-        }
-
+    if not enqueue_threadsafe(command, loop, LANE_INTERACTIVE):
+        publishResponse(commandResponse(event.message.payload, MSG_QUEUE_FULL, 255, command.message_id))
+        return
 
-    # Publish to our topic
-    response = PublishToIoTCoreRequest()
-    response.topic_name = RESPONSE_TOPIC
-    response.payload = bytes(json.dumps(response_message), "utf-8")
-    response.qos = QOS.AT_MOST_ONCE
-    response_op = ipc_client.new_publish_to_iot_core()
-    response_op.activate(response)
+    publishResponse(commandResponse(event.message.payload, "accepted", 200, command.message_id))
 
 #######################################################################################
 ##
@@ -351,7 +398,7 @@ if not LOCAL_TEST:
                 respond(event, self.loop)
                 return True
             except:
-                traceback.print_exc()
+                logger.exception("Error handling a command message")
 
         def on_stream_error(self, error: Exception) -> bool:
             # Handle error.
@@ -361,66 +408,87 @@ if not LOCAL_TEST:
             # Handle close.
             pass
 
-    #Handler for subscription callback
+    #Get the shadow name and the payload of a shadow topic message
+    #The topics look like $aws/things/<thing>/shadow/name/<shadow>/update/delta
+    def shadowTopicMessage(event):
+        if (isinstance(event, IoTCoreMessage)):
+            return event.message.topic_name.split('/')[5], str(event.message.payload, 'utf-8')
+        elif (isinstance(event, SubscriptionResponseMessage)):
+            return event.binary_message.context.topic.split('/')[5], str(event.binary_message.message, 'utf-8')
+        return None, None
+
+    #Handler for the delta subscription callback of all the named shadows
     class SubHandler(client.SubscribeToTopicStreamHandler):
         loop = None
-        shadow = None
-        def __init__(self, shadow, loop):
+        def __init__(self, loop):
             self.loop = loop
-            self.shadow = shadow
             super().__init__()
 
         def on_stream_event(self, event: IoTCoreMessage) -> None:  
 
-            lPrint("Handler for subscription callback for " + self.shadow)
-            #lPrint(event)
-
-            current_shadow = json.loads(get_thing_shadow_request(THING_NAME, self.shadow))
-
             try:
-                if (isinstance(event, IoTCoreMessage)):
-                    message = str(event.message.payload, 'utf-8')
-                elif (isinstance(event, SubscriptionResponseMessage)):
-                    message = str(event.binary_message.message, 'utf-8')
-                else:
+                shadow, message = shadowTopicMessage(event)
+                if shadow is None:
                     return True
-                
-                # Load message and check values
-                jsonmsg = json.loads(message)
 
+                #Only the <node>_<endpoint> shadows (and their static and shard
+                #shadows) hold attributes that can be written
+                shadow_parts = shadow.split('_')
+                if len(shadow_parts) < 2 or not shadow_parts[0].isdigit() or not shadow_parts[1].isdigit():
+                    return True
+
+                lPrint("shadow delta", shadow=shadow)
+
+                # Load message and check values
+                jsonmsg = jsonCodec.loads(message)
+
+                #We are the writer of the reported state so it is usually
+                #in the shadow cache, only read the shadow when it is not
+                shadow_cache.on_delta(THING_NAME, shadow, jsonmsg.get('version'))
+                reported = shadow_cache.reported(THING_NAME, shadow)
+                if reported is None:
+                    response = get_thing_shadow_request(THING_NAME, shadow)
+                    #A live shadow may only hold desired values when its
+                    #attributes are all still in the static shadow
+                    reported = jsonCodec.loads(response)["state"].get("reported", {}) if response else {}
+
+                #Collect every attribute that differs from the reported state
+                #grouped by endpoint so each endpoint gets one batched write
+                temp_node_id = int(shadow.split('_')[0])
+                changes_per_endpoint = {}
                 state_changes = jsonmsg['state']
                 for iterator in state_changes:
 
                     #If we have already changed then do nothing
-                    reported_states= current_shadow["state"]["reported"]
-                    if reported_states[iterator] == state_changes[iterator]:
-                        break
+                    if iterator in reported and reported[iterator] == state_changes[iterator]:
+                        continue
 
-                    temp_node_id = int(self.shadow.split('_')[0])
                     temp_endpoint = int(iterator.split('/')[0])
-                    rand_message_id = str(random.randint(1, 9999999) )
-                    lPrint(iterator + ":" + str(state_changes[iterator]))
+                    changes_per_endpoint.setdefault(temp_endpoint, {})[iterator] = state_changes[iterator]
+
+                for temp_endpoint, attributes in changes_per_endpoint.items():
+                    new_message_id = next_message_id()
 
                     # add to the queue
-                    lPrint("adding message_object to queue")
                     message_object = {
-                        "message_id": rand_message_id, 
-                        "command": "write_attribute", 
+                        "message_id": new_message_id, 
+                        "command": "write_attributes", 
                         "args": {"endpoint_id": temp_endpoint, 
                                 "node_id": temp_node_id, 
-                                "attribute_path": iterator, 
-                                "value": state_changes[iterator]
+                                "attributes": attributes
                                 }
                     }
-                    lPrint(json.dumps(message_object))
+                    lPrint("queueing write_attributes", message_id=new_message_id, node_id=temp_node_id,
+                           endpoint_id=temp_endpoint, attributes=len(attributes))
+                    logger.payload("write_attributes", message_object)
 
-                    self.loop.create_task(queue.put(json.dumps(message_object)))
-                    self.loop.create_task(asyncio.sleep(0.1))
+                    if not enqueue_threadsafe(MatterCommand(message_object), self.loop, LANE_CONTROL):
+                        logger.warning("Dropped the write of a shadow delta", shadow=shadow, endpoint_id=temp_endpoint)
 
                 return True
 
             except:
-                traceback.print_exc()
+                logger.exception("Error handling a shadow delta")
 
         def on_stream_error(self, error: Exception) -> bool:
             # Handle error.
@@ -430,33 +498,29 @@ if not LOCAL_TEST:
             # Handle close.
             pass
 
-    #Handler for update document subscription callback
+    #Handler for the update document subscription callback of all the named shadows
     class UpdateDocumentHandler(client.SubscribeToTopicStreamHandler):
         loop = None
-        shadow = None
-        def __init__(self, shadow, loop):
+        def __init__(self, loop):
             self.loop = loop
-            self.shadow = shadow
             super().__init__()
 
         def on_stream_event(self, event: IoTCoreMessage) -> None:  
 
+            shadow, message = shadowTopicMessage(event)
+            if shadow is None:
+                return True
+
             #We dont support Events in the rules
-            if "event" not in self.shadow: 
-                lPrint("Handler for UpdateDocumentHandler callback for " + self.shadow)
+            if "event" not in shadow: 
+                lPrint("Handler for UpdateDocumentHandler callback for " + shadow)
 
                 try:
-                    if (isinstance(event, IoTCoreMessage)):
-                        message = str(event.message.payload, 'utf-8')
-                    elif (isinstance(event, SubscriptionResponseMessage)):
-                        message = str(event.binary_message.message, 'utf-8')
-                    else:
-                        return True
                     
                     # Load message and check values
-                    jsonmsg = json.loads(message)            
+                    jsonmsg = jsonCodec.loads(message)            
 
-                    rand_message_id = str(random.randint(1, 9999999) )
+                    new_message_id = next_message_id()
 
                     # add to the queue
                     #lPrint("adding webhook message_object to queue")
@@ -464,16 +528,16 @@ if not LOCAL_TEST:
                     webhook_endpoint = WEBHOOK_GRAPHQL_ENDPOINT + "shadowUpdateWebhookForRules"
 
                     message_object = {
-                        "message_id": rand_message_id, 
+                        "message_id": new_message_id, 
                         "command": "call_webhook", 
                         "webhook_method": "POST", 
                         "webhook_url": webhook_url, 
                         "webhook_endpoint": webhook_endpoint,
                         "args": {
                             "Type": "Notification",
-                            "Message" : json.dumps({
+                            "Message" : jsonCodec.dumps({
                                 "thing_name" :  THING_NAME,
-                                "shadow_name" : self.shadow,
+                                "shadow_name" : shadow,
                                 "previous": jsonmsg["previous"],
                                 "current": jsonmsg["current"] 
                                 })
@@ -482,13 +546,13 @@ if not LOCAL_TEST:
                     #lPrint(json.dumps(message_object))
 
                     lPrint("adding webhook message_object to queue")
-                    self.loop.create_task(queue.put(json.dumps(message_object)))
-                    self.loop.create_task(asyncio.sleep(0.1))
+                    if not enqueue_threadsafe(MatterCommand(message_object), self.loop, LANE_WEBHOOK):
+                        logger.warning("Dropped the rules webhook of a shadow update", shadow=shadow)
 
                     return True
 
                 except:
-                    traceback.print_exc()
+                    logger.exception("Error handling a shadow update")
 
         def on_stream_error(self, error: Exception) -> bool:
             # Handle error.
@@ -498,218 +562,135 @@ if not LOCAL_TEST:
             # Handle close.
             return True
 
-def subscribeToTopic(topic, handler):
-    global operation
+async def subscribeToTopic(topic, handler):
     lPrint("Setting up the MQTT Subscription to subscribe to topic")
     # Setup the MQTT Subscription
     qos = QOS.AT_MOST_ONCE
-    request = SubscribeToIoTCoreRequest()
-    request.topic_name = topic
-    request.qos = qos
-    operation = ipc_client.new_subscribe_to_iot_core(handler)
-    future = operation.activate(request)
-    future.result(TIMEOUT)
-
-#Get the shadow from the local IPC
+    await ipc_client.subscribe("subscribe_to_iot_core", topic_name=topic, qos=qos, stream_handler=handler)
+
+#Get the shadow from the shadow cache or else the local IPC
 def get_thing_shadow_request(thing_name, shadow_name):
-    lPrint("getting_thing_shadow_request: "+shadow_name)
+    document = shadow_cache.get(thing_name, shadow_name)
+    logger.debug("get shadow", shadow=shadow_name, cached=document is not None)
+    if document is not None:
+        return jsonCodec.dumpb(document)
 
     try:
-        # set up IPC client to connect to the IPC server
-        ipc_client = awsiot.greengrasscoreipc.connect()
-                            
-        # create the GetThingShadow request
-        get_thing_shadow_request = GetThingShadowRequest()
-        get_thing_shadow_request.thing_name = thing_name
-        get_thing_shadow_request.shadow_name = shadow_name
-        
-        # retrieve the GetThingShadow response after sending the request to the IPC server
-        op = ipc_client.new_get_thing_shadow()
-        op.activate(get_thing_shadow_request)
-        fut = op.get_response()
+        # retrieve the GetThingShadow response over the shared IPC connection
+        result = ipc_client.call("get_thing_shadow", thing_name=thing_name, shadow_name=shadow_name)
+        shadow_cache.put(thing_name, shadow_name, jsonCodec.loads(result.payload))
+        return result.payload
         
-        result = fut.result(TIMEOUT)
+    except Exception as e:
+        lPrint("Error get shadow")
+        return []
+        # except ResourceNotFoundError | UnauthorizedError | ServiceError
 
-        ipc_client.close()
+#Get the shadow from the shadow cache or else the local IPC without blocking the event loop
+async def get_thing_shadow_request_async(thing_name, shadow_name):
+    document = shadow_cache.get(thing_name, shadow_name)
+    logger.debug("get shadow", shadow=shadow_name, cached=document is not None)
+    if document is not None:
+        return jsonCodec.dumpb(document)
+
+    try:
+        result = await ipc_client.call_async("get_thing_shadow", thing_name=thing_name, shadow_name=shadow_name)
+        shadow_cache.put(thing_name, shadow_name, jsonCodec.loads(result.payload))
         return result.payload
         
     except Exception as e:
         lPrint("Error get shadow")
         return []
-        # except ResourceNotFoundError | UnauthorizedError | ServiceError
 
-#Set the local shadow using the IPC
-def update_thing_shadow_request(thing_name, shadow_name, payload):
-    lPrint("in update_thing_shadow_request")
-    #lPrint(payload)
+#Set the local shadow using the IPC without blocking the event loop
+async def update_thing_shadow_request(thing_name, shadow_name, payload):
+    logger.debug("update shadow", shadow=shadow_name, bytes=len(payload))
+    logger.payload("update shadow " + shadow_name, payload)
     try:
-        # set up IPC client to connect to the IPC server
-        client = GreengrassCoreIPCClientV2()
-        result = client.update_thing_shadow(thing_name=thing_name, payload=payload, shadow_name=shadow_name)
+        result = await ipc_client.call_async("update_thing_shadow", thing_name=thing_name, payload=payload, shadow_name=shadow_name)
+        #Keep the cached document in step with what we wrote
+        response = jsonCodec.loads(result.payload)
+        shadow_cache.apply_update(thing_name, shadow_name, jsonCodec.loads(payload).get("state", {}), response.get("version"), response.get("timestamp"), response.get("metadata"))
         return result.payload
     except ConflictError as e:
-        lPrint("ConflictError: Error update shadow")
-        traceback.print_exc()
+        logger.exception("ConflictError: Error update shadow", shadow=shadow_name)
     except UnauthorizedError as e:
-        lPrint("UnauthorizedError: Error update shadow")
-        traceback.print_exc()
+        logger.exception("UnauthorizedError: Error update shadow", shadow=shadow_name)
     except ServiceError as e:
-        lPrint("ServiceError: Error update shadow")
-        traceback.print_exc()
+        logger.exception("ServiceError: Error update shadow", shadow=shadow_name)
     except InvalidArgumentsError as e:
-        lPrint(e)
-        lPrint("InvalidArgumentsError: Error update shadow")
-        traceback.print_exc()
+        logger.exception("InvalidArgumentsError: Error update shadow", shadow=shadow_name)
     except Exception as e:
-        lPrint("Error update shadow")
-        traceback.print_exc()
-
-#Get the shadow from the local IPC
-def list_named_shadows_request(thing_name, nextToken):
+        logger.exception("Error update shadow", shadow=shadow_name)
+    #The write failed so the cached document can no longer be trusted
+    shadow_cache.invalidate(thing_name, shadow_name)
+
+#Set the local shadow using the IPC unless it already holds this document
+#Returns True when the shadow was written, False when the write was skipped
+#as the shadow already holds the payload and None when the write failed
+async def write_shadow_if_changed(thing_name, shadow_name, payload):
+    digest = shadow_fingerprints.check(shadow_name, payload)
+    if digest is None:
+        return False
+
+    if await update_thing_shadow_request(thing_name, shadow_name, payload) is None:
+        shadow_fingerprints.forget(shadow_name)
+        return None
+
+    shadow_fingerprints.record(shadow_name, digest)
+    return True
+
+#List the named shadows from the local IPC without blocking the event loop
+async def list_named_shadows_request_async(thing_name, nextToken):
     lPrint("list_named_shadows_request: "+thing_name)
 
     try:
-        ipc_client = awsiot.greengrasscoreipc.connect()
-                            
-        lPrint("Creating the ListNamedShadowsForThing request")
-        # create the ListNamedShadowsForThingRequest request
-        list_named_shadows_for_thing_request = ListNamedShadowsForThingRequest()
-        list_named_shadows_for_thing_request.thing_name = thing_name
-        list_named_shadows_for_thing_request.next_token = nextToken
-
-        lPrint("Retrieving the ListNamedShadowsForThing response")
-        # retrieve the ListNamedShadowsForThingRequest response after sending the request to the IPC server
-        op = ipc_client.new_list_named_shadows_for_thing()
-
-        lPrint("Activating the ListNamedShadowsForThing response")
-        op.activate(list_named_shadows_for_thing_request)
-        fut = op.get_response()
-                
-        list_result = fut.result(TIMEOUT)
-        
-        # additional returned fields
-        timestamp = list_result.timestamp
-        next_token = list_result.next_token
-        named_shadow_list = list_result.results
-        
-        ipc_client.close()
-        #return named_shadow_list
-        return named_shadow_list, next_token, timestamp
+        list_result = await ipc_client.call_async("list_named_shadows_for_thing", thing_name=thing_name, next_token=nextToken)
+        return list_result.results, list_result.next_token, list_result.timestamp
         
     except Exception as e:
         lPrint("Error listing named shadows")
-        return []
-        # except ResourceNotFoundError | UnauthorizedError | ServiceError
+        return [], None, None
 
-#Get the shadow from the local IPC
-def delete_named_shadow_request(thing_name, shadow_name):
+#Delete the shadow from the local IPC without blocking the event loop
+async def delete_named_shadow_request_async(thing_name, shadow_name):
     lPrint("delete_named_shadow_request - thing_name: "+thing_name)
     lPrint("delete_named_shadow_request - shadow_name: "+shadow_name)
+    shadow_fingerprints.forget(shadow_name)
+    reported_states.forget(shadow_name)
+    shadow_cache.forget(thing_name, shadow_name)
 
-    try:
-        # set up IPC client to connect to the IPC server
-        ipc_client = awsiot.greengrasscoreipc.connect()
-                            
-        # create the DeleteThingShadowRequest request
-        delete_named_shadow_for_thing_request = DeleteThingShadowRequest()
-        delete_named_shadow_for_thing_request.thing_name = thing_name
-        delete_named_shadow_for_thing_request.shadow_name = shadow_name
-
-        # retrieve the DeleteThingShadowRequest response after sending the request to the IPC server
+    #The shards of a sharded endpoint shadow go with it
+    for shard_name in shadow_sharder.forget(shadow_name):
+        await delete_named_shadow_request_async(thing_name, shard_name)
 
-        op = ipc_client.new_delete_thing_shadow()
-
-        lPrint("Activating the DeleteThingShadowRequest response")
-
-        op.activate(delete_named_shadow_for_thing_request)
-        fut = op.get_response()
-                
-        lPrint(fut)
-        result = fut.result(TIMEOUT)
-        
-        ipc_client.close()
+    try:
+        result = await ipc_client.call_async("delete_thing_shadow", thing_name=thing_name, shadow_name=shadow_name)
         return result.payload
         
     except Exception as e:
         lPrint("Error deleting named shadow")
         return []
-        # except ResourceNotFoundError | UnauthorizedError | ServiceError
-
-def findEndpointsPerNode(node_result):
-    endpoints = []
-    for iterator in node_result["attributes"]:
-        temp_endpoint = int(iterator.split('/')[0])
-        if temp_endpoint not in endpoints:
-            endpoints.append(temp_endpoint) # add this attribute to the new sttribute dict
-        
-    return endpoints
-
-def filterNodesByEndpoint(node_result, endpoint_id):
-    filtered_results = node_result.copy()
-    attributes = {}
-    for iterator in filtered_results["attributes"]:
-        if iterator.startswith(f"{endpoint_id}/"):
-            attributes[iterator] = filtered_results["attributes"][iterator] # add this attribute to the new sttribute dict
-            
-    filtered_results["attributes"] = attributes
-    return attributes
 
 async def OnNodeChange(node_id, node_result)-> None:
-    lPrint("Saw node change inside Cloud Controller! for node_id: "+ str(node_id))
-    thing_name = args.name 
-
-    #Here we are going to create multiple shadows - per node_id/endpointid 
-    for endpoint in findEndpointsPerNode(node_result):
-        filtered_node_result = filterNodesByEndpoint(node_result, endpoint)
-            
-        #set the device shadow for test
-        shadow_name = str(node_id) + "_" + str(endpoint)
-
-        newStr = '{"state": {"reported": '+json.dumps(filtered_node_result)+'}}'
-
-        if not LOCAL_TEST:
-            update_thing_shadow_request(thing_name, shadow_name, bytes(newStr, "utf-8"))
-
-    if not LOCAL_TEST:
-        #now that we have created/updated new shadows 
-        #we need to subscribe to any deltas
-        subscribe_to_shadow_deltas(thing_name)
-        pass
-
-    if LOCAL_ARG: #This code is only if we run the controller with local mode enabled (i.e. -l True)
-        # acquire the semaphore
-        async with semaphore:
-            #Lets send a webhook to the locally running redwood service
-            webHookUrl = WEBHOOK_PATH + "shadowUpdateWebhookLocal/" + thing_name+"/"+str(node_id)
-
-            rand_message_id = str(random.randint(1, 9999999) )
-
-            # add to the queue
-            lPrint("adding webhook message_object to queue - GET")
-            webhook_url = WEBHOOK_PATH
-
-            webhook_endpoint = WEBHOOK_GRAPHQL_ENDPOINT + "shadowUpdateWebhookLocal/" + thing_name+"/"+str(node_id)
-
-            message_object = {
-                "message_id": rand_message_id, 
-                "command": "call_webhook", 
-                "webhook_method": "GET", 
-                "webhook_url": webhook_url, 
-                "webhook_endpoint": webhook_endpoint,
-                "args": {}
-            }
-            #lPrint(json.dumps(message_object))
-
-            node_change_loop = asyncio.get_event_loop()
-            node_change_loop.create_task(queue.put(json.dumps(message_object)))
-            node_change_loop.create_task(asyncio.sleep(0.1))
-
-    lPrint("we will subscribe to attribute changes")
+    #Called with a full node result (get_node/get_nodes). The node mirror is
+    #replaced and the shadows of all of its endpoints are marked dirty
+    lPrint("node change", node_id=node_id)
+
+    #Only the attributes in the projection are mirrored
+    node_result = dict(node_result, attributes=attribute_projection.project(node_result.get("attributes", {})))
+    node_store.set_node(node_id, node_result)
+    #A full node is the time to (re)write the static shadows
+    for endpoint in node_store.endpoints(node_id):
+        shadow_splitter.mark_static_dirty(str(node_id) + "_" + str(endpoint))
+    await OnNodeAttributesChange(node_id)
+
+    logger.debug("subscribing to attribute changes", node_id=node_id)
     #This is a node event so we will 
     #subscribe to the attribute changes for this noide
-    rand_message_id = str(random.randint(1, 9999999) )
+    new_message_id = next_message_id()
     message_object = {
-        "message_id": rand_message_id,
+        "message_id": new_message_id,
         "command": "subscribe_attribute",
         "args": {
             "node_id": node_id,
@@ -717,11 +698,126 @@ async def OnNodeChange(node_id, node_result)-> None:
         }
     }
     #lPrint(json.dumps(message_object))
-    # add to the queue
-    await queue.put(json.dumps(message_object))
+    # add to the queue, this is called from the websocket reader
+    reader_feeder.put(MatterCommand(message_object), LANE_BACKGROUND, key=("subscribe_attribute", node_id))
+
+async def OnNodeAttributesChange(node_id)-> None:
+    #Mark the shadows of the endpoints that are dirty in the node mirror
+    #so they are written by the next shadow flush
+    logger.debug("node attributes change", node_id=node_id)
+
+    #Here we are going to create multiple shadows - per node_id/endpointid 
+    for endpoint in node_store.pop_dirty(node_id):
+        shadow_flusher.mark_dirty(str(node_id) + "_" + str(endpoint))
+
+#After a restart a shadow still holds what the previous run wrote, which can
+#include keys that are no longer wanted: a "shards" manifest once the endpoint
+#fits in one shadow again, a "static" link after --shadow-split was turned off
+#or attributes that are gone. The updates are merged into the document, so
+#the tracker starts from the existing document to have them deleted
+async def seed_reported_state(thing_name, document_name):
+    response = await get_thing_shadow_request_async(thing_name, document_name)
+    if not response:
+        return # no shadow yet (or it could not be read), written in full
+    try:
+        reported = jsonCodec.loads(response).get("state", {}).get("reported")
+    except ValueError:
+        return
+    if isinstance(reported, dict):
+        reported_states.seed(document_name, reported)
 
-def OnEventChange(node_id, event_read_result)-> None:
-    lPrint("Saw event change inside Cloud Controller! for node_id: "+ str(node_id))
+async def flushNodeShadows(shadow_names)-> list:
+    #Write the current state of each dirty <node>_<endpoint> shadow, returns
+    #the shadows that could not be written so the flusher retries them
+    thing_name = args.name 
+    updated_nodes = []
+    failed = []
+
+    for shadow_name in shadow_names:
+        node_id, endpoint = (int(part) for part in shadow_name.split('_'))
+        if not node_store.has_node(node_id):
+            continue # the node was removed before we got to write it
+
+        #The static attributes are only written when they have changed
+        live, static = shadow_splitter.split(node_store.endpoint_attributes(node_id, endpoint))
+        endpoint_shadows = [(shadow_name, live)]
+        if shadow_splitter.pop_static_dirty(shadow_name):
+            endpoint_shadows.append((shadow_name + "_static", static))
+
+        for endpoint_shadow_name, endpoint_attributes in endpoint_shadows:
+            #Large endpoints are written as several shard shadows plus a manifest
+            documents, retired_shards = shadow_sharder.documents(endpoint_shadow_name, endpoint_attributes)
+            if shadow_splitter.enabled and endpoint_shadow_name == shadow_name:
+                #Readers of the live shadow find the rest of the endpoint here
+                documents[shadow_name] = dict(documents[shadow_name], static=shadow_name + "_static")
+            for document_name, reported in documents.items():
+                if not LOCAL_TEST and not reported_states.written(document_name):
+                    await seed_reported_state(thing_name, document_name)
+                #Only send the attributes that changed since the last write,
+                #the first write is always sent even when it is empty so
+                #readers of the shadow find it
+                patch = reported_states.patch(document_name, reported)
+                if not patch and reported_states.written(document_name):
+                    continue
+
+                payload = jsonCodec.dumpb({"state": {"reported": patch}})
+
+                written = True if LOCAL_TEST else await write_shadow_if_changed(thing_name, document_name, payload)
+                if written is None:
+                    if shadow_name not in failed:
+                        failed.append(shadow_name)
+                    if endpoint_shadow_name != shadow_name:
+                        shadow_splitter.mark_static_dirty(shadow_name) # write the static shadow again too
+                    continue
+                if not written:
+                    continue
+                reported_states.commit(document_name, reported, patch)
+
+                if node_id not in updated_nodes:
+                    updated_nodes.append(node_id)
+
+            for shard_name in retired_shards:
+                reported_states.forget(shard_name)
+                if not LOCAL_TEST:
+                    await delete_named_shadow_request_async(thing_name, shard_name)
+
+    if LOCAL_ARG: #This code is only if we run the controller with local mode enabled (i.e. -l True)
+        for node_id in updated_nodes:
+            await notifyShadowWebhook(thing_name, node_id)
+
+    return failed
+
+# writes the dirty node shadows, coalescing bursts of changes into one write per shadow
+shadow_flusher = ShadowFlushScheduler(flushNodeShadows, debounce=args.shadow_debounce, max_staleness=args.shadow_max_staleness)
+
+async def notifyShadowWebhook(thing_name, node_id)-> None:
+    # acquire the semaphore
+    async with semaphore:
+        #Lets send a webhook to the locally running redwood service
+        webHookUrl = WEBHOOK_PATH + "shadowUpdateWebhookLocal/" + thing_name+"/"+str(node_id)
+
+        new_message_id = next_message_id()
+
+        # add to the queue
+        logger.debug("queueing shadow webhook", node_id=node_id)
+        webhook_url = WEBHOOK_PATH
+
+        webhook_endpoint = WEBHOOK_GRAPHQL_ENDPOINT + "shadowUpdateWebhookLocal/" + thing_name+"/"+str(node_id)
+
+        message_object = {
+            "message_id": new_message_id, 
+            "command": "call_webhook", 
+            "webhook_method": "GET", 
+            "webhook_url": webhook_url, 
+            "webhook_endpoint": webhook_endpoint,
+            "args": {}
+        }
+        #lPrint(json.dumps(message_object))
+
+        await queue.put(MatterCommand(message_object), LANE_WEBHOOK)
+
+async def OnEventChange(node_id, event_read_result)-> None:
+    lPrint("node event", node_id=node_id, event=event_read_result.get("event"))
     thing_name = args.name 
     shadow_name = "events_" + str(node_id)
 
@@ -732,110 +828,106 @@ def OnEventChange(node_id, event_read_result)-> None:
     and "event_id" in event_read_result["data"] 
     and (event_read_result["data"]['event_id'] == 1 or event_read_result["data"]['event_id'] == 2)) :
         lPrint("We need to remove the shadows:")
+        node_events.remove_node(node_id)
         #Here we will remove the shadows
         #TODO - we need to list the shadows so that we remove all endpoints            
         if not LOCAL_TEST:
-            delete_named_shadow_request(thing_name, shadow_name)
-            delete_named_shadow_request(thing_name, str(node_id) + "_0")
-            delete_named_shadow_request(thing_name, str(node_id) + "_1")
+            await delete_named_shadow_request_async(thing_name, shadow_name)
+            for endpoint_shadow_name in (str(node_id) + "_0", str(node_id) + "_1"):
+                await delete_named_shadow_request_async(thing_name, endpoint_shadow_name)
+                if shadow_splitter.enabled:
+                    await delete_named_shadow_request_async(thing_name, endpoint_shadow_name + "_static")
 
-    #First read the existing events and then add to it
-
-    newList = []
-
-    if not LOCAL_TEST:
-        #If we get an Exception its because we dont have an event list already
-        try:
-            response = get_thing_shadow_request(thing_name, shadow_name)
+    #Add a date stamp to this event
+    event_read_result['createdAt'] = str(datetime.datetime.now().isoformat())
 
-            prevEvents = json.loads(response)
-            
-            #Append a new event to the event List - this will push out oldest if full
-            if len(prevEvents['state']['reported']['list']) > MAX_EVENTS:
-                newList = prevEvents['state']['reported']['list'][1:]
-            else:
-                newList = prevEvents['state']['reported']['list']
+    #Add the event to the node's events, this will push out the oldest if full.
+    #The events shadow is written by the event flusher so a burst of events
+    #ends up as one shadow write
+    node_events.append(node_id, event_read_result)
+    event_flusher.mark_dirty(shadow_name)
 
-        except:
-            prevEvents = {"state": None}
-            prevEvents["state"] = {"reported": None}
-            prevEvents["state"]["reported"] = {"list": []}
-    else: #create a dummy prevEvents object so we can debug locally
-            prevEvents = {"state": None}
-            prevEvents["state"] = {"reported": None}
-            prevEvents["state"]["reported"] = {"list": []}
+async def flushNodeEvents(shadow_names)-> list:
+    #Write the events of each node that has new events to its events shadow,
+    #returns the shadows that could not be written so the flusher retries them
+    thing_name = args.name 
+    failed = []
 
-    #Add a date stamp to this event
-    event_read_result['createdAt'] = str(datetime.datetime.now().isoformat())
+    for shadow_name in shadow_names:
+        node_id = int(shadow_name.split('_')[1])
+        payload = jsonCodec.dumpb({"state": {"reported": {"list": node_events.node_events(node_id)}}})
 
-    newList.append(event_read_result)
-    prevEvents['state']['reported']['list'] = newList
+        #Calling update thing shadow request for events
+        lPrint("updating event thing shadow:")
+        #lPrint(payload)
 
-    newStr = json.dumps(prevEvents)
+        if not LOCAL_TEST and await write_shadow_if_changed(thing_name, shadow_name, payload) is None:
+            failed.append(shadow_name)
 
-    #Calling update thing shadow request for events
-    lPrint("updating event thing shadow:")
-    #lPrint(newStr)
+    return failed
 
-    if not LOCAL_TEST:
-        result = update_thing_shadow_request(thing_name, shadow_name, bytes(newStr, "utf-8"))
+# writes the events shadows on a timer or once enough events have been seen
+event_flusher = ShadowFlushScheduler(flushNodeEvents, debounce=args.events_flush_interval,
+                                     max_staleness=args.events_flush_interval, max_marks=args.events_flush_count)
 
-def subscribe_to_shadow_deltas(thing_name):
+#Load the events already in the events shadows, this is only done once
+#at startup after which the events shadows are only written
+async def seed_node_events(thing_name):
     shadow_list = []
-    named_shadow_list, next_token, timestamp = list_named_shadows_request(thing_name, None)
+    named_shadow_list, next_token, timestamp = await list_named_shadows_request_async(thing_name, None)
     shadow_list.extend(named_shadow_list)
     while next_token != None:
-        named_shadow_list, next_token, timestamp = list_named_shadows_request(thing_name, next_token)
+        named_shadow_list, next_token, timestamp = await list_named_shadows_request_async(thing_name, next_token)
         shadow_list.extend(named_shadow_list)
 
-    # set up IPC client to connect to the IPC server
-    ipc_client = awsiot.greengrasscoreipc.connect()
-
-    #Now subscribe to the deltas for every shadow 
-    for shadow in named_shadow_list:
-
-        if shadow not in shadow_subscriptions:
-            #set up subscription of device shadow update deltas
-            subscribe_shadow_delta_topic = "$aws/things/"+thing_name+"/shadow/name/"+shadow+"/update/delta"
+    for shadow in shadow_list:
+        if shadow.startswith("events_"):
+            try:
+                prevEvents = jsonCodec.loads(await get_thing_shadow_request_async(thing_name, shadow))
+                node_events.seed(int(shadow.split('_')[1]), prevEvents['state']['reported']['list'])
+            except:
+                lPrint("Could not load the events of shadow " + shadow)
 
-            #We dont need to subscribe on the subscription as we now use interactions to change
-            #But we will leave this here in case we want to do something when the shadow changes
-            lPrint("Setting up the Shadow Subscription for: " + shadow)
-            # Setup the Shadow Subscription
-            shadow_loop = asyncio.get_event_loop()
-            # Setup the MQTT Subscription
-            handler = SubHandler(shadow, shadow_loop)
-            subscribeToTopic(subscribe_shadow_delta_topic, handler)
+    node_events.seeded = True
 
-            if LOCAL_ARG: #This code is only if we run the controller with local mode enabled (i.e. -l True)
-                #set up subscription of device shadow update document
-                subscribe_shadow_document_update_topic = "$aws/things/"+thing_name+"/shadow/name/"+shadow+"/update/documents"
+#Subscribe once to the deltas of all the named shadows of the thing.
+#The + wildcard matches any shadow name and the handlers take the shadow
+#name from the topic, so shadows created later need no new subscription
+async def subscribe_to_shadow_deltas(thing_name, shadow_loop):
+    #set up subscription of device shadow update deltas
+    subscribe_shadow_delta_topic = "$aws/things/"+thing_name+"/shadow/name/+/update/delta"
 
-                lPrint("Setting up the Shadow Document Update subscription for: " + shadow)
-                # Setup the Shadow Subscription
-                newLoop = asyncio.get_event_loop()
-                # Setup the MQTT Subscription
-                updateDocumentHandler = UpdateDocumentHandler(shadow, newLoop)
-                subscribeToTopic(subscribe_shadow_document_update_topic, updateDocumentHandler)
+    if subscribe_shadow_delta_topic not in shadow_subscriptions:
+        lPrint("Setting up the Shadow Subscription for all shadows")
+        # Setup the MQTT Subscription
+        handler = SubHandler(shadow_loop)
+        await subscribeToTopic(subscribe_shadow_delta_topic, handler)
+        #We will keep track of the subscriptions that we have created
+        #so that we dont recreate them when the websocket reconnects
+        shadow_subscriptions.append(subscribe_shadow_delta_topic)
 
-            #We will keep track of the subscriptions that we have created
-            #so that we dont recreate them
-            shadow_subscriptions.append(shadow)
+    if LOCAL_ARG: #This code is only if we run the controller with local mode enabled (i.e. -l True)
+        #set up subscription of device shadow update document
+        subscribe_shadow_document_update_topic = "$aws/things/"+thing_name+"/shadow/name/+/update/documents"
 
-    ipc_client.close()
+        if subscribe_shadow_document_update_topic not in shadow_subscriptions:
+            lPrint("Setting up the Shadow Document Update subscription for all shadows")
+            # Setup the MQTT Subscription
+            updateDocumentHandler = UpdateDocumentHandler(shadow_loop)
+            await subscribeToTopic(subscribe_shadow_document_update_topic, updateDocumentHandler)
+            shadow_subscriptions.append(subscribe_shadow_document_update_topic)
 
-def delete_all_shadows(thing_name):
+async def delete_all_shadows(thing_name):
     shadow_list = []
-    named_shadow_list, next_token, timestamp = list_named_shadows_request(thing_name, None)
+    named_shadow_list, next_token, timestamp = await list_named_shadows_request_async(thing_name, None)
     shadow_list.extend(named_shadow_list)
     while next_token != None:
-        named_shadow_list, next_token, timestamp = list_named_shadows_request(thing_name, next_token)
+        named_shadow_list, next_token, timestamp = await list_named_shadows_request_async(thing_name, next_token)
         shadow_list.extend(named_shadow_list)
 
-    #Now subscribe to the deltas for every shadow 
-    for shadow in named_shadow_list:
+    for shadow in shadow_list:
         #delete all shadows
-        delete_named_shadow_request(thing_name, shadow)
+        await delete_named_shadow_request_async(thing_name, shadow)
 
 
 async def mainLoopTask(ws:ClientWebSocketResponse):
@@ -849,13 +941,15 @@ async def mainLoopTask(ws:ClientWebSocketResponse):
         mqttLoop = asyncio.get_event_loop()
         # Setup the MQTT Subscription
         handler = StreamHandler(mqttLoop)
-        subscribeToTopic(REQUEST_TOPIC, handler)
+        await subscribeToTopic(REQUEST_TOPIC, handler)
 
         #Remove all the named shadows at start up
         #If nodes exists they will be repopulated
         if CLEAN:
-            delete_all_shadows(THING_NAME)
-            shadow_subscriptions = []
+            await delete_all_shadows(THING_NAME)
+
+        #Subscribe to the deltas of all the node shadows
+        await subscribe_to_shadow_deltas(THING_NAME, mqttLoop)
 
 
     lPrint('------------------------run-------------------')
@@ -873,13 +967,13 @@ async def mainLoopTask(ws:ClientWebSocketResponse):
 
 async def websocketListenTask(ws):
     try:
-        rand_message_id = str(random.randint(1, 9999999) )
+        new_message_id = next_message_id()
         message_object = {
-            "message_id": rand_message_id,
+            "message_id": new_message_id,
             "command": "start_listening"
         }
         
-        await ws.send_str(json.dumps(message_object))
+        await jsonCodec.send_text(ws, jsonCodec.dumpb(message_object))
     except:
         lPrint("Connect Listening Set Up Error")
 
@@ -888,7 +982,7 @@ async def websocketListenTask(ws):
         async for msg in ws:
 
             if msg.type == aiohttp.WSMsgType.TEXT:
-                message_response = msg.json()
+                message_response = jsonCodec.loads(msg.data)
                 # Here we will look for the type of message (event,message response or start up message)
                 #lPrint(message_response)
 
@@ -902,23 +996,34 @@ async def websocketListenTask(ws):
 
                 elif "error_code" in message_response:
                     lPrint(message_response["details"])
+                    pacer.on_reply(message_response.get("message_id"), error=True)
+                    correlator.resolve(message_response.get("message_id"), message_response)
+                    callbacks_per_message_id.pop(message_response.get("message_id")) #no callback on an error
                 
+                elif ("message_id" in message_response
+                    and correlator.resolve_request(message_response["message_id"], message_response)):
+                    #This is the reply to a request made through the REST API
+                    #which has been handed back to the request waiting on it
+                    pacer.on_reply(message_response["message_id"])
+
                 elif "message_id" in message_response:
                     #when we get a message_id it could be 1 of 3 things:
                     #1. If could be a simple acknowledge of a message request with no results (type None)
                     #2. It could be a response giving the latest attributes for a single node (results is a dict not a list)
                     #3. It could be a response giving the latest attributes for all nodes (results is a list)
                     #4. Finally it could be a result from a command that is return results non related to nodes such as a open commissioning window request
-                    lPrint("message_id:" + message_response["message_id"])
+                    logger.debug("matter server reply", message_id=message_response["message_id"])
+                    pacer.on_reply(message_response["message_id"])
+                    correlator.resolve(message_response["message_id"], message_response)
                     #lPrint("message_response")
                     #lPrint(message_response)
 
                     #We will now execute any callbacks
-                    if message_response["message_id"] in callbacks_per_message_id:
+                    callback = callbacks_per_message_id.pop(message_response["message_id"]) #remove the callback
+                    if callback is not None:
                         event_loop = asyncio.get_event_loop()
-                        node_id, cb_function = callbacks_per_message_id[message_response["message_id"]]
-                        cb_function(event_loop, node_id, message_response)
-                        callbacks_per_message_id.pop(message_response["message_id"]) #remove the callback
+                        node_id, cb_function = callback
+                        await cb_function(event_loop, node_id, message_response)
 
                     #check that we have results before processing them
                     if (not isinstance(message_response["result"], type(None))):
@@ -927,28 +1032,27 @@ async def websocketListenTask(ws):
                         #Check if the results are for a single True or Fase
                         if isinstance(results, bool):
                             #if we got a single then go here
-                            lPrint("Message Response with single attribute")
+                            logger.debug("Message Response with single attribute")
 
                         #Check if the results are for a single node (dict) or
                         #list of nodes (array)
                         elif isinstance(results, dict):
                             #if we got a single then go here
-                            lPrint("Message Response with single node update")
+                            logger.debug("Message Response with single node update")
                             #Update the node shadows
                             await OnNodeChange(results["node_id"], results)
                         elif (isinstance(results, list) and (len(results) > 0) and ("commissioning_mode" in results[0])):
-                            lPrint("Message Response with discovery of commissionable nodes")
+                            logger.debug("Message Response with discovery of commissionable nodes")
                             #Here we are dealing with a commissioning response
-                            commissionableNodesJsonStr = json.dumps(results)    
+                            payload = jsonCodec.dumpb({"state": {"reported": {"list": results}}})
 
-                            lPrint('{"state": {"reported": { "list": '+commissionableNodesJsonStr+' }}}')
+                            logger.payload("commissionable nodes", payload)
                             if not LOCAL_TEST:
                                 #set the device shadow for commissionableNodes
                                 shadowName = "commissionables"
                                 thingName = args.name
-                                newStr = '{"state": {"reported": { "list": '+commissionableNodesJsonStr+' }}}'
-                                #lPrint(newStr)
-                                update_thing_shadow_request(thingName, shadowName, bytes(newStr, "utf-8"))
+                                #lPrint(payload)
+                                await write_shadow_if_changed(thingName, shadowName, payload)
                             else:
                                 pass
                         else:
@@ -957,27 +1061,29 @@ async def websocketListenTask(ws):
                                 if isinstance(result, dict):
                                     if "node_id" in result:
                                         #Here we are dealing with an update on all the node
-                                        lPrint("Message Response with nodes update")
+                                        logger.debug("Message Response with nodes update")
                                         
                                         #Update the node shadows
                                         await OnNodeChange(result["node_id"], result)
 
                                     elif "Path" in result:
                                         #Here we are dealing with an update on all the node
-                                        lPrint("Message Response with path attribute updates")
+                                        logger.debug("Message Response with path attribute updates")
                                         pass
                                 else:
                                     #Here we are dealing with a response such as opening commission
-                                    lPrint("Message Response with other result")
+                                    logger.debug("Message Response with other result")
                                     pass
 
                 elif "event" in message_response:
                     #lPrint(json.dumps(message_response))
+                    #Journal the whole event before it is trimmed for the events shadow
+                    event_journal.append(message_response)
                     if (message_response["event"] == 'node_removed'):
                         #if we have removed a node we need to delete the associated shadows
                         node_id = message_response["data"]
-                        lPrint("we have removed a node")
-                        lPrint(node_id)
+                        node_store.remove_node(node_id)
+                        lPrint("node removed", node_id=node_id)
                         pass
                     elif (message_response["event"] == 'node_added' 
                         or message_response["event"] == 'node_updated'
@@ -988,30 +1094,42 @@ async def websocketListenTask(ws):
                         if "data" in message_response['data']:
                             message_response['data'].pop('data') #Get rid of the data data as its too big for events shadow
 
+                    elif (message_response["event"] == 'attribute_updated'
+                        and node_store.has_node(message_response["data"][0])):
+                        #This is an attribute change event for a node we mirror so
+                        #we apply it in place and only update the changed endpoint
+                        node_id, attribute_path, value = message_response["data"]
+                        if (attribute_projection.allows(attribute_path, value)
+                            and node_store.apply_attribute_update(node_id, attribute_path, value) is not None):
+                            if shadow_splitter.observe_change(attribute_path):
+                                shadow_splitter.mark_static_dirty(str(node_id) + "_" + str(endpointOfPath(attribute_path)))
+                            await OnNodeAttributesChange(node_id)
+
                     else:
-                        #This is an attribute change event so we will force
-                        #an update of the node shadows by calling get_nodes
-                        #which will force the node shadows to be updated when 
+                        #This is an attribute change event for a node we dont have
+                        #yet so we will force a resync of the node shadows by calling
+                        #get_node which will force the node shadows to be updated when 
                         #the response is received back
                         node_id = message_response["data"][0]
-                        rand_message_id = str(random.randint(1, 9999999) )
+                        new_message_id = next_message_id()
                         message_object = {
-                            "message_id": rand_message_id,
+                            "message_id": new_message_id,
                             "command": "get_node",
                             "args": {
                                 "node_id": node_id
                             }
                         }
-                        # add to the queue
-                        await queue.put(json.dumps(message_object))
-                    OnEventChange(node_id, message_response)
+                        # add to the queue without waiting, the reader has to
+                        # keep reading the replies that free the queue
+                        reader_feeder.put(MatterCommand(message_object), LANE_BACKGROUND, key=("get_node", node_id))
+                    await OnEventChange(node_id, message_response)
 
                 else:
-                    lPrint("*****************Unknown/Unhandled message:")
-                    lPrint(message_response)
+                    logger.warning("unhandled message from the matter server", keys=",".join(message_response))
+                    logger.payload("unhandled message", message_response)
                     pass
-            # simulate i/o operation using sleep
-            await asyncio.sleep(random.random())
+            # let the other tasks run between messages
+            await asyncio.sleep(0)
     except:
         lPrint("Connection is Closed")
         await ws.close()
@@ -1023,6 +1141,54 @@ async def close(ws):
     await ws.close()
 
 
+#Send a batched write_attributes command. The python matter server writes one
+#attribute per command so the writes are sent back to back as a single paced
+#interaction and their replies are gathered into one result
+async def sendWriteAttributes(ws, item):
+    await pacer.wait()
+    pacer.on_send(item.message_id)
+
+    replies = {}
+    for attribute_path, value in item.args["attributes"].items():
+        write_message_id = next_message_id()
+        await correlator.acquire()
+        replies[attribute_path] = correlator.register(write_message_id, "write_attribute",
+                                                      asyncio.get_running_loop().create_future())
+        await jsonCodec.send_text(ws, jsonCodec.dumpb({
+            "message_id": write_message_id,
+            "command": "write_attribute",
+            "args": {"node_id": item.args["node_id"], "attribute_path": attribute_path, "value": value}
+        }))
+
+    asyncio.create_task(writeAttributesResult(item, replies))
+
+async def writeAttributesResult(item, replies):
+    results = await asyncio.gather(*replies.values(), return_exceptions=True)
+    written = []
+    failed = {}
+    for attribute_path, reply in zip(replies, results):
+        if isinstance(reply, Exception):
+            failed[attribute_path] = str(reply)
+        elif "error_code" in reply:
+            failed[attribute_path] = reply.get("details")
+        else:
+            written.append(attribute_path)
+
+    pacer.on_reply(item.message_id, error=bool(failed))
+    lPrint("write_attributes done", message_id=item.message_id, node_id=item.args['node_id'],
+           endpoint_id=item.args['endpoint_id'], written=len(written), failed=len(failed))
+
+    if item.reply is not None and not item.reply.done():
+        item.reply.set_result({
+            "message_id": item.message_id,
+            "result": {
+                "node_id": item.args["node_id"],
+                "endpoint_id": item.args["endpoint_id"],
+                "written": written,
+                "failed": failed
+            }
+        })
+
 async def queueListenTask(ws):
     lPrint('queueListen: Running')
 
@@ -1034,20 +1200,25 @@ async def queueListenTask(ws):
             break
         # report
         try:
-            #First we will route the message in case we need to process it later
-            if message_router(json.loads(item)):
-                await ws.send_str(item)
+            #First we will route the command in case we need to process it later
+            #This is the only place a command is routed and encoded
+            #Commands are pipelined, we only wait for a free slot in the
+            #in-flight window rather than for the reply of this command
+            if item.command == "write_attributes":
+                await sendWriteAttributes(ws, item)
+            elif message_router(item.message):
+                await correlator.acquire()
+                correlator.register(item.message_id, item.command, item.reply)
+                await pacer.wait()
+                pacer.on_send(item.message_id)
+                await jsonCodec.send_text(ws, item.to_json())
         except Exception as e:
-            lPrint("Caught an exception sending item and now exiting:")
-            lPrint(e)
+            logger.exception("Caught an exception sending item", message_id=item.message_id, command=item.command)
             #sys.exit(0)
 
         # Notify the queue that the "work item" has been processed.
         queue.task_done()
 
-        # simulate i/o operation using sleep
-        await asyncio.sleep(random.random())
-
     # all done
     lPrint('queueListen: Done')
 
@@ -1057,11 +1228,34 @@ async def webserverTask():
         # set up the local REST API server
         rest_handler = RestHandler()
         shadow_functions = {
-            "get_thing_shadow_request":get_thing_shadow_request,
-            "list_named_shadows_request":list_named_shadows_request,
-            "delete_named_shadow_request":delete_named_shadow_request
+            "get_thing_shadow_request":get_thing_shadow_request_async,
+            "list_named_shadows_request":list_named_shadows_request_async,
+            "delete_named_shadow_request":delete_named_shadow_request_async
         }
-        app = await rest_handler.initialization(queue, URL, shadow_functions, message_router)
+        metrics_functions = {
+            "queue":queue.stats,
+            "reader_feeder":reader_feeder.stats,
+            "pacer":pacer.stats,
+            "correlator":correlator.stats,
+            "callbacks":callbacks_per_message_id.stats,
+            "node_store":node_store.stats,
+            "shadow_flusher":shadow_flusher.stats,
+            "node_events":node_events.stats,
+            "event_flusher":event_flusher.stats,
+            "shadow_fingerprints":shadow_fingerprints.stats,
+            "shadow_cache":shadow_cache.stats,
+            "shadow_sharder":shadow_sharder.stats,
+            "shadow_splitter":shadow_splitter.stats,
+            "attribute_projection":attribute_projection.stats,
+            "reported_states":reported_states.stats,
+            "event_journal":event_journal.stats,
+            "logger":logger.stats,
+            "webhooks":webhooks.stats,
+            "enqueue_drops":lambda: dict(enqueue_drops)
+        }
+        if not LOCAL_TEST:
+            metrics_functions["ipc"] = ipc_client.stats
+        app = await rest_handler.initialization(queue, shadow_functions, matter_request, metrics_functions, event_journal.query)
         runner = aiohttp.web.AppRunner(app)
         await runner.setup()
         site = aiohttp.web.TCPSite(runner)    
@@ -1080,6 +1274,7 @@ def websocketClosedCB(_fut):
     [task.cancel() for task in tasks]
 
     lPrint(f"Cancelling {len(tasks)} outstanding tasks")
+    correlator.cancel_all() # no replies will come for the commands in flight
     sleeps.cancel() # cancel all running sleep tasks
 
 async def monitorTasks():
@@ -1090,6 +1285,8 @@ async def monitorTasks():
                 if t is not asyncio.current_task()
             ]
             [t.print_stack(limit=5) for t in tasks]
+            lPrint(queue.stats())
+            lPrint(pacer.stats())
         await asyncio.sleep(2)
 
 def startUpMatterServer():
@@ -1131,6 +1328,10 @@ def startUpMatterServer():
             lPrint("The process is running.")
 
 async def main(retryCount):
+    global event_journal
+    if event_journal is None:
+        event_journal = EventJournal(args.journal_dir, segment_size=args.journal_segment_size,
+                                     max_segments=args.journal_segments, flush_interval=args.journal_flush_interval)
 
     try:
         # Lets first try to open the websocket as it might already be running via another docker container
@@ -1142,6 +1343,11 @@ async def main(retryCount):
             # 1 - the webserver task
             webserver_task = asyncio.create_task(webserverTask())
 
+            #The events shadows are loaded before the listener starts, an event
+            #seen first would otherwise stop the node's history being loaded
+            if not LOCAL_TEST and not CLEAN and not node_events.seeded:
+                await seed_node_events(THING_NAME)
+
             # 2 - the websocket listener task
             ws_listen_task = asyncio.create_task(websocketListenTask(ws))
             ws_listen_task.add_done_callback(websocketClosedCB)
@@ -1198,15 +1404,26 @@ async def main(retryCount):
         
 
 def exitGracefully():
-    # To stop subscribing, close the operation stream.
+    # To stop subscribing, close the operation streams with the connection.
     if not LOCAL_TEST:
-        operation.close()
+        ipc_client.close()
+    if event_journal is not None:
+        event_journal.close()
     lPrint("exiting gracefully")
+    logger.shutdown()
+
+
+async def runDaemon():
+    try:
+        await main(0)
+    finally:
+        #Close the pooled webhook connections while the loop is still running
+        await webhooks.close()
 
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main(0))
+        asyncio.run(runDaemon())
     except KeyboardInterrupt:
         pass
     finally:
@@ -1,11 +1,10 @@
-import aiohttp
+import asyncio
 from aiohttp import web
-import json 
+import jsonCodec
 import time
 
+from matterCommand import MatterCommand, CommandError, commandResponse, MSG_INVALID_JSON
 
-MSG_MISSING_ATTRIBUTE = "The attributes 'message_id' and/or 'command' missing from request"
-MSG_INVALID_JSON = "Request message was not a valid JSON object"
 
 class RestHandler():
     routes = web.RouteTableDef()
@@ -13,13 +12,14 @@ class RestHandler():
     def __init__(self):
         pass
 
-    async def initialization(self, queue, url, shadow_functions, message_router):
+    async def initialization(self, queue, shadow_functions, matter_request, metrics_functions=None, query_events=None):
         app = web.Application()
         app.add_routes(self.routes)
         app['queue'] = queue
-        app['url'] = url
+        app['matter_request'] = matter_request
         app['shadow_functions'] = shadow_functions
-        app['message_router'] = message_router
+        app['metrics_functions'] = metrics_functions if metrics_functions is not None else {}
+        app['query_events'] = query_events
         
         return app
 
@@ -30,110 +30,93 @@ class RestHandler():
     #######################################################################################
     @routes.get('/nodes')
     async def return_nodes(request):
-        url = request.app['url']
+        #The request is sent over the daemon's websocket connection to the
+        #matter server and the reply is matched to it by message_id
+        matter_request = request.app['matter_request']
 
         resp = {}
         resp["response"] = "OK"
         resp["return_code"] = 200
         message_object = {
-                "message_id": "5",
                 "command": "get_nodes"
             }
 
-        session = aiohttp.ClientSession()
-        async with session.ws_connect(url) as ws:
-
-            await ws.send_json(message_object)
-
-            async for msg in ws:
-                if msg.type in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
-                    message_respone = json.loads(msg.data)
-                    #We are looking for the result
-                    if "result" in message_respone:
-                        await session.close()
-                        return web.json_response(message_respone["result"])
-                        break
-                        
-
-                if msg.type in (aiohttp.WSMsgType.CLOSED,
-                                aiohttp.WSMsgType.ERROR):
-                    resp["response"] = "SERVER ERROR"
-                    resp["return_code"] = 500
+        try:
+            message_respone = await matter_request(message_object)
+            #We are looking for the result
+            if "result" in message_respone:
+                return jsonCodec.json_response(message_respone["result"])
+            resp["response"] = message_respone.get("details", "SERVER ERROR")
+            resp["return_code"] = 500
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            resp["response"] = "SERVER ERROR"
+            resp["return_code"] = 500
 
         response_message = {
             "message": "nodes",
             "response": resp["response"],
             "return_code": resp["return_code"]
             }
-        await session.close()
-        return web.json_response(response_message)
+        return jsonCodec.json_response(response_message)
+
+
+    @routes.get('/metrics')
+    async def return_metrics(request):
+        metrics_functions = request.app['metrics_functions']
+
+        result = {name: metrics_function() for name, metrics_function in metrics_functions.items()}
+        result["timestamp"] = time.time()
+
+        return jsonCodec.json_response(result)
+
+
+    #Events from the local event journal, e.g. /events?node_id=1&start=1700000000&end=1700003600&limit=100
+    #start and end are epoch seconds, when there are more events than the limit
+    #next_start is the start to ask for the next page with
+    @routes.get('/events')
+    async def return_events(request):
+        query_events = request.app['query_events']
+        if query_events is None:
+            return jsonCodec.json_response({"response": "Event journal not enabled", "return_code": 404}, status=404)
+
+        try:
+            node_id = request.query.get('node_id')
+            node_id = int(node_id) if node_id is not None else None
+            start = request.query.get('start')
+            start = float(start) if start is not None else None
+            end = request.query.get('end')
+            end = float(end) if end is not None else None
+            limit = int(request.query.get('limit', 100))
+        except ValueError:
+            return jsonCodec.json_response({"response": "node_id, start, end and limit must be numbers", "return_code": 400}, status=400)
+
+        records, next_start = query_events(node_id=node_id, start=start, end=end, limit=limit)
+
+        response_message = {
+            "events": [{"timestamp": record["t"], "node_id": record["n"], "event": record["e"], "message": record["m"]} for record in records],
+            "count": len(records),
+            "next_start": next_start
+        }
+        return jsonCodec.json_response(response_message)
 
 
     #Respond to a http REST message
     @routes.get('/chip-request')
     async def return_command(request):
         queue = request.app['queue']
-        message_router = request.app['message_router']
 
         json_str = request.rel_url.query.get('json', '')
 
-        resp = {}
-        resp["return_code"] = 200
-        resp["response"] = ""
-
         # validate message and attributes
         try:
-            message_from_rest = json.loads(json_str)
-
-            # Verify required keys are provided
-            if not all(k in message_from_rest for k in ("message_id", "command")):
-                resp["response"] = MSG_MISSING_ATTRIBUTE
-                resp["return_code"] = 255
-                response_message = {
-                    "message": str(json_str),
-                    "response": resp["response"],
-                    "return_code": resp["return_code"]
-                    }
-                #lPrint(f"{MSG_MISSING_ATTRIBUTE} for message")
-                return web.json_response(response_message)
-            
-        except json.JSONDecodeError as e:
-            resp["response"] = MSG_INVALID_JSON
-            resp["return_code"] = 255
-            response_message = {
-                "timestamp": int(round(time.time() * 1000)),
-                "message": str(json_str),
-                "response": resp["response"],
-                "return_code": resp["return_code"]
-                }
-            #lPrint(f"{MSG_INVALID_JSON} for message")
-            return web.json_response(response_message)
-        except Exception as e:
-            raise
-        
-        command = message_from_rest["command"]
-        command = command.lstrip()
-
-        nodeId = None
-        resp["response"] = "accepted"
-        resp["return_code"] = 200
-        resp["message_id"] = message_from_rest["message_id"]
+            command = MatterCommand.from_json(json_str)
+        except CommandError as e:
+            return jsonCodec.json_response(commandResponse(json_str, e.response, 255))
 
-        message_router(message_from_rest)
+        # add to the queue, the command is routed when it is taken off the queue
+        await queue.put(command)
 
-        # add to the queue
-        await queue.put(json_str)
-
-        # Dummy response message
-        response_message = {
-            "timestamp": int(round(time.time() * 1000)),
-            "message": str(json_str),
-            "message_id": str(resp["message_id"]),
-            "response": resp["response"],
-            "return_code": resp["return_code"]
-            }
-
-        return web.json_response(response_message)
+        return jsonCodec.json_response(commandResponse(json_str, "accepted", 200, command.message_id))
 
 
     @routes.get('/api/things/shadow/ListNamedShadowsForThing/{name}')
@@ -148,11 +131,11 @@ class RestHandler():
         shadow_list = []
         next_token = None
 
-        named_shadow_list, next_token, timestamp = list_named_shadows_request(thing_name, next_token)
+        named_shadow_list, next_token, timestamp = await list_named_shadows_request(thing_name, next_token)
         shadow_list.extend(named_shadow_list)
 
         while next_token != None:
-            named_shadow_list, next_token, timestamp = list_named_shadows_request(thing_name, next_token)
+            named_shadow_list, next_token, timestamp = await list_named_shadows_request(thing_name, next_token)
             shadow_list.extend(named_shadow_list)
 
         result = {
@@ -160,7 +143,7 @@ class RestHandler():
             "timestamp": time.time()
         }
 
-        return web.json_response(result)
+        return jsonCodec.json_response(result)
 
 
 
@@ -171,7 +154,7 @@ class RestHandler():
         thing_name = request.match_info['name'] 
         shadow_name = request.match_info['shadow'] 
 
-        response_message = get_thing_shadow_request(thing_name, shadow_name)
+        response_message = await get_thing_shadow_request(thing_name, shadow_name)
 
         resp = {}
         resp["response"] = "OK"
@@ -181,9 +164,9 @@ class RestHandler():
             #List is empty. No JSON to parse
             response = response_message
         else:
-            response = json.loads(response_message)
+            response = jsonCodec.loads(response_message)
 
-        return web.json_response(response)
+        return jsonCodec.json_response(response)
 
     @routes.get('/deleteshadow/{name}/{shadow}')
     async def return_named_shadow(request):
@@ -192,7 +175,7 @@ class RestHandler():
         thing_name = request.match_info['name'] 
         shadow_name = request.match_info['shadow'] 
 
-        response_message = delete_named_shadow_request(thing_name, shadow_name)
+        response_message = await delete_named_shadow_request(thing_name, shadow_name)
         resp = {}
         resp["response"] = "OK"
         resp["return_code"] = 200
@@ -202,72 +185,31 @@ class RestHandler():
             "response": resp["response"],
             "return_code": resp["return_code"]
             }
-        return web.json_response(response_message)
+        return jsonCodec.json_response(response_message)
 
     #Respond to a http POST REST message
     @routes.post('/message/chip/request')
     async def return_chip_request(request):
         queue = request.app['queue']
-        message_router = request.app['message_router']
-        json_str = "{}"
+        body = b"{}"
         if request.body_exists:
-            bytes_value = await request.read()
-            json_str = bytes_value.decode('utf8').replace("'", '"')
+            body = await request.read()
+        json_str = body.decode('utf8', 'replace')
 
-        resp = {}
-        resp["return_code"] = 200
-        resp["response"] = ""
-
-        # validate message and attributes
+        # validate message and attributes, the body is tried as JSON first and
+        # only a body that is not JSON gets the single quotes some clients send
+        # replaced, so quotes inside the strings of valid JSON are left alone
         try:
-            message_from_rest = json.loads(json_str)
-
-            # Verify required keys are provided
-            if not all(k in message_from_rest for k in ("message_id", "command")):
-                resp["response"] = MSG_MISSING_ATTRIBUTE
-                resp["return_code"] = 255
-                response_message = {
-                    "message": str(json_str),
-                    "response": resp["response"],
-                    "return_code": resp["return_code"]
-                    }
-                #lPrint(f"{MSG_MISSING_ATTRIBUTE} for message")
-                return web.json_response(response_message)
-            
-        except json.JSONDecodeError as e:
-            resp["response"] = MSG_INVALID_JSON
-            resp["return_code"] = 255
-            response_message = {
-                "timestamp": int(round(time.time() * 1000)),
-                "message": str(json_str),
-                "response": resp["response"],
-                "return_code": resp["return_code"]
-                }
-            #lPrint(f"{MSG_INVALID_JSON} for message")
-            return web.json_response(response_message)
-        except Exception as e:
-            raise
-        
-        command = message_from_rest["command"]
-        command = command.lstrip()
-
-        nodeId = None
-        resp["response"] = "accepted"
-        resp["return_code"] = 200
-        resp["message_id"] = message_from_rest["message_id"]
-
-        message_router(message_from_rest)
-
-        # add to the queue
-        await queue.put(json_str)
-
-        # Dummy response message
-        response_message = {
-            "timestamp": int(round(time.time() * 1000)),
-            "message": str(json_str),
-            "message_id": str(resp["message_id"]),
-            "response": resp["response"],
-            "return_code": resp["return_code"]
-            }
-
-        return web.json_response(response_message)
+            try:
+                command = MatterCommand.from_json(body)
+            except CommandError as e:
+                if e.response != MSG_INVALID_JSON:
+                    raise
+                command = MatterCommand.from_json(json_str.replace("'", '"'))
+        except CommandError as e:
+            return jsonCodec.json_response(commandResponse(json_str, e.response, 255))
+
+        # add to the queue, the command is routed when it is taken off the queue
+        await queue.put(command)
+
+        return jsonCodec.json_response(commandResponse(json_str, "accepted", 200, command.message_id))
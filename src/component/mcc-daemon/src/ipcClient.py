@@ -0,0 +1,219 @@
+#
+# Copyright (c) 2023 Matter Cloud Controller Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import asyncio
+import threading
+import time
+
+
+class OperationStats:
+    #Call count, failures and latency of one IPC operation
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, latency, failed):
+        self.calls += 1
+        if failed:
+            self.failures += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "avg_latency_ms": round(self.total_latency / self.calls * 1000, 3) if self.calls else 0.0,
+            "max_latency_ms": round(self.max_latency * 1000, 3)
+        }
+
+
+def closeStream(stream_operation):
+    if stream_operation is not None:
+        try:
+            stream_operation.close()
+        except Exception:
+            pass
+
+
+class ManagedIpcClient:
+    #Keeps one Greengrass IPC connection open and reuses it for every call.
+    #The connection is made on first use and is dropped and made again when a
+    #call fails on the connection itself (`connection_errors`), such as the
+    #connection being closed. An error returned by the IPC service or a call
+    #timing out only fails that one call.
+    #`connect` returns a GreengrassCoreIPCClientV2 and the operations are
+    #called through their *_async variants so the timeout can be enforced.
+    #call() blocks the calling thread, call_async() awaits the response of the
+    #operation without blocking the event loop (connecting, which blocks, is
+    #done on a worker thread) and send() does not wait at all.
+    #The subscriptions made with subscribe() go with the connection so they
+    #are made again on the new connection after a reconnect. There is one
+    #subscription per topic, subscribing to a topic again replaces it.
+    def __init__(self, connect, timeout=5, connection_errors=(ConnectionError,)):
+        self._connect = connect
+        self.timeout = timeout
+        self.connection_errors = connection_errors
+        self._client = None
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.reuses = 0
+        self.reconnects = 0
+        self.resubscribes = 0
+        self.subscriptions = {}  # topic -> [operation, kwargs, stream operation]
+        self.operations = {}  # operation name -> OperationStats
+
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = self._connect()
+                self.connects += 1
+                if self.connects > 1:
+                    self._resubscribe(self._client)
+            else:
+                self.reuses += 1
+            return self._client
+
+    def reset(self):
+        #Drop the connection so the next call makes a new one
+        with self._lock:
+            client, self._client = self._client, None
+        if client is not None:
+            self.reconnects += 1
+            try:
+                client.close()
+            except Exception:
+                pass
+
+    def start(self, operation, **kwargs):
+        #Start an operation and return its concurrent.futures.Future
+        return getattr(self.client(), operation + "_async")(**kwargs)
+
+    def _failed(self, error):
+        #Drop the connection when the error came from the connection itself
+        if isinstance(error, self.connection_errors):
+            self.reset()
+
+    def _resubscribe(self, client):
+        #Called with the lock held on a new connection
+        for subscription in self.subscriptions.values():
+            operation, kwargs, _ = subscription
+            self.resubscribes += 1
+            try:
+                _, subscription[2] = getattr(client, operation + "_async")(**kwargs)
+            except Exception:
+                subscription[2] = None
+                self.operations.setdefault(operation, OperationStats()).record(0.0, True)
+
+    async def _connected(self):
+        if self._client is None:
+            await asyncio.get_running_loop().run_in_executor(None, self.client)
+
+    async def subscribe(self, operation, **kwargs):
+        #Open a stream operation and await it being accepted, it is opened
+        #again whenever the connection is made again
+        topic = kwargs.get("topic_name")
+        previous = self.subscriptions.pop(topic, None)
+        if previous is not None:
+            closeStream(previous[2])
+        subscription = self.subscriptions[topic] = [operation, kwargs, None]
+        start = time.monotonic()
+        failed = True
+        try:
+            await self._connected()
+            future, subscription[2] = self.start(operation, **kwargs)
+            await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+            failed = False
+            return subscription[2]
+        except Exception as e:
+            self._failed(e)
+            raise
+        finally:
+            self.operations.setdefault(operation, OperationStats()).record(time.monotonic() - start, failed)
+
+    def send(self, operation, **kwargs):
+        #Start an operation without waiting for its response, a failure is
+        #only counted (and drops the connection) once the response arrives
+        start = time.monotonic()
+
+        def done(future):
+            error = future.exception()
+            self.operations.setdefault(operation, OperationStats()).record(time.monotonic() - start, error is not None)
+            if error is not None:
+                self._failed(error)
+
+        try:
+            self.start(operation, **kwargs).add_done_callback(done)
+        except Exception as e:
+            self.operations.setdefault(operation, OperationStats()).record(time.monotonic() - start, True)
+            self._failed(e)
+            raise
+
+    def call(self, operation, **kwargs):
+        #Run an operation and wait up to the timeout for its response
+        start = time.monotonic()
+        failed = True
+        future = None
+        try:
+            future = self.start(operation, **kwargs)
+            result = future.result(self.timeout)
+            failed = False
+            return result
+        except Exception as e:
+            if future is not None:
+                future.cancel()
+            self._failed(e)
+            raise
+        finally:
+            self.operations.setdefault(operation, OperationStats()).record(time.monotonic() - start, failed)
+
+    async def call_async(self, operation, **kwargs):
+        #Run an operation from the event loop and await its response
+        start = time.monotonic()
+        failed = True
+        try:
+            await self._connected()
+            future = asyncio.wrap_future(self.start(operation, **kwargs))
+            result = await asyncio.wait_for(future, self.timeout)
+            failed = False
+            return result
+        except Exception as e:
+            self._failed(e)
+            raise
+        finally:
+            self.operations.setdefault(operation, OperationStats()).record(time.monotonic() - start, failed)
+
+    def close(self):
+        #Close the subscriptions and the connection
+        for subscription in self.subscriptions.values():
+            closeStream(subscription[2])
+        self.subscriptions = {}
+        with self._lock:
+            client, self._client = self._client, None
+        if client is not None:
+            client.close()
+
+    def stats(self):
+        return {
+            "connected": self._client is not None,
+            "connects": self.connects,
+            "reuses": self.reuses,
+            "reconnects": self.reconnects,
+            "subscriptions": len(self.subscriptions),
+            "resubscribes": self.resubscribes,
+            "operations": {operation: operation_stats.stats() for operation, operation_stats in self.operations.items()}
+        }
@@ -0,0 +1,68 @@
+#
+# Copyright (c) 2023 Matter Cloud Controller Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+
+from aiohttp import web, WSMsgType
+
+#The JSON encoding and decoding of the daemon. orjson is used when it is
+#installed and the standard library otherwise. Both produce compact JSON and
+#dumpb() gives UTF-8 bytes that can go straight into an IPC payload or a
+#websocket frame without a str round trip.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+#orjson.JSONDecodeError is a subclass of json.JSONDecodeError
+JSONDecodeError = json.JSONDecodeError
+
+if orjson is not None:
+    _OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def dumpb(obj):
+        return orjson.dumps(obj, option=_OPTIONS)
+
+    def dumps(obj):
+        return orjson.dumps(obj, option=_OPTIONS).decode("utf-8")
+
+    loads = orjson.loads
+else:
+    _encoder = json.JSONEncoder(separators=(",", ":"))
+
+    def dumpb(obj):
+        return _encoder.encode(obj).encode("utf-8")
+
+    def dumps(obj):
+        return _encoder.encode(obj)
+
+    def loads(data):
+        return json.loads(data)
+
+
+def json_response(data, status=200):
+    #aiohttp's web.json_response with the body encoded by dumpb()
+    return web.Response(body=dumpb(data), status=status, content_type="application/json")
+
+
+async def send_text(ws, data):
+    #Send encoded JSON bytes as a websocket text frame, aiohttp versions
+    #before send_frame() need the text as a str
+    if hasattr(ws, "send_frame"):
+        await ws.send_frame(data, WSMsgType.TEXT)
+    else:
+        await ws.send_str(data.decode("utf-8"))
@@ -13,17 +13,196 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import logging
+import logging.handlers
 import os
+import queue
 import sys
+import time
 
-import logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-log_handler = logging.StreamHandler(sys.stdout)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-log_handler.setFormatter(formatter)
-logger.addHandler(log_handler)
+import jsonCodec
+
+#The logging of the daemon. Records are put on a queue by the callers and
+#formatted and written by a listener thread so the event loop and the IPC
+#threads never wait on the console or on stdout. Every call is:
+#  - lazy, the level is checked before anything else and the message is only
+#    formatted with its %-style args by the listener. The args must not be
+#    changed after the call, pass plain values rather than live documents
+#  - rate limited per call site (file and line) with a token bucket of `rate`
+#    records a second and `burst` records, a record after suppressed ones
+#    carries suppressed=<count>. Warnings and errors are never rate limited
+#    so the line that matters is not lost in a burst of failures
+#  - optionally sampled, sample=N logs one call in N of that call site
+#  - structured, keyword arguments are written as key=value after the message
+#Whole JSON payloads are only logged by payload() at debug level and when the
+#payload switch is on.
+
+QUEUE_SIZE = 10000
+
+_logger = logging.getLogger("mcc")
+_level = logging.INFO
+_rate = 10.0
+_burst = 20.0
+_debug_payloads = False
+_listener = None
+
+_sites = {}  # (code, line) -> [tokens, last time, calls, suppressed since last record]
+emitted = 0
+suppressed = 0
+sampled_out = 0
+dropped = 0
+
+
+class KeyValueFormatter(logging.Formatter):
+    #Appends the structured fields of a record as key=value
+    def formatMessage(self, record):
+        message = super().formatMessage(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            message += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return message
+
+
+class ConsoleHandler(logging.Handler):
+    #Pretty prints to a rich Console, used when testing locally
+    def __init__(self, console):
+        super().__init__()
+        self.console = console
+
+    def emit(self, record):
+        try:
+            self.console.print(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    #The standard QueueHandler formats the message in the calling thread, here
+    #it is left to the listener. Only a traceback is rendered before the
+    #record is queued as it cannot be formatted later
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        global dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped += 1
+
+
+def setup(level="info", console=None, rate=10.0, burst=20, debug_payloads=False):
+    #Send all logging (ours and the libraries') through the queue, returns the
+    #listener that writes the records
+    global _level, _rate, _burst, _debug_payloads, _listener
+    _level = logging.getLevelName(level.upper()) if isinstance(level, str) else level
+    _rate = float(rate)
+    _burst = float(max(burst, 1))
+    _debug_payloads = debug_payloads
+
+    formatter = KeyValueFormatter('%(asctime)s - %(levelname)s - %(message)s')
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if console is not None:
+        handlers.append(ConsoleHandler(console))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(LazyQueueHandler(queue.Queue(QUEUE_SIZE)))
+    root.setLevel(_level)
+
+    _listener = logging.handlers.QueueListener(root.handlers[0].queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def shutdown():
+    #Write out the records still on the queue
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _allow(site, sample, limited=True):
+    global suppressed, sampled_out
+    state = _sites.get(site)
+    now = time.monotonic()
+    if state is None:
+        state = _sites[site] = [_burst, now, 0, 0]
+    state[2] += 1
+    if sample > 1 and (state[2] - 1) % sample:
+        sampled_out += 1
+        return None
+    if limited and _rate > 0:
+        state[0] = min(_burst, state[0] + (now - state[1]) * _rate)
+        state[1] = now
+        if state[0] < 1:
+            state[3] += 1
+            suppressed += 1
+            return None
+        state[0] -= 1
+    count = state[3]
+    state[3] = 0
+    return count
+
+
+def _log(level, msg, args, fields, sample=1, depth=2, exc_info=None):
+    global emitted
+    if level < _level:
+        return
+    frame = sys._getframe(depth)
+    count = _allow((frame.f_code, frame.f_lineno), sample, level < logging.WARNING)
+    if count is None:
+        return
+    if count:
+        fields["suppressed"] = count
+    emitted += 1
+    record = _logger.makeRecord(_logger.name, level, frame.f_code.co_filename, frame.f_lineno,
+                                msg, args, exc_info, frame.f_code.co_name, {"fields": fields})
+    _logger.handle(record)
+
+
+def debug(msg, *args, sample=1, depth=0, **fields):
+    _log(logging.DEBUG, msg, args, fields, sample, depth + 2)
+
+def info(msg, *args, sample=1, depth=0, **fields):
+    _log(logging.INFO, msg, args, fields, sample, depth + 2)
+
+def warning(msg, *args, sample=1, depth=0, **fields):
+    _log(logging.WARNING, msg, args, fields, sample, depth + 2)
+
+def error(msg, *args, sample=1, depth=0, **fields):
+    _log(logging.ERROR, msg, args, fields, sample, depth + 2)
+
+def exception(msg, *args, depth=0, **fields):
+    _log(logging.ERROR, msg, args, fields, 1, depth + 2, sys.exc_info())
+
+
+def payload(msg, data, depth=0, **fields):
+    #Log a whole JSON payload, only at debug level with the payload switch on.
+    #It is encoded straight away as the document may change after the call
+    if not _debug_payloads or logging.DEBUG < _level:
+        return
+    if not isinstance(data, (str, bytes)):
+        data = jsonCodec.dumpb(data)
+    if isinstance(data, bytes):
+        data = data.decode("utf-8", "replace")
+    _log(logging.DEBUG, "%s %s", (msg, data), fields, 1, depth + 2)
 
 
-def info(message: str):
-    logger.info(message)
+def stats():
+    busiest = sorted(((state[2], site) for site, state in _sites.items()), key=lambda call_site: -call_site[0])[:5]
+    return {
+        "emitted": emitted,
+        "suppressed": suppressed,
+        "sampled_out": sampled_out,
+        "dropped": dropped,
+        "queued": _listener.queue.qsize() if _listener is not None else 0,
+        "busiest_sites": {f"{os.path.basename(site[0].co_filename)}:{site[1]}": calls for calls, site in busiest}
+    }
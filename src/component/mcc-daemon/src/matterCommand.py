@@ -0,0 +1,194 @@
+#
+# Copyright (c) 2023 Matter Cloud Controller Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import sys
+import time
+
+import jsonCodec
+
+MSG_MISSING_ATTRIBUTE = "The attributes 'message_id' and/or 'command' missing from request"
+MSG_INVALID_JSON = "Request message was not a valid JSON object"
+
+ANY = None # an argument that can have any value
+
+
+class _NumericStringType(type):
+    def __instancecheck__(cls, value):
+        return isinstance(value, str) and value.strip().lstrip("-").isdigit()
+
+class NumericString(metaclass=_NumericStringType):
+    #A str holding an integer such as "1", isinstance() checks the value
+    type_name = "numeric str"
+
+#The ids were always forwarded as sent and clients send them as numbers or
+#as numeric strings, so both are accepted
+ID = (int, NumericString)
+
+#The fields and arguments of the commands that are checked before a command
+#is queued, name -> type or tuple of types. "fields" are at the top level of
+#the command and "args" in its args object, names ending in "?" are optional.
+#Commands that are not listed only get message_id and command checked so new
+#commands of the python matter server still pass through.
+COMMAND_SCHEMAS = {
+    "start_listening": {},
+    "get_nodes": {},
+    "discover": {},
+    "get_node": {"args": {"node_id": ID}},
+    "remove_node": {"args": {"node_id": ID}},
+    "interview_node": {"args": {"node_id": ID}},
+    "read_attribute": {"args": {"node_id": ID, "attribute_path": (str, list)}},
+    "subscribe_attribute": {"args": {"node_id": ID, "attribute_path": (str, list)}},
+    "write_attribute": {"args": {"node_id": ID, "attribute_path": str, "value": ANY, "endpoint_id?": ID}},
+    "write_attributes": {"args": {"node_id": ID, "endpoint_id": ID, "attributes": dict}},
+    "device_command": {"args": {"node_id": ID, "endpoint_id": ID, "cluster_id": ID, "command_name": str, "payload?": dict}},
+    "open_commissioning_window": {"args": {"node_id": ID, "timeout?": int, "iteration?": int, "option?": int, "discriminator?": int}},
+    "commission_with_code": {"args": {"code": str, "network_only?": bool}},
+    "commission_on_network": {"args": {"setup_pin_code": int, "filter_type?": int, "filter?": ANY}},
+    "set_wifi_credentials": {"args": {"ssid": str, "credentials": str}},
+    "set_thread_dataset": {"args": {"dataset": str}},
+    "call_webhook": {"fields": {"webhook_method": str, "webhook_url": str, "webhook_endpoint": str, "args": dict}}
+}
+
+
+class CommandError(ValueError):
+    #A command that is rejected before it is queued, `response` says why
+    def __init__(self, response):
+        super().__init__(response)
+        self.response = response
+
+
+def _typeName(types):
+    return " or ".join(getattr(t, "type_name", t.__name__) for t in types)
+
+def _compileSchema(command, schema):
+    #Turn a schema into a tuple of (in_args, name, types, required, error)
+    #checks so that validating a command is a single loop
+    checks = []
+    for in_args, section in ((False, "fields"), (True, "args")):
+        for name, types in schema.get(section, {}).items():
+            required = not name.endswith("?")
+            name = name.rstrip("?")
+            if types is not None and not isinstance(types, tuple):
+                types = (types,)
+            where = "args." + name if in_args else name
+            error = (f"{command} is missing {where}",
+                     f"{command} {where} must be {_typeName(types)}" if types is not None else None)
+            checks.append((in_args, name, types, required, error))
+    return tuple(checks)
+
+_COMMAND_CHECKS = {command: _compileSchema(command, schema) for command, schema in COMMAND_SCHEMAS.items()}
+
+def validateCommand(message):
+    #Check a decoded command in one pass, raises CommandError if it is malformed
+    if not isinstance(message, dict) or "message_id" not in message or "command" not in message:
+        raise CommandError(MSG_MISSING_ATTRIBUTE)
+    message_id = message["message_id"]
+    if not isinstance(message_id, (str, int)) or isinstance(message_id, bool):
+        raise CommandError("message_id must be str or int")
+    command = message["command"]
+    if not isinstance(command, str) or not command:
+        raise CommandError("command must be a non empty str")
+
+    checks = _COMMAND_CHECKS.get(command)
+    if checks is None:
+        return message
+    args = message.get("args", {})
+    if not isinstance(args, dict):
+        raise CommandError(f"{command} args must be an object")
+    for in_args, name, types, required, error in checks:
+        source = args if in_args else message
+        if name not in source:
+            if required:
+                raise CommandError(error[0])
+            continue
+        if types is not None:
+            value = source[name]
+            # bool is an int to isinstance
+            if not isinstance(value, types) or (value.__class__ is bool and bool not in types):
+                raise CommandError(error[1])
+    return message
+
+def commandResponse(message, response, return_code, message_id=None):
+    #The reply sent back to whoever sent a command, both when it is accepted
+    #and when it is rejected
+    response_message = {
+        "timestamp": int(round(time.time() * 1000)),
+        "message": str(message),
+        "response": response,
+        "return_code": return_code
+    }
+    if message_id is not None:
+        response_message["message_id"] = str(message_id)
+    return response_message
+
+
+class MatterCommand:
+    #A command on its way to the python matter server.
+    #The JSON is decoded once where the command enters the daemon (MQTT, REST,
+    #test file or generated internally) and encoded once when it is sent on
+    #the websocket. When the command arrived as JSON that text is sent as is.
+    #The encoded bytes are kept so sizing the command for the queue does not
+    #cost a second encode.
+    #`reply` is set to a future when the sender waits for the reply.
+    __slots__ = ("message", "raw", "reply", "_encoded", "_size")
+
+    def __init__(self, message, raw=None, reply=None):
+        self.message = message
+        self.raw = raw
+        self.reply = reply
+        self._encoded = raw.encode("utf-8") if isinstance(raw, str) else raw
+        self._size = None
+
+    @classmethod
+    def from_json(cls, raw, reply=None):
+        #Decode and validate a command, raises CommandError if raw is not
+        #valid JSON or not a valid command
+        try:
+            message = jsonCodec.loads(raw)
+        except jsonCodec.JSONDecodeError:
+            raise CommandError(MSG_INVALID_JSON)
+        return cls(validateCommand(message), raw, reply)
+
+    @classmethod
+    def from_message(cls, message, reply=None):
+        #Validate an already decoded command, raises CommandError
+        return cls(validateCommand(message), None, reply)
+
+    @property
+    def message_id(self):
+        return self.message.get("message_id")
+
+    @property
+    def command(self):
+        return self.message.get("command")
+
+    @property
+    def args(self):
+        return self.message.get("args", {})
+
+    @property
+    def payload_size(self):
+        if self._size is None:
+            self._size = sys.getsizeof(self.to_json())
+        return self._size
+
+    def to_json(self):
+        #The command as UTF-8 encoded JSON
+        if self._encoded is None:
+            self._encoded = jsonCodec.dumpb(self.message)
+        return self._encoded
+
+    def __repr__(self):
+        return f"MatterCommand({self.message_id}, {self.command})"
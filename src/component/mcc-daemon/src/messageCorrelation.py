@@ -0,0 +1,204 @@
+#
+# Copyright (c) 2023 Matter Cloud Controller Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import asyncio
+import collections
+import itertools
+import secrets
+
+# Commands that take longer than the default deadline on the python matter server
+COMMAND_TIMEOUTS = {
+    "commission_with_code": 180,
+    "commission_on_network": 180,
+    "open_commissioning_window": 60,
+    "discover": 60,
+    "remove_node": 60,
+    "interview_node": 120,
+    "get_nodes": 30
+}
+
+
+class MessageIdGenerator:
+    #Generates message ids that cannot collide with each other. The random
+    #prefix keeps them apart from the ids of commands sent by users and from
+    #the ids of a previous run of the daemon
+    def __init__(self, prefix=None):
+        self.prefix = prefix if prefix is not None else "mcc-" + secrets.token_hex(4)
+        self._counter = itertools.count(1)
+
+    def __call__(self):
+        return f"{self.prefix}-{next(self._counter)}"
+
+
+class CallbackRegistry:
+    #Holds the callbacks waiting for the reply to a message_id.
+    #Each entry has a deadline after which it is removed and its timeout
+    #callback is called. The registry is bounded, when it is full the oldest
+    #entry is evicted (and its timeout callback called) to make room.
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()  # message_id -> (node_id, callback, on_timeout, timer)
+        self.registered = 0
+        self.completed = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def register(self, message_id, node_id, callback, on_timeout=None, ttl=None):
+        loop = asyncio.get_running_loop()
+        if message_id in self._entries:
+            self._remove(message_id)
+        while len(self._entries) >= self.maxsize:
+            oldest_message_id = next(iter(self._entries))
+            self.evicted += 1
+            self._timeout(oldest_message_id)
+
+        timer = loop.call_later(self.ttl if ttl is None else ttl, self._expire, message_id)
+        self._entries[message_id] = (node_id, callback, on_timeout, timer)
+        self.registered += 1
+
+    def pop(self, message_id):
+        #Returns (node_id, callback) for the reply to message_id, or None
+        if message_id not in self._entries:
+            return None
+        node_id, callback, on_timeout, timer = self._remove(message_id)
+        self.completed += 1
+        return node_id, callback
+
+    def _expire(self, message_id):
+        if message_id in self._entries:
+            self.expired += 1
+            self._timeout(message_id)
+
+    def _timeout(self, message_id):
+        node_id, callback, on_timeout, timer = self._remove(message_id)
+        if on_timeout is not None:
+            on_timeout(message_id, node_id)
+
+    def _remove(self, message_id):
+        entry = self._entries.pop(message_id)
+        entry[3].cancel()
+        return entry
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, message_id):
+        return message_id in self._entries
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "registered": self.registered,
+            "completed": self.completed,
+            "expired": self.expired,
+            "evicted": self.evicted
+        }
+
+
+class CommandCorrelator:
+    #Matches the replies of the python matter server to the commands sent on
+    #the websocket by message_id. Up to `window` commands can be in flight at
+    #once, each command gets a deadline and commands that never get a reply
+    #are failed with asyncio.TimeoutError when their deadline passes.
+    def __init__(self, window=8, timeout=30, command_timeouts=None, on_timeout=None):
+        self.window = window
+        self.timeout = timeout
+        self.command_timeouts = COMMAND_TIMEOUTS if command_timeouts is None else command_timeouts
+        self.on_timeout = on_timeout
+        self._slots = asyncio.Semaphore(window)
+        self._pending = {}  # message_id -> (future, deadline timer handle, requested)
+        self.sent = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.replaced = 0
+
+    def command_timeout(self, command):
+        return self.command_timeouts.get(command, self.timeout)
+
+    async def acquire(self):
+        #Wait for a free slot in the in-flight window
+        await self._slots.acquire()
+
+    def register(self, message_id, command=None, future=None):
+        #Register a command that holds a window slot and is about to be sent.
+        #Returns a future that gets the reply message. A future can be passed
+        #in by a requester that is waiting for the reply, in which case the
+        #reply is handed to it by resolve_request()
+        loop = asyncio.get_running_loop()
+        if message_id in self._pending:
+            # the same message_id is already in flight, the older command
+            # can no longer be matched to its reply
+            self.replaced += 1
+            self._finish(message_id, exception=RuntimeError(f"message_id {message_id} was reused"))
+
+        requested = future is not None
+        if not requested:
+            future = loop.create_future()
+        timer = loop.call_later(self.command_timeout(command), self._expire, message_id)
+        self._pending[message_id] = (future, timer, requested)
+        self.sent += 1
+        return future
+
+    def resolve_request(self, message_id, message):
+        #Hand the reply to the requester waiting on it. Returns False if the
+        #command was not sent on behalf of a requester
+        if message_id not in self._pending or not self._pending[message_id][2]:
+            return False
+        return self.resolve(message_id, message)
+
+    def resolve(self, message_id, message):
+        #Called with every reply from the matter server. Returns True if the
+        #reply was for a command in flight
+        if message_id not in self._pending:
+            return False
+        self.completed += 1
+        self._finish(message_id, result=message)
+        return True
+
+    def _expire(self, message_id):
+        if message_id not in self._pending:
+            return
+        self.timeouts += 1
+        self._finish(message_id, exception=asyncio.TimeoutError(f"No reply for message_id {message_id}"))
+        if self.on_timeout is not None:
+            self.on_timeout(message_id)
+
+    def _finish(self, message_id, result=None, exception=None):
+        future, timer, requested = self._pending.pop(message_id)
+        timer.cancel()
+        if not future.done():
+            if exception is not None:
+                future.set_exception(exception)
+                future.exception() # nobody may be waiting on this future
+            else:
+                future.set_result(result)
+        self._slots.release()
+
+    def cancel_all(self):
+        #Fail every command in flight, used when the websocket is closed
+        for message_id in list(self._pending):
+            self._finish(message_id, exception=ConnectionError("Websocket closed"))
+
+    def stats(self):
+        return {
+            "in_flight": len(self._pending),
+            "window": self.window,
+            "sent": self.sent,
+            "completed": self.completed,
+            "timeouts": self.timeouts,
+            "replaced": self.replaced
+        }
@@ -0,0 +1,131 @@
+#
+# Copyright (c) 2023 Matter Cloud Controller Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import collections
+
+
+def endpointOfPath(attribute_path):
+    #attribute paths are "endpoint/cluster/attribute"
+    return int(attribute_path.split('/', 1)[0])
+
+
+class NodeStore:
+    #In memory mirror of the nodes known to the python matter server.
+    #A full node (from get_node/get_nodes) replaces the mirror of that node and
+    #attribute_updated events are applied to it in place. The attributes are
+    #held per endpoint and only the endpoints that changed are marked dirty so
+    #that only their shadows need to be rewritten.
+    def __init__(self):
+        self.nodes = {}       # node_id -> node details without the attributes
+        self.attributes = {}  # node_id -> endpoint -> attribute_path -> value
+        self.dirty = {}       # node_id -> set of dirty endpoints
+        self.full_updates = 0
+        self.attribute_updates = 0
+        self.unchanged_updates = 0
+
+    def has_node(self, node_id):
+        return node_id in self.nodes
+
+    def set_node(self, node_id, node_result):
+        #Replace the mirror of a node with a full node result.
+        #Every endpoint of the node is marked dirty
+        node = {key: value for key, value in node_result.items() if key != "attributes"}
+        endpoints = {}
+        for attribute_path, value in node_result.get("attributes", {}).items():
+            endpoints.setdefault(endpointOfPath(attribute_path), {})[attribute_path] = value
+
+        self.nodes[node_id] = node
+        self.attributes[node_id] = endpoints
+        self.dirty.setdefault(node_id, set()).update(endpoints.keys())
+        self.full_updates += 1
+
+    def apply_attribute_update(self, node_id, attribute_path, value):
+        #Apply an attribute_updated event. Returns the endpoint that changed,
+        #or None if the value was already known. The node must be in the store
+        endpoint = endpointOfPath(attribute_path)
+        endpoint_attributes = self.attributes[node_id].setdefault(endpoint, {})
+        if attribute_path in endpoint_attributes and endpoint_attributes[attribute_path] == value:
+            self.unchanged_updates += 1
+            return None
+
+        endpoint_attributes[attribute_path] = value
+        self.dirty.setdefault(node_id, set()).add(endpoint)
+        self.attribute_updates += 1
+        return endpoint
+
+    def remove_node(self, node_id):
+        self.nodes.pop(node_id, None)
+        self.attributes.pop(node_id, None)
+        self.dirty.pop(node_id, None)
+
+    def endpoints(self, node_id):
+        return sorted(self.attributes.get(node_id, {}).keys())
+
+    def endpoint_attributes(self, node_id, endpoint):
+        return self.attributes.get(node_id, {}).get(endpoint, {})
+
+    def pop_dirty(self, node_id):
+        #Return and clear the dirty endpoints of a node
+        return sorted(self.dirty.pop(node_id, set()))
+
+    def stats(self):
+        return {
+            "nodes": len(self.nodes),
+            "attributes": sum(len(endpoint_attributes) for endpoints in self.attributes.values() for endpoint_attributes in endpoints.values()),
+            "dirty_endpoints": sum(len(endpoints) for endpoints in self.dirty.values()),
+            "full_updates": self.full_updates,
+            "attribute_updates": self.attribute_updates,
+            "unchanged_updates": self.unchanged_updates
+        }
+
+
+class NodeEventLog:
+    #The latest matter events of each node, kept in memory so that the events
+    #shadows can be written from it instead of being read back and rewritten
+    #for every event. Each node keeps at most maxevents events, the oldest
+    #events are dropped first.
+    def __init__(self, maxevents=100):
+        self.maxevents = maxevents
+        self.events = {}  # node_id -> deque of events, oldest first
+        self.seeded = False
+        self.appended = 0
+        self.dropped = 0
+
+    def seed(self, node_id, events):
+        #Load the events already in the shadow of a node we have no events for
+        if node_id not in self.events:
+            self.events[node_id] = collections.deque(events[-self.maxevents:], maxlen=self.maxevents)
+
+    def append(self, node_id, event):
+        ring = self.events.setdefault(node_id, collections.deque(maxlen=self.maxevents))
+        if len(ring) == self.maxevents:
+            self.dropped += 1
+        ring.append(event)
+        self.appended += 1
+
+    def node_events(self, node_id):
+        return list(self.events.get(node_id, ()))
+
+    def remove_node(self, node_id):
+        self.events.pop(node_id, None)
+
+    def stats(self):
+        return {
+            "nodes": len(self.events),
+            "events": sum(len(ring) for ring in self.events.values()),
+            "maxevents": self.maxevents,
+            "appended": self.appended,
+            "dropped": self.dropped
+        }
@@ -0,0 +1,625 @@
+#
+# Copyright (c) 2023 Matter Cloud Controller Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import jsonCodec
+from attributeProjection import PathRule
+
+
+class ShadowFlushScheduler:
+    #Coalesces shadow writes. Shadows are marked dirty as the nodes change and
+    #are flushed together once no change has been seen for the debounce window,
+    #but never later than max_staleness seconds after the first change of the
+    #batch. When max_marks is set a batch is also flushed as soon as it has
+    #been marked that many times.
+    #The flush function is called with the list of dirty shadow names and
+    #returns the names it could not write (or None). Those, or all of them if
+    #it raises, are marked dirty again and retried after a backoff that
+    #doubles on every failed flush up to max_backoff seconds.
+    def __init__(self, flush_function, debounce=0.5, max_staleness=2.0, max_marks=0, retry_delay=1.0, max_backoff=30.0):
+        self.flush_function = flush_function
+        self.debounce = debounce
+        self.max_staleness = max_staleness
+        self.max_marks = max_marks
+        self.retry_delay = retry_delay
+        self.max_backoff = max_backoff
+        self._backoff = 0.0
+        self._retry_at = None
+        self.dirty = {}  # shadow_name -> None, kept in the order the shadows were marked
+        self._batch_marks = 0
+        self._first_mark = None
+        self._last_mark = None
+        self._timer = None
+        self._flush_task = None
+        self.marks = 0
+        self.flushes = 0
+        self.shadows_flushed = 0
+        self.errors = 0
+        self.retries = 0
+
+    def mark_dirty(self, shadow_name):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if not self.dirty:
+            self._first_mark = now
+            self._batch_marks = 0
+        self.dirty[shadow_name] = None
+        self._last_mark = now
+        self._batch_marks += 1
+        self.marks += 1
+        self._schedule(loop)
+
+    def _schedule(self, loop):
+        if self._flush_task is not None and not self._flush_task.done():
+            return # rescheduled once the running flush is done
+        deadline = min(self._last_mark + self.debounce, self._first_mark + self.max_staleness)
+        if self.max_marks and self._batch_marks >= self.max_marks:
+            deadline = loop.time()
+        if self._retry_at is not None:
+            deadline = max(deadline, self._retry_at) # backing off after a failed flush
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = loop.call_at(deadline, self._start_flush)
+
+    def _start_flush(self):
+        self._timer = None
+        self._flush_task = asyncio.ensure_future(self.flush())
+        self._flush_task.add_done_callback(self._flush_done)
+
+    def _flush_done(self, _fut):
+        if self.dirty:
+            self._schedule(asyncio.get_event_loop())
+
+    async def flush(self):
+        #Flush every dirty shadow now
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.dirty:
+            return
+        shadow_names = list(self.dirty)
+        self.dirty = {}
+        self.flushes += 1
+        self.shadows_flushed += len(shadow_names)
+        try:
+            failed = await self.flush_function(shadow_names)
+        except Exception:
+            self.errors += 1
+            logging.exception("Error flushing shadows")
+            failed = shadow_names
+
+        if not failed:
+            self._backoff = 0.0
+            self._retry_at = None
+            return
+        #Keep the shadows that were not written dirty so they are retried
+        loop = asyncio.get_running_loop()
+        self._backoff = min(self.max_backoff, self._backoff * 2 if self._backoff else self.retry_delay)
+        self._retry_at = loop.time() + self._backoff
+        self.retries += len(failed)
+        if not self.dirty:
+            self._first_mark = loop.time()
+            self._batch_marks = 0
+        for shadow_name in failed:
+            self.dirty[shadow_name] = None
+        self._last_mark = loop.time()
+
+    def stats(self):
+        return {
+            "dirty": len(self.dirty),
+            "marks": self.marks,
+            "flushes": self.flushes,
+            "shadows_flushed": self.shadows_flushed,
+            "coalesced": self.marks + self.retries - self.shadows_flushed - len(self.dirty),
+            "errors": self.errors,
+            "retries": self.retries,
+            "backoff": self._backoff,
+            "debounce": self.debounce,
+            "max_staleness": self.max_staleness,
+            "max_marks": self.max_marks
+        }
+
+
+class ShadowFingerprints:
+    #Keeps a hash of the last document written to each shadow so that writes
+    #that would not change the shadow can be skipped
+    def __init__(self):
+        self.fingerprints = {}  # shadow_name -> digest of the last written payload
+        self.writes = 0
+        self.skipped = 0
+        self.bytes_skipped = 0
+
+    @staticmethod
+    def fingerprint(payload):
+        return hashlib.blake2b(payload, digest_size=16).digest()
+
+    def check(self, shadow_name, payload):
+        #Returns the fingerprint of the payload if it differs from the last
+        #written document, or None if the write can be skipped
+        digest = self.fingerprint(payload)
+        if self.fingerprints.get(shadow_name) == digest:
+            self.skipped += 1
+            self.bytes_skipped += len(payload)
+            return None
+        return digest
+
+    def record(self, shadow_name, digest):
+        self.fingerprints[shadow_name] = digest
+        self.writes += 1
+
+    def forget(self, shadow_name):
+        self.fingerprints.pop(shadow_name, None)
+
+    def stats(self):
+        return {
+            "shadows": len(self.fingerprints),
+            "writes": self.writes,
+            "skipped": self.skipped,
+            "bytes_skipped": self.bytes_skipped
+        }
+
+
+class ReportedStateTracker:
+    #Keeps the last reported state written to each shadow so that only the
+    #keys that changed need to be sent. Shadow updates are merged into the
+    #existing document so a removed key is sent as None (null) to delete it.
+    def __init__(self):
+        self.reported = {}  # shadow_name -> last reported state written
+        self.full_writes = 0
+        self.patch_writes = 0
+        self.keys_sent = 0
+        self.keys_unchanged = 0
+        self.seeded = 0
+
+    def patch(self, shadow_name, reported):
+        #Returns the part of the reported state that has to be sent, which is
+        #the full state when nothing has been written to the shadow yet
+        previous = self.reported.get(shadow_name)
+        if previous is None:
+            return dict(reported)
+
+        patch = {}
+        for key, value in reported.items():
+            if key in previous and previous[key] == value:
+                self.keys_unchanged += 1
+            else:
+                patch[key] = value
+        for key in previous:
+            if key not in reported:
+                patch[key] = None
+        return patch
+
+    def written(self, shadow_name):
+        return shadow_name in self.reported
+
+    def seed(self, shadow_name, reported):
+        #Start from the reported state already in the shadow, e.g. after a
+        #restart, so the first patch deletes the keys that are no longer wanted
+        if shadow_name not in self.reported:
+            self.reported[shadow_name] = dict(reported)
+            self.seeded += 1
+
+    def commit(self, shadow_name, reported, patch):
+        #Record the reported state once the patch has been written
+        if shadow_name in self.reported:
+            self.patch_writes += 1
+        else:
+            self.full_writes += 1
+        self.keys_sent += len(patch)
+        self.reported[shadow_name] = dict(reported)
+
+    def forget(self, shadow_name):
+        self.reported.pop(shadow_name, None)
+
+    def stats(self):
+        return {
+            "shadows": len(self.reported),
+            "full_writes": self.full_writes,
+            "patch_writes": self.patch_writes,
+            "keys_sent": self.keys_sent,
+            "keys_unchanged": self.keys_unchanged,
+            "seeded": self.seeded
+        }
+
+
+def mergeState(document, update):
+    #Merge a shadow update into a document the way the shadow service does,
+    #a None (null) value deletes the key
+    for key, value in update.items():
+        if value is None:
+            document.pop(key, None)
+        elif isinstance(value, dict) and isinstance(document.get(key), dict):
+            mergeState(document[key], value)
+        else:
+            document[key] = value
+
+
+def deletedKeys(update):
+    #Only the keys an update deletes, used to drop their metadata
+    deleted = {}
+    for key, value in update.items():
+        if value is None:
+            deleted[key] = None
+        elif isinstance(value, dict):
+            nested = deletedKeys(value)
+            if nested:
+                deleted[key] = nested
+    return deleted
+
+
+class ShadowDocumentCache:
+    #Write-through cache of the shadow documents, keyed by (thing, shadow).
+    #Documents are loaded from a get and kept current by applying our own
+    #writes to them, each write must bump the version by exactly one or the
+    #document is dropped since somebody else changed it in between. A delta
+    #means the desired state was changed elsewhere, the reported state is
+    #still known but the full document has to be read again.
+    #The metadata is kept along with the state so a cached document is the
+    #same as the one read from the shadow service, our writes take theirs
+    #from the update response.
+    #The cache is used from the IPC handler threads and the event loop.
+    def __init__(self):
+        self.documents = {}  # (thing, shadow) -> {"state":..., "metadata":..., "version":..., "timestamp":...}
+        self.versions = {}   # (thing, shadow) -> highest version seen
+        self.stale_desired = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.invalidations = 0
+        self.version_conflicts = 0
+
+    def get(self, thing_name, shadow_name):
+        #The full document, or None if it has to be read from the shadow service
+        key = (thing_name, shadow_name)
+        with self._lock:
+            if key not in self.documents or key in self.stale_desired:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return copyDocument(self.documents[key])
+
+    def reported(self, thing_name, shadow_name):
+        #The reported state, or None if it has to be read from the shadow service
+        key = (thing_name, shadow_name)
+        with self._lock:
+            if key not in self.documents:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return copyDocument(self.documents[key]["state"].get("reported", {}))
+
+    def put(self, thing_name, shadow_name, document):
+        #Store a document read from the shadow service. A document older than
+        #a version we already know about (a read racing a write) is dropped
+        key = (thing_name, shadow_name)
+        version = document.get("version")
+        with self._lock:
+            if version is None or version < self.versions.get(key, 0):
+                return
+            self.documents[key] = {
+                "state": copyDocument(document.get("state", {})),
+                "metadata": copyDocument(document.get("metadata", {})),
+                "version": version,
+                "timestamp": document.get("timestamp")
+            }
+            self.versions[key] = version
+            self.stale_desired.discard(key)
+
+    def apply_update(self, thing_name, shadow_name, update_state, version, timestamp=None, metadata=None):
+        #Apply one of our writes that the shadow service accepted as `version`,
+        #`metadata` is the metadata of the update response
+        key = (thing_name, shadow_name)
+        metadata = metadata or {}
+        with self._lock:
+            self.writes += 1
+            document = self.documents.get(key)
+            if document is not None and version != document["version"] + 1:
+                self.version_conflicts += 1
+                self._invalidate(key)
+            elif document is not None:
+                for section, values in update_state.items():
+                    if values is None:
+                        document["state"].pop(section, None)
+                        document["metadata"].pop(section, None)
+                    else:
+                        mergeState(document["state"].setdefault(section, {}), values)
+                        section_metadata = document["metadata"].setdefault(section, {})
+                        mergeState(section_metadata, copyDocument(metadata.get(section) or {}))
+                        mergeState(section_metadata, deletedKeys(values))
+                document["version"] = version
+                document["timestamp"] = timestamp
+            if version is not None:
+                self.versions[key] = max(version, self.versions.get(key, 0))
+
+    def on_delta(self, thing_name, shadow_name, version):
+        #The desired state was changed by somebody else
+        key = (thing_name, shadow_name)
+        with self._lock:
+            document = self.documents.get(key)
+            if document is None or version is None or version <= document["version"]:
+                return
+            if version == document["version"] + 1:
+                document["version"] = version
+                self.stale_desired.add(key)
+            else:
+                # there were other changes we did not see
+                self.version_conflicts += 1
+                self._invalidate(key)
+            self.versions[key] = max(version, self.versions.get(key, 0))
+
+    def invalidate(self, thing_name, shadow_name):
+        #Drop the document after a failed write
+        with self._lock:
+            self._invalidate((thing_name, shadow_name))
+
+    def forget(self, thing_name, shadow_name):
+        #Drop everything known about a deleted shadow
+        key = (thing_name, shadow_name)
+        with self._lock:
+            self._invalidate(key)
+            self.versions.pop(key, None)
+
+    def _invalidate(self, key):
+        if self.documents.pop(key, None) is not None:
+            self.invalidations += 1
+        self.stale_desired.discard(key)
+
+    def stats(self):
+        return {
+            "shadows": len(self.documents),
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "invalidations": self.invalidations,
+            "version_conflicts": self.version_conflicts
+        }
+
+
+def copyDocument(document):
+    #Shadow documents only hold JSON values so a nested dict/list copy is enough
+    if isinstance(document, dict):
+        return {key: copyDocument(value) for key, value in document.items()}
+    if isinstance(document, list):
+        return [copyDocument(value) for value in document]
+    return document
+
+
+def attributeSortKey(attribute_path):
+    #attribute paths are "endpoint/cluster/attribute"
+    endpoint, cluster, attribute = attribute_path.split('/')
+    return int(cluster), int(attribute)
+
+
+class ShadowSharder:
+    #Splits the reported state of an endpoint over several shadows when it
+    #would not fit in one shadow document. The attributes are kept in cluster
+    #order and packed into the shards <shadow>_0, <shadow>_1, ... of up to
+    #max_size bytes, a cluster is only split over shards when it does not fit
+    #in a shard by itself. The shard boundaries are kept for as long as the
+    #shards fit so that a change to one cluster only rewrites its own shard.
+    #The base shadow then only holds a manifest of the shards:
+    #  {"shards": [{"name": "1_0_0", "clusters": [29, 40]}, ...]}
+    #Shadows go back to a single document once the state fits in half of
+    #max_size.
+    OVERHEAD = len('{"state":{"reported":{}}}')
+
+    def __init__(self, max_size=28672):
+        self.max_size = max_size
+        self.boundaries = {}  # shadow_name -> first sort key of each shard after the first
+        self.shard_names = {}  # shadow_name -> names of the shards written
+        self.reshards = 0
+        self.oversized = 0
+
+    @staticmethod
+    def attribute_size(attribute_path, value):
+        return len(jsonCodec.dumpb(attribute_path)) + len(jsonCodec.dumpb(value)) + 2 # the colon and comma
+
+    def documents(self, shadow_name, attributes):
+        #Returns the reported state of each shadow to write as a dict, and the
+        #names of shards that are no longer used and should be deleted
+        sizes = {attribute_path: self.attribute_size(attribute_path, value) for attribute_path, value in attributes.items()}
+        total = self.OVERHEAD + sum(sizes.values())
+        previous_shards = self.shard_names.get(shadow_name, [])
+
+        if total <= (self.max_size // 2 if previous_shards else self.max_size):
+            self.boundaries.pop(shadow_name, None)
+            self.shard_names.pop(shadow_name, None)
+            return {shadow_name: attributes}, previous_shards
+
+        attribute_paths = sorted(attributes, key=attributeSortKey)
+        shards = self._assign(self.boundaries.get(shadow_name, []), attribute_paths)
+        #Repack when a shard has outgrown the limit, unless it is a single
+        #attribute that cannot be split any further
+        if any(len(shard) > 1 and self.OVERHEAD + sum(sizes[path] for path in shard) > self.max_size for shard in shards):
+            self.boundaries[shadow_name] = self._pack(attribute_paths, sizes)
+            shards = self._assign(self.boundaries[shadow_name], attribute_paths)
+            self.reshards += 1
+
+        documents = {}
+        manifest = []
+        for number, shard in enumerate(shards):
+            shard_name = shadow_name + "_" + str(number)
+            documents[shard_name] = {attribute_path: attributes[attribute_path] for attribute_path in shard}
+            if self.OVERHEAD + sum(sizes[path] for path in shard) > self.max_size:
+                self.oversized += 1 # a single attribute over the limit
+            manifest.append({
+                "name": shard_name,
+                "clusters": [attributeSortKey(shard[0])[0], attributeSortKey(shard[-1])[0]] if shard else []
+            })
+        documents[shadow_name] = {"shards": manifest}
+
+        self.shard_names[shadow_name] = [shard["name"] for shard in manifest]
+        retired = [shard_name for shard_name in previous_shards if shard_name not in documents]
+        return documents, retired
+
+    def _assign(self, boundaries, attribute_paths):
+        #Put each attribute in the shard whose range it falls in
+        shards = [[] for _ in range(len(boundaries) + 1)]
+        for attribute_path in attribute_paths:
+            shards[bisect.bisect_right(boundaries, attributeSortKey(attribute_path))].append(attribute_path)
+        return shards
+
+    def _pack(self, attribute_paths, sizes):
+        #Greedily pack whole clusters into shards, only splitting a cluster
+        #that does not fit in a shard by itself
+        capacity = self.max_size - self.OVERHEAD
+        clusters = []
+        for attribute_path in attribute_paths:
+            cluster = attributeSortKey(attribute_path)[0]
+            if not clusters or clusters[-1][0] != cluster:
+                clusters.append((cluster, []))
+            clusters[-1][1].append(attribute_path)
+
+        boundaries = []
+        used = 0
+        for cluster, cluster_paths in clusters:
+            cluster_size = sum(sizes[path] for path in cluster_paths)
+            if used + cluster_size <= capacity:
+                used += cluster_size
+                continue
+            if cluster_size <= capacity:
+                boundaries.append(attributeSortKey(cluster_paths[0]))
+                used = cluster_size
+                continue
+            for attribute_path in cluster_paths:
+                if used + sizes[attribute_path] > capacity and used > 0:
+                    boundaries.append(attributeSortKey(attribute_path))
+                    used = 0
+                used += sizes[attribute_path]
+        return boundaries
+
+    def forget(self, shadow_name):
+        self.boundaries.pop(shadow_name, None)
+        return self.shard_names.pop(shadow_name, [])
+
+    def stats(self):
+        return {
+            "sharded_shadows": len(self.shard_names),
+            "shards": sum(len(shard_names) for shard_names in self.shard_names.values()),
+            "max_size": self.max_size,
+            "reshards": self.reshards,
+            "oversized": self.oversized
+        }
+
+
+# attributes that do not change after commissioning: BasicInformation,
+# Descriptor, OperationalCredentials and the global attribute lists
+DEFAULT_STATIC_ATTRIBUTES = "0/40/*,*/29/*,0/62/*,*/*/65528-65533"
+
+
+class ShadowSplitter:
+    #Splits the attributes of an endpoint between its live shadow <node>_<ep>
+    #and a static shadow <node>_<ep>_static that is only written when a full
+    #node is read (commissioning or a resync) or when an attribute moves out
+    #of it, so that attribute updates only rewrite the small live shadow.
+    #The live shadow names its static shadow in a "static" key.
+    #The mode is
+    #  off: everything is in the live shadow
+    #  config: the attributes matching static_rules are static
+    #  learn: every attribute is static until it is seen to change, the
+    #         attributes seen to change are kept in state_file
+    def __init__(self, mode="off", static_rules=(), state_file=None):
+        self.mode = mode
+        self.static_rules = [PathRule(rule) for rule in static_rules]
+        self.state_file = state_file
+        self.hot = set()  # attribute paths seen to change, in learn mode
+        self.static_dirty = set()  # live shadow names whose static shadow has to be written
+        self._decisions = {}  # attribute_path -> static in config mode
+        self.promotions = 0
+        self.static_changes = 0
+        self._load()
+
+    @property
+    def enabled(self):
+        return self.mode != "off"
+
+    def _load(self):
+        if self.mode == "learn" and self.state_file is not None and os.path.exists(self.state_file):
+            try:
+                with open(self.state_file) as state:
+                    self.hot = set(json.load(state).get("hot", []))
+            except (OSError, ValueError):
+                logging.exception("Error loading the hot attributes from %s", self.state_file)
+
+    def _save(self):
+        if self.state_file is None:
+            return
+        try:
+            with open(self.state_file, "w") as state:
+                json.dump({"hot": sorted(self.hot)}, state)
+        except OSError:
+            logging.exception("Error saving the hot attributes to %s", self.state_file)
+
+    def is_static(self, attribute_path):
+        if self.mode == "off":
+            return False
+        if self.mode == "learn":
+            return attribute_path not in self.hot
+        if attribute_path not in self._decisions:
+            ids = [int(part) for part in attribute_path.split('/')]
+            self._decisions[attribute_path] = any(rule.matches(ids) for rule in self.static_rules)
+        return self._decisions[attribute_path]
+
+    def observe_change(self, attribute_path):
+        #Called when an attribute changes. Returns True if the static shadow
+        #has to be written, because the attribute is static or because it
+        #has just been learned to be live and has to be removed from it
+        if not self.is_static(attribute_path):
+            return False
+        if self.mode == "learn":
+            self.hot.add(attribute_path)
+            self.promotions += 1
+            self._save()
+        else:
+            self.static_changes += 1
+        return True
+
+    def split(self, attributes):
+        #Returns the live and the static attributes
+        live = {}
+        static = {}
+        for attribute_path, value in attributes.items():
+            if self.is_static(attribute_path):
+                static[attribute_path] = value
+            else:
+                live[attribute_path] = value
+        return live, static
+
+    def mark_static_dirty(self, shadow_name):
+        if self.enabled:
+            self.static_dirty.add(shadow_name)
+
+    def pop_static_dirty(self, shadow_name):
+        if shadow_name in self.static_dirty:
+            self.static_dirty.discard(shadow_name)
+            return True
+        return False
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "hot_attributes": len(self.hot),
+            "promotions": self.promotions,
+            "static_changes": self.static_changes,
+            "static_dirty": len(self.static_dirty)
+        }
@@ -0,0 +1,92 @@
+#
+# Copyright (c) 2023 Matter Cloud Controller Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Tests of the AIMD pacing of the commands sent to the python matter server.
+
+To Run:
+python3 -m pytest src/component/mcc-daemon/tests
+"""
+
+import asyncio
+import os
+import sys
+import time
+import unittest
+
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__)))+'/src')
+from asyncioUtils import AimdPacer
+
+
+class AimdPacerTest(unittest.TestCase):
+    def test_fast_replies_increase_the_rate_up_to_the_maximum(self):
+        pacer = AimdPacer(rate=10, max_rate=12, increase=1, target_latency=1.0)
+        for message_id in range(5):
+            pacer.on_send(message_id)
+            pacer.on_reply(message_id)
+        self.assertEqual(pacer.rate, 12)
+        self.assertEqual(pacer.replies, 5)
+
+    def test_a_slow_reply_cuts_the_rate(self):
+        pacer = AimdPacer(rate=10, decrease=0.5, target_latency=0.01)
+        pacer.on_send("slow")
+        time.sleep(0.02)
+        pacer.on_reply("slow")
+        self.assertEqual(pacer.rate, 5)
+        self.assertEqual(pacer.slow_replies, 1)
+
+    def test_errors_cut_the_rate_once_per_target_latency(self):
+        pacer = AimdPacer(rate=16, min_rate=1, decrease=0.5, target_latency=60)
+        for message_id in range(3):
+            pacer.on_send(message_id)
+            pacer.on_reply(message_id, error=True)
+        self.assertEqual(pacer.rate, 8)
+        self.assertEqual(pacer.errors, 3)
+
+    def test_the_rate_does_not_go_below_the_minimum(self):
+        pacer = AimdPacer(rate=2, min_rate=1.5, decrease=0.5, target_latency=0)
+        pacer.on_reply("unknown", error=True)
+        self.assertEqual(pacer.rate, 1.5)
+
+    def test_replies_to_unpaced_messages_are_ignored(self):
+        pacer = AimdPacer(rate=10)
+        pacer.on_reply("not-sent")
+        self.assertEqual(pacer.rate, 10)
+        self.assertEqual(pacer.replies, 0)
+
+    def test_pending_sends_are_bounded(self):
+        pacer = AimdPacer(max_pending=3)
+        for message_id in range(10):
+            pacer.on_send(message_id)
+        self.assertEqual(pacer.stats()["pending"], 3)
+        pacer.on_reply(0) # dropped as the oldest, no longer paced
+        self.assertEqual(pacer.replies, 0)
+
+    def test_wait_spaces_the_sends_at_the_rate(self):
+        async def send(count):
+            pacer = AimdPacer(rate=50, min_rate=50, max_rate=50)
+            start = time.monotonic()
+            for message_id in range(count):
+                await pacer.wait()
+            return time.monotonic() - start
+
+        #the first send goes straight away, the next ones 20ms apart
+        self.assertGreaterEqual(asyncio.run(send(6)), 0.09)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+#
+# Copyright (c) 2023 Matter Cloud Controller Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Tests of the projection of the attributes mirrored into the shadows.
+
+To Run:
+python3 -m pytest src/component/mcc-daemon/tests
+"""
+
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__)))+'/src')
+from attributeProjection import NOT_INCLUDED, AttributeProjection, PathRule
+
+
+class PathRuleTest(unittest.TestCase):
+    def test_numbers_ranges_and_wildcards(self):
+        rule = PathRule("*/29/65528-65533")
+        self.assertTrue(rule.matches([0, 29, 65528]))
+        self.assertTrue(rule.matches([7, 29, 65533]))
+        self.assertFalse(rule.matches([0, 29, 65534]))
+        self.assertFalse(rule.matches([0, 30, 65530]))
+
+    def test_malformed_rules_are_rejected(self):
+        for rule in ("0/29", "0/29/1/2", "a/29/1", "0/1-x/2"):
+            with self.assertRaises(ValueError, msg=rule):
+                PathRule(rule)
+
+
+class AttributeProjectionTest(unittest.TestCase):
+    def test_everything_is_kept_by_default(self):
+        projection = AttributeProjection()
+        attributes = {"0/40/1": "vendor", "1/6/0": True}
+        self.assertEqual(projection.project(attributes), attributes)
+        self.assertEqual(projection.stats()["kept"], 2)
+
+    def test_exclude_rules_win_over_include_rules(self):
+        projection = AttributeProjection(include=["*/*/*"], exclude=["*/*/65528-65533", "0/62/*"])
+        self.assertTrue(projection.allows("1/6/0", True))
+        self.assertFalse(projection.allows("1/6/65531", [0, 1]))
+        self.assertFalse(projection.allows("0/62/5", "fabric"))
+        self.assertEqual(projection.dropped_by("1/6/65531"), "*/*/65528-65533")
+        self.assertIsNone(projection.dropped_by("1/6/0"))
+
+    def test_attributes_outside_the_include_rules_are_dropped(self):
+        projection = AttributeProjection(include=["1/6/*", "1/8/0"])
+        kept = projection.project({"1/6/0": True, "1/8/0": 10, "1/8/1": 1, "0/40/1": "vendor"})
+        self.assertEqual(kept, {"1/6/0": True, "1/8/0": 10})
+        self.assertEqual(projection.dropped_by("0/40/1"), NOT_INCLUDED)
+
+    def test_dropped_bytes_are_counted_per_rule(self):
+        projection = AttributeProjection(exclude=["0/62/*"])
+        projection.allows("0/62/0", "x" * 10)
+        projection.allows("0/62/1", "y" * 10)
+        stats = projection.stats()
+        self.assertEqual(stats["rules"]["0/62/*"]["dropped"], 2)
+        self.assertEqual(stats["rules"]["0/62/*"]["bytes_saved"], stats["bytes_saved"])
+        self.assertEqual(stats["bytes_saved"], 2 * (len('"0/62/0"') + len('"xxxxxxxxxx"') + 2))
+
+    def test_from_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "projection.json")
+            with open(path, "w") as config_file:
+                json.dump({"exclude": ["0/51/0"]}, config_file)
+            projection = AttributeProjection.from_file(path)
+        self.assertFalse(projection.allows("0/51/0"))
+        self.assertTrue(projection.allows("0/51/1"))
+
+    def test_the_shipped_config_parses(self):
+        path = os.path.join(os.path.dirname(os.path.abspath(os.path.dirname(__file__))), "src", "attributeProjection.json")
+        projection = AttributeProjection.from_file(path)
+        self.assertFalse(projection.allows("1/6/65532"))
+        self.assertTrue(projection.allows("1/6/0"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+#
+# Copyright (c) 2023 Matter Cloud Controller Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Tests of the registry of the callbacks waiting for a reply.
+
+To Run:
+python3 -m pytest src/component/mcc-daemon/tests
+"""
+
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__)))+'/src')
+from messageCorrelation import CallbackRegistry
+
+
+def callback(*args):
+    pass
+
+
+class CallbackRegistryTest(unittest.IsolatedAsyncioTestCase):
+    async def test_pop_returns_the_callback_once(self):
+        registry = CallbackRegistry()
+        registry.register("1", 5, callback)
+        self.assertIn("1", registry)
+        self.assertEqual(registry.pop("1"), (5, callback))
+        self.assertIsNone(registry.pop("1"))
+        self.assertEqual(len(registry), 0)
+
+    async def test_entries_expire_after_their_ttl(self):
+        timed_out = []
+        registry = CallbackRegistry(ttl=60)
+        registry.register("short", 1, callback, on_timeout=lambda message_id, node_id: timed_out.append((message_id, node_id)), ttl=0.01)
+        registry.register("long", 2, callback)
+        await asyncio.sleep(0.05)
+        self.assertEqual(timed_out, [("short", 1)])
+        self.assertNotIn("short", registry)
+        self.assertIn("long", registry)
+        self.assertEqual(registry.stats()["expired"], 1)
+        registry.pop("long")
+
+    async def test_a_popped_entry_does_not_expire(self):
+        timed_out = []
+        registry = CallbackRegistry(ttl=0.01)
+        registry.register("1", 1, callback, on_timeout=lambda *args: timed_out.append(args))
+        registry.pop("1")
+        await asyncio.sleep(0.05)
+        self.assertEqual(timed_out, [])
+
+    async def test_the_oldest_entry_is_evicted_when_full(self):
+        timed_out = []
+        registry = CallbackRegistry(maxsize=2)
+        for message_id in ("1", "2", "3"):
+            registry.register(message_id, int(message_id), callback, on_timeout=lambda message_id, node_id: timed_out.append(message_id))
+        self.assertEqual(timed_out, ["1"])
+        self.assertEqual(len(registry), 2)
+        self.assertNotIn("1", registry)
+        self.assertEqual(registry.stats()["evicted"], 1)
+        for message_id in ("2", "3"):
+            registry.pop(message_id)
+
+    async def test_registering_a_message_id_again_replaces_it(self):
+        timed_out = []
+        registry = CallbackRegistry(maxsize=2)
+        registry.register("1", 1, callback, on_timeout=lambda *args: timed_out.append(args))
+        registry.register("1", 2, callback)
+        self.assertEqual(len(registry), 1)
+        self.assertEqual(timed_out, [])
+        self.assertEqual(registry.pop("1"), (2, callback))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+#
+# Copyright (c) 2023 Matter Cloud Controller Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Tests of the matching of the matter server replies to the commands in flight.
+
+To Run:
+python3 -m pytest src/component/mcc-daemon/tests
+"""
+
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__)))+'/src')
+from messageCorrelation import CommandCorrelator, MessageIdGenerator
+
+
+class CommandCorrelatorTest(unittest.IsolatedAsyncioTestCase):
+    async def test_a_reply_resolves_its_command_and_frees_the_slot(self):
+        correlator = CommandCorrelator(window=1)
+        await correlator.acquire()
+        future = correlator.register("1", "get_node")
+        self.assertTrue(correlator.resolve("1", {"message_id": "1"}))
+        self.assertEqual(await future, {"message_id": "1"})
+        #the slot is free again
+        await asyncio.wait_for(correlator.acquire(), 1)
+        self.assertFalse(correlator.resolve("unknown", {}))
+
+    async def test_the_window_bounds_the_commands_in_flight(self):
+        correlator = CommandCorrelator(window=2)
+        for message_id in ("1", "2"):
+            await correlator.acquire()
+            correlator.register(message_id)
+        waiting = asyncio.ensure_future(correlator.acquire())
+        await asyncio.sleep(0)
+        self.assertFalse(waiting.done())
+        correlator.resolve("1", {})
+        await asyncio.wait_for(waiting, 1)
+
+    async def test_a_command_without_a_reply_times_out(self):
+        timed_out = []
+        correlator = CommandCorrelator(timeout=0.01, command_timeouts={"discover": 60}, on_timeout=timed_out.append)
+        await correlator.acquire()
+        future = correlator.register("1", "get_node")
+        await correlator.acquire()
+        slow = correlator.register("2", "discover")
+        with self.assertRaises(asyncio.TimeoutError):
+            await future
+        self.assertEqual(timed_out, ["1"])
+        self.assertFalse(slow.done())
+        self.assertEqual(correlator.command_timeout("discover"), 60)
+        correlator.cancel_all()
+
+    async def test_a_reused_message_id_fails_the_older_command(self):
+        correlator = CommandCorrelator()
+        await correlator.acquire()
+        older = correlator.register("1")
+        await correlator.acquire()
+        newer = correlator.register("1")
+        with self.assertRaises(RuntimeError):
+            await older
+        correlator.resolve("1", "reply")
+        self.assertEqual(await newer, "reply")
+        self.assertEqual(correlator.stats()["in_flight"], 0)
+
+    async def test_only_requested_commands_are_resolved_for_a_requester(self):
+        correlator = CommandCorrelator()
+        await correlator.acquire()
+        correlator.register("internal")
+        self.assertFalse(correlator.resolve_request("internal", {}))
+
+        requester = asyncio.get_running_loop().create_future()
+        await correlator.acquire()
+        correlator.register("rest", future=requester)
+        self.assertTrue(correlator.resolve_request("rest", "reply"))
+        self.assertEqual(await requester, "reply")
+        correlator.cancel_all()
+
+    async def test_cancel_all_fails_the_commands_in_flight(self):
+        correlator = CommandCorrelator(window=2)
+        futures = []
+        for message_id in ("1", "2"):
+            await correlator.acquire()
+            futures.append(correlator.register(message_id))
+        correlator.cancel_all()
+        for future in futures:
+            with self.assertRaises(ConnectionError):
+                await future
+        self.assertEqual(correlator.stats()["in_flight"], 0)
+
+
+class MessageIdGeneratorTest(unittest.TestCase):
+    def test_ids_are_unique_and_prefixed(self):
+        next_id = MessageIdGenerator(prefix="mcc-test")
+        self.assertEqual([next_id(), next_id()], ["mcc-test-1", "mcc-test-2"])
+        self.assertNotEqual(MessageIdGenerator().prefix, MessageIdGenerator().prefix)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+#
+# Copyright (c) 2023 Matter Cloud Controller Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Tests of the local journal of matter server events.
+
+To Run:
+python3 -m pytest src/component/mcc-daemon/tests
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__)))+'/src')
+from eventJournal import EventJournal
+
+
+def event(node_id, number):
+    return {"event": "node_event", "data": {"node_id": node_id, "event_number": number}}
+
+
+class EventJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_reload_indexes_appended_records(self):
+        journal = EventJournal(self.directory.name)
+        for number in range(3):
+            journal.append(event(1, number))
+        journal.close()
+
+        journal = EventJournal(self.directory.name)
+        records, next_start = journal.query(node_id=1)
+        journal.close()
+        self.assertEqual([record["m"]["data"]["event_number"] for record in records], [0, 1, 2])
+        self.assertIsNone(next_start)
+
+    def test_torn_tail_is_truncated_before_appending(self):
+        journal = EventJournal(self.directory.name)
+        journal.append(event(1, 0))
+        segment_path = journal._segment_path(journal.segments[-1])
+        journal.close()
+
+        #A crash in the middle of writing a record
+        with open(segment_path, "ab") as segment:
+            segment.write(b'{"t": 1, "n": 1, "e": "node_ev')
+
+        journal = EventJournal(self.directory.name)
+        self.assertEqual(journal.stats()["truncated"], 1)
+        for number in range(1, 4):
+            journal.append(event(1, number))
+        journal.close()
+
+        journal = EventJournal(self.directory.name)
+        records, next_start = journal.query(node_id=1)
+        self.assertEqual(journal.stats()["truncated"], 0)
+        journal.close()
+        self.assertEqual([record["m"]["data"]["event_number"] for record in records], [0, 1, 2, 3])
+
+    def test_appends_are_buffered_on_the_event_loop(self):
+        async def append_burst():
+            journal = EventJournal(self.directory.name, flush_interval=0.05)
+            segment_path = journal._segment_path(journal.segments[-1])
+            for number in range(10):
+                journal.append(event(1, number))
+            buffered = os.path.getsize(segment_path)
+            #A query still sees the buffered records
+            records, next_start = journal.query(node_id=1)
+            self.assertEqual(len(records), 10)
+            journal.append(event(1, 10))
+            await asyncio.sleep(0.1)
+            flushed = os.path.getsize(segment_path)
+            stats = journal.stats()
+            journal.close()
+            return buffered, flushed, stats
+
+        buffered, flushed, stats = asyncio.run(append_burst())
+        self.assertEqual(buffered, 0)
+        self.assertGreater(flushed, 0)
+        self.assertEqual(stats["pending_bytes"], 0)
+        self.assertEqual(stats["flushes"], 2)
+
+        journal = EventJournal(self.directory.name)
+        records, next_start = journal.query(node_id=1)
+        journal.close()
+        self.assertEqual(len(records), 11)
+
+
+if __name__ == "__main__":
+    unittest.main()
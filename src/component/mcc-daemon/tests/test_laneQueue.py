@@ -0,0 +1,120 @@
+#
+# Copyright (c) 2023 Matter Cloud Controller Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Tests of the weighted lanes of the command queue.
+
+To Run:
+python3 -m pytest src/component/mcc-daemon/tests
+"""
+
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__)))+'/src')
+from asyncioUtils import LaneQueue, parse_lane_weights
+
+
+def drain(queue):
+    items = []
+    while not queue.empty():
+        item_size, item = queue.get_nowait()
+        items.append(item)
+    return items
+
+
+class LaneWeightsTest(unittest.TestCase):
+    def test_parse_keeps_the_order_and_a_minimum_weight(self):
+        weights = parse_lane_weights("interactive:8, control:0,,webhook:1")
+        self.assertEqual(list(weights.items()), [("interactive", 8), ("control", 1), ("webhook", 1)])
+
+    def test_no_lanes_is_an_error(self):
+        with self.assertRaises(ValueError):
+            parse_lane_weights(" , ")
+
+
+class LaneQueueTest(unittest.TestCase):
+    def test_lanes_are_served_in_proportion_to_their_weights(self):
+        queue = LaneQueue(lane_weights={"fast": 3, "slow": 1})
+        for number in range(8):
+            queue.put_nowait(("fast", number), "fast")
+            queue.put_nowait(("slow", number), "slow")
+
+        lanes = [lane for lane, number in drain(queue)[:8]]
+        self.assertEqual(lanes.count("fast"), 6)
+        self.assertEqual(lanes.count("slow"), 2)
+        #smooth round robin spreads the slow lane out instead of bunching it
+        self.assertNotEqual(lanes[-2:], ["slow", "slow"])
+
+    def test_items_keep_their_order_within_a_lane(self):
+        queue = LaneQueue(lane_weights={"fast": 3, "slow": 1})
+        for number in range(5):
+            queue.put_nowait(("fast", number), "fast")
+            queue.put_nowait(("slow", number), "slow")
+
+        items = drain(queue)
+        for lane in ("fast", "slow"):
+            self.assertEqual([number for item_lane, number in items if item_lane == lane], list(range(5)))
+
+    def test_an_empty_lane_does_not_hold_back_the_others(self):
+        queue = LaneQueue(lane_weights={"fast": 1, "slow": 8})
+        for number in range(3):
+            queue.put_nowait(number, "fast")
+        self.assertEqual(drain(queue), [0, 1, 2])
+
+    def test_an_unknown_lane_goes_to_the_default_lane(self):
+        queue = LaneQueue(lane_weights={"interactive": 2, "webhook": 1})
+        queue.put_nowait("command", "no-such-lane")
+        queue.put_nowait("other")
+        stats = queue.stats()
+        self.assertEqual(stats["lanes"]["interactive"]["depth"], 2)
+        self.assertEqual(stats["lanes"]["webhook"]["depth"], 0)
+
+    def test_byte_accounting_follows_the_items(self):
+        queue = LaneQueue(lane_weights={"fast": 1, "slow": 1})
+        queue.put_nowait(b"x" * 100, "fast")
+        queue.put_nowait(b"y" * 200, "slow")
+        self.assertGreater(queue.stats()["lanes"]["slow"]["bytes"], queue.stats()["lanes"]["fast"]["bytes"])
+        drain(queue)
+        stats = queue.stats()
+        self.assertEqual(stats["bytes"], 0)
+        self.assertEqual(stats["lanes"]["fast"]["bytes"], 0)
+        self.assertEqual(stats["lanes"]["slow"]["bytes"], 0)
+        self.assertEqual(stats["lanes"]["fast"]["dequeued"], 1)
+
+    def test_put_waits_while_the_byte_budget_is_used(self):
+        async def run():
+            queue = LaneQueue(maxmemsize=150, lane_weights={"fast": 1})
+            await queue.put(b"x" * 200, "fast") # one item can always get into an empty queue
+            blocked = asyncio.ensure_future(queue.put(b"y", "fast"))
+            await asyncio.sleep(0)
+            self.assertFalse(blocked.done())
+            with self.assertRaises(asyncio.QueueFull):
+                queue.put_nowait(b"z", "fast")
+            await queue.get()
+            await asyncio.wait_for(blocked, 1)
+            return queue.stats()
+
+        stats = asyncio.run(run())
+        self.assertEqual(stats["blocked_puts"], 1)
+        self.assertEqual(stats["depth"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+#
+# Copyright (c) 2023 Matter Cloud Controller Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Tests of the validation of the commands sent to the python matter server.
+
+To Run:
+python3 -m pytest src/component/mcc-daemon/tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__)))+'/src')
+from matterCommand import (MSG_INVALID_JSON, MSG_MISSING_ATTRIBUTE, CommandError, MatterCommand,
+                           commandResponse, validateCommand)
+
+
+def command(name, message_id=1, **fields):
+    return dict({"message_id": message_id, "command": name}, **fields)
+
+
+class ValidateCommandTest(unittest.TestCase):
+    def assertRejected(self, message, response):
+        with self.assertRaises(CommandError) as raised:
+            validateCommand(message)
+        self.assertEqual(raised.exception.response, response)
+
+    def test_message_id_and_command_are_required(self):
+        self.assertRejected({"command": "get_nodes"}, MSG_MISSING_ATTRIBUTE)
+        self.assertRejected({"message_id": 1}, MSG_MISSING_ATTRIBUTE)
+        self.assertRejected(["get_nodes"], MSG_MISSING_ATTRIBUTE)
+        self.assertRejected(command("get_nodes", message_id=True), "message_id must be str or int")
+        self.assertRejected(command(""), "command must be a non empty str")
+
+    def test_unknown_commands_pass_through(self):
+        message = command("some_new_command", args={"anything": [1]})
+        self.assertIs(validateCommand(message), message)
+
+    def test_required_args(self):
+        self.assertRejected(command("get_node"), "get_node is missing args.node_id")
+        self.assertRejected(command("get_node", args=[]), "get_node args must be an object")
+        self.assertRejected(command("read_attribute", args={"node_id": 1}), "read_attribute is missing args.attribute_path")
+        validateCommand(command("read_attribute", args={"node_id": 1, "attribute_path": ["1/6/0"]}))
+
+    def test_types_are_checked(self):
+        self.assertRejected(command("commission_with_code", args={"code": 1234}), "commission_with_code args.code must be str")
+        self.assertRejected(command("write_attributes", args={"node_id": 1, "endpoint_id": 1, "attributes": []}),
+                            "write_attributes args.attributes must be dict")
+        #bool is not an int
+        self.assertRejected(command("commission_on_network", args={"setup_pin_code": True}),
+                            "commission_on_network args.setup_pin_code must be int")
+
+    def test_ids_can_be_numeric_strings(self):
+        validateCommand(command("get_node", args={"node_id": "12"}))
+        validateCommand(command("device_command", args={"node_id": "1", "endpoint_id": "1", "cluster_id": 6, "command_name": "On"}))
+        self.assertRejected(command("get_node", args={"node_id": "twelve"}), "get_node args.node_id must be int or numeric str")
+        self.assertRejected(command("get_node", args={"node_id": 1.5}), "get_node args.node_id must be int or numeric str")
+
+    def test_optional_args_are_checked_when_present(self):
+        validateCommand(command("write_attribute", args={"node_id": 1, "attribute_path": "1/6/0", "value": None}))
+        self.assertRejected(command("write_attribute", args={"node_id": 1, "attribute_path": "1/6/0", "value": 1, "endpoint_id": "one"}),
+                            "write_attribute args.endpoint_id must be int or numeric str")
+
+    def test_call_webhook_needs_its_fields_and_args(self):
+        webhook = command("call_webhook", webhook_method="POST", webhook_url="http://localhost:8080", webhook_endpoint="hook")
+        self.assertRejected(webhook, "call_webhook is missing args")
+        self.assertRejected(dict(webhook, args="data"), "call_webhook args must be an object")
+        validateCommand(dict(webhook, args={"a": 1}))
+        self.assertRejected(command("call_webhook", args={}), "call_webhook is missing webhook_method")
+
+
+class MatterCommandTest(unittest.TestCase):
+    def test_from_json_keeps_the_raw_text(self):
+        raw = '{"message_id": "7", "command": "get_node", "args": {"node_id": 1}}'
+        matter_command = MatterCommand.from_json(raw)
+        self.assertEqual((matter_command.message_id, matter_command.command, matter_command.args), ("7", "get_node", {"node_id": 1}))
+        self.assertEqual(matter_command.to_json(), raw.encode("utf-8"))
+
+    def test_from_json_rejects_invalid_json(self):
+        with self.assertRaises(CommandError) as raised:
+            MatterCommand.from_json(b'{"message_id": 1,')
+        self.assertEqual(raised.exception.response, MSG_INVALID_JSON)
+
+    def test_from_message_is_encoded_once(self):
+        matter_command = MatterCommand.from_message(command("get_nodes"))
+        encoded = matter_command.to_json()
+        self.assertIs(matter_command.to_json(), encoded)
+        self.assertGreater(matter_command.payload_size, len(encoded))
+
+    def test_command_response(self):
+        response = commandResponse("payload", "accepted", 200, 7)
+        self.assertEqual((response["response"], response["return_code"], response["message_id"]), ("accepted", 200, "7"))
+        self.assertNotIn("message_id", commandResponse("payload", MSG_INVALID_JSON, 255))
+
+
+if __name__ == "__main__":
+    unittest.main()
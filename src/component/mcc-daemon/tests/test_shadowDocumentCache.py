@@ -0,0 +1,114 @@
+#
+# Copyright (c) 2023 Matter Cloud Controller Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Tests of the write-through cache of the shadow documents.
+
+To Run:
+python3 -m pytest src/component/mcc-daemon/tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__)))+'/src')
+from shadowUtils import ShadowDocumentCache
+
+
+def document(version, reported, desired=None):
+    state = {"reported": dict(reported)}
+    metadata = {"reported": {key: {"timestamp": version} for key in reported}}
+    if desired is not None:
+        state["desired"] = dict(desired)
+        metadata["desired"] = {key: {"timestamp": version} for key in desired}
+    return {"state": state, "metadata": metadata, "version": version, "timestamp": version}
+
+
+class ShadowDocumentCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = ShadowDocumentCache()
+        self.cache.put("thing", "1_0", document(5, {"a": 1, "b": 2}))
+
+    def test_a_hit_returns_the_document_as_read(self):
+        self.assertEqual(self.cache.get("thing", "1_0"), document(5, {"a": 1, "b": 2}))
+        self.assertIsNone(self.cache.get("thing", "2_0"))
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+
+    def test_a_hit_is_a_copy(self):
+        self.cache.get("thing", "1_0")["state"]["reported"]["a"] = 100
+        self.assertEqual(self.cache.reported("thing", "1_0"), {"a": 1, "b": 2})
+
+    def test_the_next_version_is_applied(self):
+        self.cache.apply_update("thing", "1_0", {"reported": {"a": 3, "b": None, "c": 4}}, 6, 60,
+                                {"reported": {"a": {"timestamp": 60}, "b": {"timestamp": 60}, "c": {"timestamp": 60}}})
+        cached = self.cache.get("thing", "1_0")
+        self.assertEqual(cached["state"], {"reported": {"a": 3, "c": 4}})
+        self.assertEqual(cached["metadata"], {"reported": {"a": {"timestamp": 60}, "c": {"timestamp": 60}}})
+        self.assertEqual((cached["version"], cached["timestamp"]), (6, 60))
+
+    def test_a_version_gap_drops_the_document(self):
+        #version 6 was written by somebody else
+        self.cache.apply_update("thing", "1_0", {"reported": {"a": 3}}, 7)
+        self.assertIsNone(self.cache.get("thing", "1_0"))
+        self.assertEqual(self.cache.stats()["version_conflicts"], 1)
+        self.assertEqual(self.cache.stats()["invalidations"], 1)
+
+    def test_an_older_read_does_not_replace_a_newer_write(self):
+        self.cache.apply_update("thing", "1_0", {"reported": {"a": 3}}, 6)
+        self.cache.put("thing", "1_0", document(5, {"a": 1, "b": 2})) # a read that raced the write
+        self.assertEqual(self.cache.reported("thing", "1_0"), {"a": 3, "b": 2})
+        self.assertEqual(self.cache.get("thing", "1_0")["version"], 6)
+
+    def test_a_read_after_an_unseen_write_is_kept(self):
+        self.cache.apply_update("thing", "1_0", {"reported": {"a": 3}}, 8) # gap, dropped
+        self.cache.put("thing", "1_0", document(7, {"a": 0})) # older than the write
+        self.assertIsNone(self.cache.get("thing", "1_0"))
+        self.cache.put("thing", "1_0", document(8, {"a": 3}))
+        self.assertEqual(self.cache.reported("thing", "1_0"), {"a": 3})
+
+    def test_the_next_delta_keeps_only_the_reported_state(self):
+        self.cache.on_delta("thing", "1_0", 6)
+        self.assertIsNone(self.cache.get("thing", "1_0")) # desired has to be read again
+        self.assertEqual(self.cache.reported("thing", "1_0"), {"a": 1, "b": 2})
+        #our next write follows the delta's version
+        self.cache.apply_update("thing", "1_0", {"reported": {"a": 3}}, 7)
+        self.assertEqual(self.cache.reported("thing", "1_0"), {"a": 3, "b": 2})
+        self.cache.put("thing", "1_0", document(7, {"a": 3, "b": 2}, {"a": 9}))
+        self.assertEqual(self.cache.get("thing", "1_0")["state"]["desired"], {"a": 9})
+
+    def test_a_delta_after_missed_changes_drops_the_document(self):
+        self.cache.on_delta("thing", "1_0", 8)
+        self.assertIsNone(self.cache.reported("thing", "1_0"))
+        self.assertEqual(self.cache.stats()["version_conflicts"], 1)
+
+    def test_an_old_delta_is_ignored(self):
+        self.cache.on_delta("thing", "1_0", 5)
+        self.assertIsNotNone(self.cache.get("thing", "1_0"))
+
+    def test_forget_drops_the_known_version(self):
+        self.cache.apply_update("thing", "1_0", {"reported": {"a": 3}}, 6)
+        self.cache.forget("thing", "1_0")
+        self.assertIsNone(self.cache.get("thing", "1_0"))
+        #a new shadow with the same name starts over at version 1
+        self.cache.put("thing", "1_0", document(1, {"a": 1}))
+        self.assertEqual(self.cache.reported("thing", "1_0"), {"a": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
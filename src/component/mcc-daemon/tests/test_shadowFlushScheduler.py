@@ -0,0 +1,130 @@
+#
+# Copyright (c) 2023 Matter Cloud Controller Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Tests of the debounced flushing of the dirty shadows.
+
+To Run:
+python3 -m pytest src/component/mcc-daemon/tests
+"""
+
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__)))+'/src')
+from shadowUtils import ShadowFlushScheduler
+
+
+class Recorder:
+    #A flush function that records its calls and fails the names in `fail`
+    #for the first `failures` calls
+    def __init__(self, fail=(), failures=0, error=None):
+        self.calls = []
+        self.fail = list(fail)
+        self.failures = failures
+        self.error = error
+
+    async def __call__(self, shadow_names):
+        self.calls.append((asyncio.get_running_loop().time(), list(shadow_names)))
+        if len(self.calls) <= self.failures:
+            if self.error is not None:
+                raise self.error
+            return [name for name in shadow_names if name in self.fail]
+        return []
+
+
+class ShadowFlushSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_a_burst_of_marks_is_flushed_once(self):
+        recorder = Recorder()
+        flusher = ShadowFlushScheduler(recorder, debounce=0.02, max_staleness=1)
+        for shadow_name in ("1_0", "1_1", "1_0", "2_0"):
+            flusher.mark_dirty(shadow_name)
+        await asyncio.sleep(0.1)
+        self.assertEqual([names for at, names in recorder.calls], [["1_0", "1_1", "2_0"]])
+        self.assertEqual(flusher.stats()["coalesced"], 1)
+
+    async def test_steady_marks_are_flushed_by_max_staleness(self):
+        recorder = Recorder()
+        flusher = ShadowFlushScheduler(recorder, debounce=0.05, max_staleness=0.1)
+        start = asyncio.get_running_loop().time()
+        for count in range(10):
+            flusher.mark_dirty("1_0")
+            await asyncio.sleep(0.02)
+        await asyncio.sleep(0.1)
+        #the debounce window never closes so only max_staleness flushes
+        first_flush = recorder.calls[0][0] - start
+        self.assertGreaterEqual(first_flush, 0.09)
+        self.assertLess(first_flush, 0.15)
+        self.assertGreaterEqual(len(recorder.calls), 2)
+
+    async def test_max_marks_flushes_straight_away(self):
+        recorder = Recorder()
+        flusher = ShadowFlushScheduler(recorder, debounce=10, max_staleness=10, max_marks=3)
+        for shadow_name in ("a", "b", "c"):
+            flusher.mark_dirty(shadow_name)
+        await asyncio.sleep(0.01)
+        self.assertEqual([names for at, names in recorder.calls], [["a", "b", "c"]])
+
+    async def test_failed_shadows_are_retried_with_backoff(self):
+        recorder = Recorder(fail=["a"], failures=2)
+        flusher = ShadowFlushScheduler(recorder, debounce=0.01, max_staleness=0.01, retry_delay=0.05, max_backoff=1)
+        flusher.mark_dirty("a")
+        flusher.mark_dirty("b")
+        await asyncio.sleep(0.4)
+        self.assertEqual([names for at, names in recorder.calls], [["a", "b"], ["a"], ["a"]])
+        first_retry = recorder.calls[1][0] - recorder.calls[0][0]
+        second_retry = recorder.calls[2][0] - recorder.calls[1][0]
+        self.assertGreaterEqual(first_retry, 0.05)
+        self.assertGreaterEqual(second_retry, 0.1) # doubled
+        stats = flusher.stats()
+        self.assertEqual(stats["retries"], 2)
+        self.assertEqual(stats["backoff"], 0.0) # reset by the clean flush
+        self.assertEqual(stats["dirty"], 0)
+
+    async def test_a_raising_flush_retries_the_whole_batch(self):
+        recorder = Recorder(failures=1, error=RuntimeError("IPC down"))
+        flusher = ShadowFlushScheduler(recorder, debounce=0.01, max_staleness=0.01, retry_delay=0.02)
+        flusher.mark_dirty("a")
+        flusher.mark_dirty("b")
+        with self.assertLogs(level="ERROR"):
+            await asyncio.sleep(0.1)
+        self.assertEqual([names for at, names in recorder.calls], [["a", "b"], ["a", "b"]])
+        self.assertEqual(flusher.stats()["errors"], 1)
+
+    async def test_backoff_is_capped(self):
+        recorder = Recorder(fail=["a"], failures=100)
+        flusher = ShadowFlushScheduler(recorder, debounce=0, max_staleness=0, retry_delay=0.01, max_backoff=0.02)
+        flusher.mark_dirty("a")
+        await asyncio.sleep(0.15)
+        self.assertEqual(flusher.stats()["backoff"], 0.02)
+        self.assertGreaterEqual(len(recorder.calls), 4)
+        flusher.dirty = {}
+
+    async def test_flush_writes_everything_now(self):
+        recorder = Recorder()
+        flusher = ShadowFlushScheduler(recorder, debounce=10, max_staleness=10)
+        flusher.mark_dirty("a")
+        await flusher.flush()
+        self.assertEqual([names for at, names in recorder.calls], [["a"]])
+        await flusher.flush() # nothing dirty, no call
+        self.assertEqual(len(recorder.calls), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
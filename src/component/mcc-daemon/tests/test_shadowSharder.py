@@ -0,0 +1,124 @@
+#
+# Copyright (c) 2023 Matter Cloud Controller Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Tests of the sharding of large endpoint shadows.
+
+To Run:
+python3 -m pytest src/component/mcc-daemon/tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__)))+'/src')
+import jsonCodec
+from shadowUtils import ShadowSharder
+
+
+def endpoint(clusters, attributes=4, value_size=40):
+    #attribute paths of endpoint 1, `attributes` per cluster
+    return {f"1/{cluster}/{attribute}": "x" * value_size for cluster in clusters for attribute in range(attributes)}
+
+def document_size(reported):
+    return len(jsonCodec.dumpb({"state": {"reported": reported}}))
+
+
+class ShadowSharderTest(unittest.TestCase):
+    def test_a_small_endpoint_is_one_document(self):
+        sharder = ShadowSharder(max_size=4096)
+        attributes = endpoint([6, 8])
+        documents, retired = sharder.documents("1_1", attributes)
+        self.assertEqual(documents, {"1_1": attributes})
+        self.assertEqual(retired, [])
+
+    def test_a_large_endpoint_is_split_into_shards_with_a_manifest(self):
+        sharder = ShadowSharder(max_size=600)
+        attributes = endpoint(range(1, 9))
+        documents, retired = sharder.documents("1_1", attributes)
+
+        manifest = documents["1_1"]["shards"]
+        self.assertEqual(list(documents), [shard["name"] for shard in manifest] + ["1_1"])
+        self.assertEqual([shard["name"] for shard in manifest], [f"1_1_{number}" for number in range(len(manifest))])
+        self.assertGreater(len(manifest), 1)
+        merged = {}
+        for shard in manifest:
+            reported = documents[shard["name"]]
+            self.assertLessEqual(document_size(reported), 600)
+            clusters = sorted({int(path.split('/')[1]) for path in reported})
+            self.assertEqual(shard["clusters"], [clusters[0], clusters[-1]])
+            merged.update(reported)
+        self.assertEqual(merged, attributes)
+
+    def test_clusters_are_not_split_when_they_fit(self):
+        sharder = ShadowSharder(max_size=600)
+        documents, retired = sharder.documents("1_1", endpoint(range(1, 9)))
+        seen = {}
+        for shard in documents["1_1"]["shards"]:
+            for path in documents[shard["name"]]:
+                cluster = path.split('/')[1]
+                self.assertEqual(seen.setdefault(cluster, shard["name"]), shard["name"])
+
+    def test_a_cluster_larger_than_a_shard_is_split(self):
+        sharder = ShadowSharder(max_size=600)
+        attributes = endpoint([6], attributes=20)
+        documents, retired = sharder.documents("1_1", attributes)
+        shard_names = [shard["name"] for shard in documents["1_1"]["shards"]]
+        self.assertGreater(len(shard_names), 1)
+        for shard_name in shard_names:
+            self.assertLessEqual(document_size(documents[shard_name]), 600)
+
+    def test_a_change_only_rewrites_its_own_shard(self):
+        sharder = ShadowSharder(max_size=600)
+        attributes = endpoint(range(1, 9))
+        before, retired = sharder.documents("1_1", attributes)
+        attributes["1/8/0"] = "y" * 40
+        after, retired = sharder.documents("1_1", attributes)
+        changed = [name for name in after if after[name] != before[name]]
+        self.assertEqual(len(changed), 1)
+        self.assertIn("1/8/0", after[changed[0]])
+        self.assertEqual(sharder.reshards, 1)
+
+    def test_shrinking_retires_the_shards_with_hysteresis(self):
+        sharder = ShadowSharder(max_size=600)
+        documents, retired = sharder.documents("1_1", endpoint(range(1, 9)))
+        shard_names = [shard["name"] for shard in documents["1_1"]["shards"]]
+
+        #fits in max_size but not in half of it, stays sharded
+        attributes = endpoint([1, 2], attributes=3)
+        self.assertLess(document_size(attributes), 600)
+        self.assertGreater(document_size(attributes), 300)
+        documents, retired = sharder.documents("1_1", attributes)
+        self.assertIn("shards", documents["1_1"])
+        self.assertEqual(retired, [name for name in shard_names if name not in documents])
+
+        attributes = endpoint([1], attributes=2)
+        documents, retired = sharder.documents("1_1", attributes)
+        self.assertEqual(documents, {"1_1": attributes})
+        self.assertTrue(retired)
+        self.assertEqual(sharder.stats()["sharded_shadows"], 0)
+
+    def test_forget_returns_the_shards(self):
+        sharder = ShadowSharder(max_size=600)
+        documents, retired = sharder.documents("1_1", endpoint(range(1, 9)))
+        self.assertEqual(sharder.forget("1_1"), [shard["name"] for shard in documents["1_1"]["shards"]])
+        self.assertEqual(sharder.forget("1_1"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
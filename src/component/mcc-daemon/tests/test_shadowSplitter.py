@@ -0,0 +1,93 @@
+#
+# Copyright (c) 2023 Matter Cloud Controller Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Tests of the split of endpoint shadows into live and static shadows.
+
+To Run:
+python3 -m pytest src/component/mcc-daemon/tests
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__)))+'/src')
+from shadowUtils import DEFAULT_STATIC_ATTRIBUTES, ShadowSplitter
+
+
+ATTRIBUTES = {"0/40/1": "vendor", "1/6/0": True, "1/8/0": 10}
+
+
+class ShadowSplitterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.state_file = os.path.join(self.directory.name, "hot.json")
+
+    def test_off_keeps_everything_live(self):
+        splitter = ShadowSplitter()
+        self.assertEqual(splitter.split(ATTRIBUTES), (ATTRIBUTES, {}))
+        self.assertFalse(splitter.observe_change("0/40/1"))
+        splitter.mark_static_dirty("1_0")
+        self.assertFalse(splitter.pop_static_dirty("1_0"))
+
+    def test_config_mode_uses_the_static_rules(self):
+        splitter = ShadowSplitter("config", DEFAULT_STATIC_ATTRIBUTES.split(","))
+        live, static = splitter.split(dict(ATTRIBUTES, **{"1/6/65532": 1}))
+        self.assertEqual(live, {"1/6/0": True, "1/8/0": 10})
+        self.assertEqual(static, {"0/40/1": "vendor", "1/6/65532": 1})
+        #a static attribute that changes rewrites the static shadow
+        self.assertTrue(splitter.observe_change("0/40/1"))
+        self.assertFalse(splitter.observe_change("1/6/0"))
+        self.assertEqual(splitter.stats()["static_changes"], 1)
+
+    def test_learn_mode_starts_static_and_promotes_changing_attributes(self):
+        splitter = ShadowSplitter("learn", state_file=self.state_file)
+        self.assertEqual(splitter.split(ATTRIBUTES), ({}, ATTRIBUTES))
+
+        #the first change moves the attribute out of the static shadow
+        self.assertTrue(splitter.observe_change("1/6/0"))
+        self.assertFalse(splitter.observe_change("1/6/0"))
+        live, static = splitter.split(ATTRIBUTES)
+        self.assertEqual(live, {"1/6/0": True})
+        self.assertEqual(static, {"0/40/1": "vendor", "1/8/0": 10})
+        self.assertEqual(splitter.stats()["promotions"], 1)
+
+    def test_learned_attributes_survive_a_restart(self):
+        splitter = ShadowSplitter("learn", state_file=self.state_file)
+        splitter.observe_change("1/8/0")
+        splitter = ShadowSplitter("learn", state_file=self.state_file)
+        self.assertEqual(splitter.split(ATTRIBUTES)[0], {"1/8/0": 10})
+
+    def test_a_broken_state_file_starts_over(self):
+        with open(self.state_file, "w") as state:
+            state.write("{not json")
+        with self.assertLogs(level="ERROR"):
+            splitter = ShadowSplitter("learn", state_file=self.state_file)
+        self.assertEqual(splitter.hot, set())
+
+    def test_static_dirty_is_popped_once(self):
+        splitter = ShadowSplitter("learn")
+        splitter.mark_static_dirty("1_0")
+        self.assertTrue(splitter.pop_static_dirty("1_0"))
+        self.assertFalse(splitter.pop_static_dirty("1_0"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,12 @@
 #Import the required libraries
 import psycopg2
 from psycopg2.extras import RealDictCursor
+import boto3
 import json
 import os
 
+iot_data = None
+
 def set_up_connection():
 	try:
 		# If the requested key does not exist, it raises `KeyError(key)`.
@@ -30,6 +33,69 @@ def set_up_connection():
 	)
 	return conn
 
+def iot_data_client():
+	#The IoT data plane client used to read the shadows of sharded endpoints
+	global iot_data
+	if iot_data is None:
+		endpoint = boto3.client('iot').describe_endpoint(endpointType='iot:Data-ATS')['endpointAddress']
+		iot_data = boto3.client('iot-data', endpoint_url='https://' + endpoint)
+	return iot_data
+
+def get_reported(thingName, shadowName):
+	#The reported state of a named shadow, empty if there is no such shadow
+	client = iot_data_client()
+	try:
+		response = client.get_thing_shadow(thingName=thingName, shadowName=shadowName)
+	except client.exceptions.ResourceNotFoundException:
+		return {}
+	return json.loads(response['payload'].read()).get('state', {}).get('reported', {})
+
+def base_shadow_name(shadowName):
+	#The shadow an endpoint is written to. When the endpoint does not fit in
+	#one shadow document the daemon splits it into the shards <shadow>_0,
+	#<shadow>_1, ... and the base shadow only holds their manifest
+	parts = shadowName.split('_')
+	if len(parts) > 2 and parts[-1].isdigit():
+		return '_'.join(parts[:-1])
+	return shadowName
+
+def endpoint_shadow_attributes(thingName, shadowName, reported):
+	#The reported state of the base shadow and all the attributes of an
+	#endpoint shadow, given the reported state of the shadow that was updated.
+	#The other shards are read back when it is sharded
+	baseName = base_shadow_name(shadowName)
+	base = reported if baseName == shadowName else get_reported(thingName, baseName)
+	if 'shards' not in base:
+		return base, (reported if baseName == shadowName else {})
+	attributes = {}
+	for shard in base['shards']:
+		if shard['name'] == shadowName:
+			attributes.update(reported)
+		else:
+			attributes.update(get_reported(thingName, shard['name']))
+	return base, attributes
+
+def endpoint_attributes(thingName, shadowName, reported):
+	#All the attributes of an endpoint. The daemon can split an endpoint
+	#between its live shadow <node>_<ep> and a static shadow <node>_<ep>_static
+	#that the live shadow names in its "static" key, both go in one Endpoint
+	baseName = base_shadow_name(shadowName)
+	liveName = '_'.join(baseName.split('_')[:2])
+	if baseName == liveName:
+		live, liveAttributes = endpoint_shadow_attributes(thingName, shadowName, reported)
+		staticName = live.get('static')
+		if staticName is None:
+			return liveAttributes
+		static, staticAttributes = endpoint_shadow_attributes(thingName, staticName, get_reported(thingName, staticName))
+	else:
+		static, staticAttributes = endpoint_shadow_attributes(thingName, shadowName, reported)
+		live, liveAttributes = endpoint_shadow_attributes(thingName, liveName, get_reported(thingName, liveName))
+	#An attribute learned to change is in the live shadow before it is removed
+	#from the static shadow
+	attributes = dict(staticAttributes)
+	attributes.update(liveAttributes)
+	return attributes
+
 def lambda_handler_thing_deleted(event, context):
 	print("lambda_handler_thing_deleted")
 	print(json.dumps(event))
@@ -45,6 +111,8 @@ def lambda_handler_thing_deleted(event, context):
 					jsonMessage = json.loads(record['Sns']['Message'])
 					thingName = jsonMessage['thing_name']
 					shadowName = jsonMessage['shadow_name']
+					if len(shadowName.split('_')) > 2:
+						continue #a shard of a sharded endpoint shadow, the node itself is still there
 					nodeId = shadowName.split('_')[0]
 					endpointId = shadowName.split('_')[1]
 
@@ -92,8 +160,10 @@ def lambda_handler_thing_updated(event, context):
 						nodeId = shadowName.split('_')[0]
 						endpointId = shadowName.split('_')[1]
 
-						# Iterate through the object
-						attributes = jsonMessage['reported']
+						# Iterate through the object, this is the full reported state of the
+						# shadow (current.state.reported of update/documents) not the update
+						# and of the other shadows the endpoint is split into
+						attributes = endpoint_attributes(thingName, shadowName, jsonMessage.get('reported', {}))
 						jsonEndpoints = attributes_to_json(attributes)
 						#print(f"Processing message {jsonEndpoints}")
 						controllerId = findControllerId(thingName)
@@ -297,18 +367,16 @@ def attributes_to_json(attributes):
         # go thru each attribute and build a json object
         if attribute in attributes:
             attribute_array = attribute.split('/')
+            if len(attribute_array) != 3:
+                continue # not an attribute path, e.g. the manifest of a sharded shadow
             endpoint_key = attribute_array[0]
             cluster_key = attribute_array[1]
             attribute_key = attribute_array[2]
-            if cluster_key not in cluster_dict:
-                # if we havent seen that cluster before initialize the attribute dictionaries
-                attribute_dict = {}
-            if endpoint_key not in data_dict:
-                # if we havent seen that endpoint before initialize the cluster dictionaries
-                cluster_dict = {}
+            # the attributes of a cluster are not always next to each other when
+            # an endpoint is read from more than one shadow
+            cluster_dict = data_dict.setdefault(endpoint_key, {})
+            attribute_dict = cluster_dict.setdefault(cluster_key, {})
             attribute_dict[attribute_key] = attributes[attribute]
-            cluster_dict[cluster_key] = attribute_dict
-            data_dict[endpoint_key] = cluster_dict
     return data_dict
 
 def deleteFromDb(controllerName, id):